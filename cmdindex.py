@@ -0,0 +1,214 @@
+'''Inverted index of the recipe commands of a make database.
+
+   Each command line is split into words at white space, quotes and
+   the shell operators ; & | < > ( ). Every target is listed under the
+   words of its commands, so the targets running some words are found
+   by intersecting their lists, without reading the commands of any
+   other target. A path is listed under its last part only, so that
+   "javac" finds prebuilts/jdk/bin/javac and the lists stay few, and
+   an option with a value also under the option, so that "-std" finds
+   -std=c++11. The commands of the targets found are then read, to
+   keep the ones with all words on one line.
+
+   Building the index reads every command, so it is saved next to the
+   database (make.db -> make.db.cmds), keyed like make.db.vars.'''
+
+import os
+import re
+import bisect
+import marshal
+import logging
+import array
+import threading
+
+import graphcache
+import graphstore
+
+VERSION = 1
+WORD_RE = re.compile(r'''[^\s;&|<>()'"`]+''')
+
+
+def split_words(cmd):
+    # Leave out the prefixes of make (@ silent, - ignore errors, + run
+    # with -n)
+    return WORD_RE.findall(cmd.lstrip(' \t@-+'))
+
+
+def query_words(text):
+    '''Returns the words of a query, split as command lines are'''
+    return WORD_RE.findall(text)
+
+
+def key(word):
+    '''Returns the key which word is listed under: the last part of a
+       path, otherwise the word itself'''
+    if '/' in word:
+        return word.rstrip('/').rsplit('/', 1)[-1]
+    return word
+
+
+def line_keys(cmd):
+    '''Returns the set of the keys of a command line'''
+    keys = set()
+    for word in split_words(cmd):
+        keys.add(key(word))
+        if word.startswith('-') and '=' in word:
+            keys.add(word.split('=', 1)[0])
+    return keys
+
+
+def line_terms(cmd):
+    '''Returns the set of the words and keys of a command line: the
+       words which a query word may equal'''
+    words = split_words(cmd)
+    terms = set(words)
+    for word in words:
+        if '/' in word:
+            terms.add(key(word))
+        if word.startswith('-') and '=' in word:
+            terms.add(word.split('=', 1)[0])
+    return terms
+
+
+def matches(cmd, query):
+    '''Returns True if the command line cmd has all words of query,
+       where a word ending with * matches the words and keys starting
+       with the rest of it'''
+    # Most lines are ruled out without splitting them
+    for word in query:
+        if key(word.rstrip('*')) not in cmd:
+            return False
+    terms = line_terms(cmd)
+    for word in query:
+        if word.endswith('*'):
+            prefix = word[:-1]
+            if not any(t.startswith(prefix) for t in terms):
+                return False
+        elif word not in terms:
+            return False
+    return True
+
+
+def build(store):
+    '''Returns a dictionary from each key to the array of the targets
+       of store with a command line having it, in increasing order'''
+    lists = {}
+    for i in xrange(store.n):
+        if not store.flags(i) & graphstore.IS_TARGET:
+            continue
+        keys = set()
+        for cmd in store.read_cmds(i):
+            keys.update(line_keys(cmd))
+        for k in keys:
+            ids = lists.get(k)
+            if ids is None:
+                ids = lists[k] = array.array('i')
+            ids.append(i)
+    return lists
+
+
+class CmdIndex:
+    def __init__(self, lists):
+        self.lists = lists
+        self.sorted_keys = None
+
+    def postings(self, word):
+        '''Returns the targets which may have word in a command line,
+           as a sorted sequence'''
+        if not word.endswith('*'):
+            return self.lists.get(key(word), ())
+        prefix = word[:-1]
+        if '/' in prefix:
+            raise ValueError('a word ending with * can not contain /: ' +
+                             word)
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.lists)
+        ids = set()
+        i = bisect.bisect_left(self.sorted_keys, prefix)
+        while (i < len(self.sorted_keys) and
+               self.sorted_keys[i].startswith(prefix)):
+            ids.update(self.lists[self.sorted_keys[i]])
+            i += 1
+        return sorted(ids)
+
+    def candidates(self, query):
+        '''Returns the targets having all keys of the words of query'''
+        lists = sorted((self.postings(w) for w in query), key=len)
+        if not lists:
+            return []
+        found = set(lists[0])
+        for ids in lists[1:]:
+            if not found:
+                break
+            found.intersection_update(ids)
+        return sorted(found)
+
+    def search(self, store, query):
+        '''Returns (target, matching command lines) for each target of
+           store with all words of query on one command line, in
+           sorted order'''
+        result = []
+        for i in self.candidates(query):
+            lines = [c for c in store.read_cmds(i) if matches(c, query)]
+            if lines:
+                result.append((i, lines))
+        return result
+
+    def targets(self, store, query):
+        '''Returns the set of the targets found by search()'''
+        if len(query) == 1 and key(query[0]) == query[0]:
+            # Having the key is having the word
+            return set(self.candidates(query))
+        return set(i for (i, lines) in self.search(store, query))
+
+
+def cache_path(db_path):
+    return db_path + '.cmds'
+
+
+def load(db_path, store, use_cache=True):
+    '''Returns the CmdIndex of store, the graph of the database
+       db_path, from the file make.db.cmds if it is up to date.
+       Without db_path, it is built and not saved.'''
+    if not (db_path and use_cache):
+        return CmdIndex(build(store))
+    cache_key = (graphcache.db_key(db_path), store.n)
+    path = cache_path(db_path)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as fi:
+                (version, cached_key, data) = marshal.load(fi)
+            if version == VERSION and cached_key == cache_key:
+                return CmdIndex(dict((k, graphcache.from_ints('i', ids))
+                                     for (k, ids) in data.iteritems()))
+            logging.info('Command index %s is out of date', path)
+        except (EOFError, ValueError, TypeError) as e:
+            logging.info('Ignoring command index %s: %s', path, e)
+    lists = build(store)
+    data = dict((k, graphcache.int_array('i', ids))
+                for (k, ids) in lists.iteritems())
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fo:
+            marshal.dump((VERSION, cache_key, data), fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logging.info('Could not write command index: %s', e)
+    return CmdIndex(lists)
+
+
+class Loader:
+    '''Returns the CmdIndex of a database when called, loading it the
+       first time. Queries which do not need it do not pay for it.'''
+    def __init__(self, db_path, store, use_cache=True):
+        self.db_path = db_path
+        self.store = store
+        self.use_cache = use_cache
+        self.index = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.index is None:
+                self.index = load(self.db_path, self.store, self.use_cache)
+        return self.index
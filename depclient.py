@@ -0,0 +1,191 @@
+'''Client side of the depserver.py protocol.
+
+   The client connects to the Unix domain socket of the server and
+   sends one request per line, as a JSON object with an "op" member.
+   The server answers each request with one line:
+     {"ok": true, "result": ...}  or  {"ok": false, "error": "..."}
+
+   Requests:
+     {"op": "info"}                     -> {"db": path, "nodes": count}
+     {"op": "node", "name": N, "cmds": bool}
+                                        -> {"target", "phony", "prereqs",
+                                            "order_only", "parents"
+                                            [, "cmds"]}, null if unknown
+     {"op": "cmds", "name": N}          -> [command, ...]
+     {"op": "subtree", "name": N, "direction": "down"|"up",
+      "depth": D, "bfs": bool}          -> [[name, level], ...]
+     {"op": "path", "src": A, "dst": B} -> [A, ..., B] or null
+     {"op": "query", "args": [arg, ...]}
+                                        -> {"ok", "output", "errors"} of
+                                           a showdep query
+     {"op": "variables", "name": N, "origin": O, "makefile": M}
+                                        -> [[name, flavor, value, origin,
+                                             file, line, pattern], ...]
+     {"op": "find", "text": T, "mode": M, "limit": L}
+                                        -> [name, ...] matching T, best
+                                           first (see namesearch.py)
+
+   Names in a make database are byte strings. They are sent as JSON
+   strings whose characters are the bytes (latin-1), so that any
+   name survives the round trip.
+
+   RemoteTargets and RemoteChildren give the same dictionary-like
+   interface as graphstore.TargetView and graphstore.ChildView,
+   asking the server for one node at a time.'''
+
+import json
+import socket
+
+ENCODING = 'latin-1'
+
+
+class ServerError(Exception):
+    pass
+
+
+def socket_path(db_path):
+    return db_path + '.sock'
+
+
+def to_str(obj):
+    '''Converts the unicode strings in a decoded message back to
+       byte strings'''
+    if isinstance(obj, unicode):
+        return obj.encode(ENCODING)
+    if isinstance(obj, list):
+        return [to_str(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((to_str(k), to_str(v)) for (k, v) in obj.iteritems())
+    return obj
+
+
+def encode(message):
+    return json.dumps(message, encoding=ENCODING) + '\n'
+
+
+def decode(line):
+    return to_str(json.loads(line))
+
+
+class Client:
+    def __init__(self, path):
+        self.address = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except socket.error as e:
+            self.sock.close()
+            raise ServerError('Can not connect to {}: {}'.format(path, e))
+        self.fi = self.sock.makefile('rb')
+
+    def close(self):
+        self.fi.close()
+        self.sock.close()
+
+    def request(self, op, **params):
+        '''Sends one request and returns its result'''
+        params['op'] = op
+        try:
+            self.sock.sendall(encode(params))
+            line = self.fi.readline()
+        except socket.error as e:
+            raise ServerError('Lost connection to {}: {}'.format(
+                self.address, e))
+        if not line:
+            raise ServerError('Server on {} went away'.format(self.address))
+        response = decode(line)
+        if not response['ok']:
+            raise ServerError(response['error'])
+        return response['result']
+
+    def info(self):
+        return self.request('info')
+
+    def node(self, name, cmds=False):
+        return self.request('node', name=name, cmds=cmds)
+
+    def cmds(self, name):
+        return self.request('cmds', name=name)
+
+    def subtree(self, name, direction='down', depth=0, bfs=False):
+        return self.request('subtree', name=name, direction=direction,
+                            depth=depth, bfs=bfs)
+
+    def path(self, src, dst):
+        return self.request('path', src=src, dst=dst)
+
+    def query(self, args):
+        return self.request('query', args=args)
+
+    def variables(self, name, origin=None, makefile=None):
+        return self.request('variables', name=name, origin=origin,
+                            makefile=makefile)
+
+    def find(self, text, mode='any', limit=0):
+        return self.request('find', text=text, mode=mode, limit=limit)
+
+
+class RemoteGraph:
+    '''Remembers the answers for the most recently shown nodes, so
+       that showing a node costs one round trip to the server'''
+    CACHE_SIZE = 64
+
+    def __init__(self, client, with_cmds=False):
+        self.client = client
+        self.with_cmds = with_cmds
+        self.cache = {}
+
+    def node(self, name):
+        if name not in self.cache:
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.clear()
+            self.cache[name] = self.client.node(name, self.with_cmds)
+        return self.cache[name]
+
+
+class RemoteTargets:
+    '''Read-only replacement for the all_targets dictionary'''
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __contains__(self, name):
+        node = self.graph.node(name)
+        return node is not None and node['target']
+
+    def __getitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        node = self.graph.node(name)
+        return (node['prereqs'], node['order_only'], node.get('cmds', []))
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+
+class RemoteChildren:
+    '''Read-only replacement for the all_children dictionary'''
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __contains__(self, name):
+        node = self.graph.node(name)
+        return node is not None and len(node['parents']) > 0
+
+    def __getitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        return self.graph.node(name)['parents']
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+
+def views(client, with_cmds=False):
+    '''Returns (all_targets, all_children) views of the graph served
+       to client. The commands are only fetched with with_cmds.'''
+    graph = RemoteGraph(client, with_cmds)
+    return (RemoteTargets(graph), RemoteChildren(graph))
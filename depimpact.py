@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+'''Lists the targets which make would rebuild when some files change,
+   e.g. the files of a "git diff --name-only". All changed files are
+   followed up the dependency graph in one traversal, so thousands of
+   files take about as long as one.'''
+
+import argparse
+import array
+import collections
+import os
+import sys
+import textwrap
+
+import graphcache
+import graphstore
+
+# Directories which installed files go to, below the product output
+# directory
+INSTALL_DIRS = frozenset(['system', 'vendor', 'data', 'root', 'recovery',
+                          'odm', 'oem', 'product'])
+
+
+def is_install(name):
+    '''Returns True if name looks like an installed file, e.g.
+       out/target/product/x/system/lib/libfoo.so'''
+    parts = name.split('/')[:-1]
+    return 'obj' not in parts and not INSTALL_DIRS.isdisjoint(parts)
+
+
+def module_of(name):
+    '''Returns the module which a target belongs to: the name of its
+       intermediates directory, the base name of an installed file
+       without suffix, or the target itself for a phony module target
+       like libfoo. Returns None if the module is unknown.'''
+    parts = name.split('/')
+    for part in reversed(parts[:-1]):
+        if part.endswith('_intermediates'):
+            return part[:-len('_intermediates')]
+    if is_install(name):
+        return os.path.splitext(parts[-1])[0]
+    if len(parts) == 1:
+        return name
+    return None
+
+
+def normal_parents(store):
+    '''Returns (offsets, ids): the parents of node i through normal
+       prerequisites are ids[offsets[i]:offsets[i + 1]], as with
+       store.rev_off and store.rev. Order-only prerequisites do not
+       make their targets rebuild, so they are left out. The parents
+       are those of store.rev, which has the edges of every rule of a
+       target, while the order-only flags are only known for the
+       prerequisites of its last rule: an order-only prerequisite of
+       an earlier double-colon rule counts as a normal one.'''
+    n = store.n
+    (fwd, fwd_off, fwd_cnt) = (store.fwd, store.fwd_off, store.fwd_cnt)
+    (rev, rev_off) = (store.rev, store.rev_off)
+    # (target, prerequisite) of the edges which are only order-only
+    order_only = set()
+    for t in xrange(n):
+        start = fwd_off[t]
+        split = start + fwd_cnt[t]
+        if split < fwd_off[t + 1]:
+            normal = set(fwd[start:split])
+            order_only.update((t, p) for p in fwd[split:fwd_off[t + 1]]
+                              if p not in normal)
+    if not order_only:
+        return (rev_off, rev)
+    offsets = array.array('l', [0]) * (n + 1)
+    ids = array.array('i')
+    for p in xrange(n):
+        for t in rev[rev_off[p]:rev_off[p + 1]]:
+            if (t, p) not in order_only:
+                ids.append(t)
+        offsets[p + 1] = len(ids)
+    return (offsets, ids)
+
+
+def affected(store, sources, order_only=False):
+    '''Returns the ids of the nodes which depend on any of sources,
+       directly or not, in breadth-first order. A source is only
+       included if it depends on another source.'''
+    if order_only:
+        (offsets, ids) = (store.rev_off, store.rev)
+    else:
+        (offsets, ids) = normal_parents(store)
+    seen = bytearray(store.n)
+    queue = list(sources)
+    for i in queue:
+        seen[i] = 1
+    result = []
+    for p in queue:
+        for t in ids[offsets[p]:offsets[p + 1]]:
+            if seen[t] < 2:
+                if not seen[t]:
+                    queue.append(t)
+                seen[t] = 2
+                result.append(t)
+    return result
+
+
+def read_files(fi):
+    '''Returns the file names in fi, one per line'''
+    return [l.strip() for l in fi if l.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Lists the targets of a make database (made by "make -qpR")
+           which depend on any of the given files, directly or
+           through other targets: what make would rebuild after the
+           files change. Order-only prerequisites are not followed,
+           as they do not cause a rebuild, unless --order-only is
+           given. The database only tells which prerequisites of the
+           last rule of a target are order-only: those of its earlier
+           double-colon rules are always followed. The files can also
+           be read from a file, e.g.:
+             git diff --name-only HEAD~ | depimpact.py -f make.db -i -
+           Files which are not in the graph are ignored, and counted
+           on stderr.
+           --install only lists installed files (a path below one of
+           the directories {}, and not below obj).
+           --modules prints the number of targets of each module
+           instead, the module being the name of the intermediates
+           directory or of the installed file.'''.format(
+               ', '.join(sorted(INSTALL_DIRS)))))
+    parser.add_argument('changed', nargs='*', help='changed files')
+    parser.add_argument('-i', '--input', action='store', metavar='FILE',
+                        help='read the changed files from FILE, one per '
+                             'line ("-" for stdin)')
+    parser.add_argument('-p', '--prefix', action='store', default='',
+                        help='prepend this to the changed file names, '
+                             'e.g. the path of a git repository within '
+                             'the source tree')
+    parser.add_argument('-f', '--file', action='store',
+                        help='make database to analyse')
+    parser.add_argument('-m', '--make', action='store', metavar='ARGS',
+                        help='run "make -qpR ARGS" and analyse its output '
+                             'instead of a file')
+    parser.add_argument('-s', '--save', action='store',
+                        help='with -m, also save the make database in this '
+                             'file. A name ending with .gz compresses it.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write the index file make.db.idx')
+    parser.add_argument('--install', action='store_true',
+                        help='only list installed files')
+    parser.add_argument('--phony', action='store_true',
+                        help='only list phony targets. With --install, '
+                             'list both.')
+    parser.add_argument('--modules', action='store_true',
+                        help='print the number of affected targets of '
+                             'each module')
+    parser.add_argument('--order-only', action='store_true',
+                        help='also follow order-only prerequisites')
+    args = parser.parse_args()
+
+    if args.make is not None:
+        store = graphcache.load_store_from_make(args.make, args.save,
+                                                not args.no_cache)
+    elif args.file:
+        store = graphcache.load_store(args.file, not args.no_cache,
+                                      args.jobs or None)
+    else:
+        parser.error('a make database (-f or -m) is needed')
+    if isinstance(store, graphcache.GraphIndex):
+        # The traversal reads the whole graph
+        store = store.to_store()
+    changed = list(args.changed)
+    if args.input == '-':
+        changed.extend(read_files(sys.stdin))
+    elif args.input:
+        with open(args.input) as fi:
+            changed.extend(read_files(fi))
+
+    sources = []
+    for name in changed:
+        i = store.lookup(args.prefix + name)
+        if i >= 0:
+            sources.append(i)
+    targets = affected(store, sources, args.order_only)
+    if args.install or args.phony:
+        targets = [t for t in targets
+                   if (args.install and is_install(store.name(t))) or
+                   (args.phony and store.flags(t) & graphstore.IS_PHONY)]
+    names = sorted(store.names_of(targets))
+    if args.modules:
+        counts = collections.Counter(module_of(name) or '(none)'
+                                     for name in names)
+        for (module, count) in sorted(counts.iteritems(),
+                                      key=lambda (m, c): (-c, m)):
+            print '{:7} {}'.format(count, module)
+    else:
+        for name in names:
+            print name
+    sys.stderr.write('{} changed files, {} not in the graph, {} targets '
+                     'affected\n'.format(len(changed),
+                                         len(changed) - len(sources),
+                                         len(names)))
+
+if __name__ == "__main__":
+    main()
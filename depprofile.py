@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+'''Reports how much parallelism the dependency graph of a make
+   database allows: dependency cycles, the number of jobs which can
+   run at each step of a build with unlimited make -j, and the
+   longest chain of jobs.
+   Given the build time of each target, also reports the critical
+   path: the chain of jobs which takes the longest time to build,
+   and the slack of each job: how much longer it could take without
+   making the build slower.'''
+
+import argparse
+import array
+import collections
+import csv
+import sys
+import textwrap
+
+import graphcache
+
+# Width of the bars in the level histogram
+BAR_WIDTH = 50
+
+
+def all_prerequisites(store, i):
+    (order, order_only) = store.prerequisites(i)
+    return order + order_only
+
+
+def strongly_connected(store, roots):
+    '''Yields the strongly connected components reachable from roots
+       through prerequisites, as lists of node ids. A component is
+       yielded after all components it depends on.
+       This is Tarjan's algorithm, with an explicit stack instead of
+       recursion, so that long chains do not hit the recursion limit.'''
+    index = array.array('i', [-1]) * store.n
+    low = array.array('i', [0]) * store.n
+    on_stack = bytearray(store.n)
+    stack = []
+    counter = 0
+    for root in roots:
+        if index[root] >= 0:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        # Nodes being visited, their prerequisites, and the position
+        # of the next prerequisite to look at
+        work = [root]
+        work_succ = [all_prerequisites(store, root)]
+        work_pos = [0]
+        while work:
+            v = work[-1]
+            succ = work_succ[-1]
+            pos = work_pos[-1]
+            if pos < len(succ):
+                work_pos[-1] = pos + 1
+                w = succ[pos]
+                if index[w] < 0:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = 1
+                    work.append(w)
+                    work_succ.append(all_prerequisites(store, w))
+                    work_pos.append(0)
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+                continue
+            work.pop()
+            work_succ.pop()
+            work_pos.pop()
+            if work and low[v] < low[work[-1]]:
+                low[work[-1]] = low[v]
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = 0
+                    component.append(w)
+                    if w == v:
+                        break
+                yield component
+
+
+class Profile:
+    '''Levels of the nodes reachable from roots. A node with a recipe
+       is a job. The level of a node is the number of jobs on the
+       longest chain of prerequisites ending with it, so all jobs of
+       one level can run in parallel once the lower levels are done.
+       The nodes of a cycle get the same level.'''
+    def __init__(self, store, roots):
+        self.store = store
+        self.level = {}
+        # The prerequisite on the longest chain below each node
+        self.via = {}
+        self.cycles = []
+        self.nodes = 0
+        self.jobs = collections.Counter()
+        for component in strongly_connected(store, roots):
+            self.add(component)
+
+    def is_job(self, i):
+        return len(self.store.read_cmds(i)) > 0
+
+    def add(self, component):
+        store = self.store
+        members = set(component)
+        if len(component) > 1 or \
+           component[0] in all_prerequisites(store, component[0]):
+            self.cycles.append(component)
+        top = 0
+        via = None
+        for v in component:
+            for p in all_prerequisites(store, v):
+                if p not in members and self.level[p] > top:
+                    (top, via) = (self.level[p], p)
+        jobs = [v for v in component if self.is_job(v)]
+        level = top + (1 if jobs else 0)
+        for v in component:
+            self.level[v] = level
+            self.via[v] = via
+        self.nodes += len(component)
+        for v in jobs:
+            self.jobs[level] += 1
+
+    def depth(self):
+        return max(self.jobs) if self.jobs else 0
+
+    def longest_chain(self):
+        '''Returns the jobs of a longest chain, from the first job
+           to build to the last'''
+        if not self.level:
+            return []
+        i = max(self.level, key=self.level.get)
+        chain = []
+        while i is not None:
+            if self.is_job(i):
+                chain.append(i)
+            i = self.via[i]
+        chain.reverse()
+        return chain
+
+    def jobs_at(self, levels):
+        '''Returns a dictionary from each of levels to the sorted names
+           of its jobs'''
+        result = dict((l, []) for l in levels)
+        for (i, l) in self.level.iteritems():
+            if l in result and self.is_job(i):
+                result[l].append(self.store.name(i))
+        for names in result.itervalues():
+            names.sort()
+        return result
+
+
+def read_times(fi):
+    '''Reads the build times of targets from a CSV file, with the
+       columns target,start,end or target,duration (in seconds).
+       Lines which do not end with numbers, as a header, are skipped.
+       Returns a dictionary from target name to seconds. The times of
+       a target listed several times, as a double-colon rule, are
+       added.'''
+    times = collections.defaultdict(float)
+    for row in csv.reader(fi):
+        if not row or row[0].startswith('#'):
+            continue
+        try:
+            values = [float(v) for v in row[1:]]
+        except ValueError:
+            continue
+        if len(values) == 2:
+            times[row[0]] += values[1] - values[0]
+        elif len(values) == 1:
+            times[row[0]] += values[0]
+        else:
+            raise ValueError('Bad line in times file: ' + ','.join(row))
+    return times
+
+
+def durations_of(store, times):
+    '''Returns (a dictionary from node id to seconds, the names in
+       times which are not in the graph)'''
+    durations = {}
+    unknown = []
+    for (name, seconds) in times.iteritems():
+        i = store.lookup(name)
+        if i < 0:
+            unknown.append(name)
+        else:
+            durations[i] = seconds
+    return (durations, unknown)
+
+
+class CriticalPath:
+    '''Earliest finish time of the nodes reachable from roots, when
+       every job starts as soon as its prerequisites are done, and
+       the latest finish time which does not delay the whole build.
+       durations maps node ids to seconds; other nodes take no time.
+       Edges inside a cycle are ignored.'''
+    # Slack below which a node is on the critical path, in seconds
+    EPSILON = 1e-6
+
+    def __init__(self, store, roots, durations):
+        self.store = store
+        self.duration = durations
+        self.finish = {}
+        self.via = {}
+        components = list(strongly_connected(store, roots))
+        for component in components:
+            members = set(component)
+            for v in component:
+                (start, via) = (0.0, None)
+                for p in all_prerequisites(store, v):
+                    if p not in members and self.finish[p] > start:
+                        (start, via) = (self.finish[p], p)
+                self.finish[v] = start + durations.get(v, 0.0)
+                self.via[v] = via
+        self.length = max(self.finish.itervalues()) if self.finish else 0.0
+        # Going from the last targets down, a prerequisite must be
+        # done when the first target needing it starts
+        self.latest = dict.fromkeys(self.finish, self.length)
+        for component in reversed(components):
+            members = set(component)
+            for v in component:
+                start = self.latest[v] - durations.get(v, 0.0)
+                for p in all_prerequisites(store, v):
+                    if p not in members and start < self.latest[p]:
+                        self.latest[p] = start
+
+    def slack(self, i):
+        return self.latest[i] - self.finish[i]
+
+    def is_critical(self, i):
+        return self.slack(i) < self.EPSILON
+
+    def start(self, i):
+        return self.finish[i] - self.duration.get(i, 0.0)
+
+    def path(self):
+        '''Returns the nodes with a duration on the critical path,
+           from the first one to build to the last'''
+        if not self.finish:
+            return []
+        i = max(self.finish, key=self.finish.get)
+        path = []
+        while i is not None:
+            if self.duration.get(i):
+                path.append(i)
+            i = self.via[i]
+        path.reverse()
+        return path
+
+
+def print_critical_path(cp, unknown, top, out=sys.stdout):
+    store = cp.store
+    out.write('Critical path: {:.1f} s, total job time: {:.1f} s\n'.format(
+        cp.length, sum(cp.duration.get(i, 0.0) for i in cp.finish)))
+    if unknown:
+        out.write('{} timed targets are not in the graph, e.g. {}\n'.format(
+            len(unknown), sorted(unknown)[0]))
+    out.write('\nCritical path, first job first:\n')
+    out.write('{:>10} {:>10}  {}\n'.format('Start', 'Duration', 'Target'))
+    for i in cp.path():
+        out.write('{:10.1f} {:10.1f}  {}\n'.format(cp.start(i), cp.duration[i],
+                                                   store.name(i)))
+    if not top:
+        return
+    out.write('\nThe {} longest jobs, with their slack:\n'.format(top))
+    out.write('{:>10} {:>10}  {}\n'.format('Slack', 'Duration', 'Target'))
+    timed = sorted((i for i in cp.finish if cp.duration.get(i)),
+                   key=lambda i: (-cp.duration[i], store.name(i)))
+    for i in timed[:top]:
+        out.write('{:10.1f} {:10.1f}  {}\n'.format(cp.slack(i), cp.duration[i],
+                                                   store.name(i)))
+
+
+def print_report(profile, narrow, out=sys.stdout):
+    store = profile.store
+    total = sum(profile.jobs.itervalues())
+    depth = profile.depth()
+    out.write('Nodes: {}, jobs (nodes with a recipe): {}\n'.format(
+        profile.nodes, total))
+    out.write('Cycles: {}\n'.format(len(profile.cycles)))
+    for c in profile.cycles:
+        out.write('  ' + ' -> '.join(store.names_of(c + c[:1])) + '\n')
+    out.write('Longest chain: {} jobs\n'.format(depth))
+    if not depth:
+        return
+    out.write('Average parallelism: {:.1f} jobs\n'.format(
+        float(total) / depth))
+    widest = max(profile.jobs.itervalues())
+    out.write('Widest level: {} jobs\n\n'.format(widest))
+    out.write('Level   Jobs\n')
+    for level in xrange(1, depth + 1):
+        width = profile.jobs[level]
+        bar = '#' * int(round(float(width) * BAR_WIDTH / widest))
+        out.write('{:5} {:6} {}\n'.format(level, width, bar))
+    out.write('\nLongest chain, first job first:\n')
+    for i in profile.longest_chain():
+        out.write('  {:5} {}\n'.format(profile.level[i], store.name(i)))
+    if narrow:
+        out.write('\nLevels with at most {} jobs:\n'.format(narrow))
+        levels = [l for l in xrange(1, depth + 1)
+                  if profile.jobs[l] <= narrow]
+        jobs = profile.jobs_at(levels)
+        for level in levels:
+            for name in jobs[level]:
+                out.write('  {:5} {}\n'.format(level, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Analyses the dependency graph of a make database, as made
+           by "make -qpR". Prints the dependency cycles, and for
+           each level the number of jobs (targets with a recipe)
+           which could run in parallel with an unlimited make -j,
+           after all jobs of the lower levels. The number of levels
+           is the length of the longest chain of jobs, which bounds
+           how fast the build can be, whatever the number of CPUs.
+           Levels with few jobs are where the build is serialized.
+           Only the prerequisites of the given nodes are analysed,
+           or the whole graph if no node is given.
+           With -t, the build time of each target is read from a CSV
+           file with the columns target,start,end or target,duration,
+           in seconds, and the critical path is reported instead: the
+           chain of jobs taking the longest time, which no number of
+           CPUs can make shorter. The slack of a job is how much
+           longer it could take without delaying the build. make
+           --trace does not log the end of jobs, so the times have
+           to come from a wrapper around the recipe shell.'''))
+    parser.add_argument('node', nargs='*')
+    parser.add_argument('-f', '--file', action='store',
+                        help='make database to analyse')
+    parser.add_argument('-m', '--make', action='store', metavar='ARGS',
+                        help='run "make -qpR ARGS" and analyse its output '
+                             'instead of a file')
+    parser.add_argument('-s', '--save', action='store',
+                        help='with -m, also save the make database in this '
+                             'file. A name ending with .gz compresses it.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write the index file make.db.idx')
+    parser.add_argument('-n', '--narrow', type=int, default=1,
+                        help='list the jobs of the levels with at most this '
+                             'many jobs (default 1, 0 = none)')
+    parser.add_argument('-t', '--times', action='store', metavar='CSV',
+                        help='report the critical path, using the build '
+                             'times in this file')
+    parser.add_argument('--top', type=int, default=20,
+                        help='with -t, list the slack of this many of the '
+                             'longest jobs (default 20)')
+    args = parser.parse_args()
+
+    if args.make is not None:
+        store = graphcache.load_store_from_make(args.make, args.save,
+                                                not args.no_cache)
+    elif args.file:
+        store = graphcache.load_store(args.file, not args.no_cache,
+                                      args.jobs or None)
+    else:
+        parser.error('a make database (-f or -m) is needed')
+    roots = []
+    for name in args.node:
+        i = store.lookup(name)
+        if i < 0:
+            sys.exit('Error: {} is not in the graph'.format(name))
+        roots.append(i)
+    roots = roots or xrange(store.n)
+    if args.times:
+        with open(args.times, 'rb') as fi:
+            (durations, unknown) = durations_of(store, read_times(fi))
+        print_critical_path(CriticalPath(store, roots, durations), unknown,
+                            args.top)
+    else:
+        print_report(Profile(store, roots), args.narrow)
+
+if __name__ == "__main__":
+    main()
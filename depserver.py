@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+'''Keeps the dependency graph of a make database loaded, and answers
+   queries about it over a Unix domain socket. makeview.py,
+   mrwalker.py and showdep.py can use it (option -S) instead of
+   loading the graph themselves. See depclient.py for the protocol.'''
+
+import argparse
+import logging
+import os
+import signal
+import SocketServer
+import StringIO
+import sys
+import textwrap
+import threading
+
+import cmdindex
+import depclient
+import graphcache
+import graphstore
+import makevars
+import namesearch
+import showdep
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    '''Answers the requests of one client, one line at a time,
+       until the client closes the connection'''
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = depclient.decode(line)
+                result = self.server.answer(request)
+                response = {'ok': True, 'result': result}
+            except Exception as e:
+                logging.exception('Request %r failed', line)
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(depclient.encode(response))
+            self.wfile.flush()
+
+
+class DepServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+    # Forget the memoised chains of the path finder when it
+    # remembers more than this many
+    MAX_PATHS = 1000000
+
+    def __init__(self, socket_path, store, db_path):
+        SocketServer.ThreadingUnixStreamServer.__init__(self, socket_path,
+                                                        QueryHandler)
+        self.store = store
+        self.db_path = db_path
+        # The path finder is shared by the threads of all clients, and
+        # each search updates its memos
+        self.finder = showdep.PathFinder(store)
+        self.finder_lock = threading.Lock()
+        self.var_index = None
+        self.var_lock = threading.Lock()
+        self.name_index = None
+        self.name_lock = threading.Lock()
+        self.cmd_index = cmdindex.Loader(db_path, store)
+        self.ops = {
+            'info': self.info,
+            'node': self.node,
+            'cmds': self.cmds,
+            'subtree': self.subtree,
+            'path': self.path,
+            'query': self.query,
+            'variables': self.variables,
+            'find': self.find,
+        }
+
+    def answer(self, request):
+        op = self.ops.get(request.get('op'))
+        if not op:
+            raise ValueError('unknown op {}'.format(request.get('op')))
+        return op(request)
+
+    def lookup(self, name):
+        i = self.store.lookup(name)
+        if i < 0:
+            raise ValueError('{} is not in the graph'.format(name))
+        return i
+
+    def path_finder(self):
+        '''Returns the shared path finder. Only call it, and use the
+           result, with finder_lock held.'''
+        if len(self.finder.paths) > self.MAX_PATHS:
+            self.finder = showdep.PathFinder(self.store)
+        return self.finder
+
+    def info(self, request):
+        return {'db': self.db_path, 'nodes': self.store.n}
+
+    def node(self, request):
+        '''The neighbours of a node, and optionally its commands.
+           None if the node is unknown.'''
+        store = self.store
+        i = store.lookup(request['name'])
+        if i < 0:
+            return None
+        (order, order_only) = store.prerequisites(i)
+        flags = store.flags(i)
+        result = {'target': bool(flags & graphstore.IS_TARGET),
+                  'phony': bool(flags & graphstore.IS_PHONY),
+                  'prereqs': store.names_of(order),
+                  'order_only': store.names_of(order_only),
+                  'parents': store.names_of(store.parents(i))}
+        if request.get('cmds'):
+            result['cmds'] = list(store.cmds(i))
+        return result
+
+    def cmds(self, request):
+        return list(self.store.cmds(self.lookup(request['name'])))
+
+    def subtree(self, request):
+        '''[name, level] of each node reachable from a node'''
+        store = self.store
+        walk = showdep.walk(store, self.lookup(request['name']),
+                            request.get('direction', 'down'),
+                            request.get('depth', 0), request.get('bfs', False))
+        return [[store.name(i), level] for (i, level) in walk]
+
+    def path(self, request):
+        '''The shortest chain of prerequisites from src down to dst,
+           or None'''
+        (src, dst) = (self.lookup(request['src']),
+                      self.lookup(request['dst']))
+        with self.finder_lock:
+            path = self.path_finder().path(src, dst)
+        return self.store.names_of(path) if path else None
+
+    def query(self, request):
+        '''Runs a showdep query, given as its command line arguments'''
+        out = StringIO.StringIO()
+        err = StringIO.StringIO()
+        try:
+            args = showdep.QueryParser().parse_args(request['args'])
+        except showdep.QueryError as e:
+            return {'ok': False, 'output': '',
+                    'errors': 'Error: {}\n'.format(e)}
+        if args.path or args.reach:
+            with self.finder_lock:
+                ok = showdep.run_query(self.path_finder(), args, out, err,
+                                       self.cmd_index)
+        else:
+            # The other queries only use the graph of the finder
+            ok = showdep.run_query(showdep.PathFinder(self.store), args,
+                                   out, err, self.cmd_index)
+        return {'ok': ok, 'output': out.getvalue(), 'errors': err.getvalue()}
+
+    def variables(self, request):
+        '''The definitions of the variables matching a name'''
+        with self.var_lock:
+            if self.var_index is None:
+                self.var_index = makevars.load_index(self.db_path)
+        return [list(v) for v in makevars.lookup(self.var_index,
+                                                 request['name'],
+                                                 request.get('origin'),
+                                                 request.get('makefile'))]
+
+    def find(self, request):
+        '''The node names matching a search text, best first'''
+        with self.name_lock:
+            if self.name_index is None:
+                self.name_index = namesearch.load(
+                    self.db_path, namesearch.store_names(self.store))
+        return self.name_index.find(request['text'],
+                                    request.get('mode', 'any'),
+                                    request.get('limit', 0))
+
+
+def remove_stale_socket(path):
+    '''Removes the socket file at path, unless a server answers on it'''
+    if not os.path.exists(path):
+        return
+    try:
+        depclient.Client(path).close()
+    except depclient.ServerError:
+        os.unlink(path)
+        return
+    sys.exit('Error: a server is already running on ' + path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Loads the dependency graph of a make database once, and
+           answers queries about it on a Unix domain socket, by
+           default make.db.sock next to the database. Start it with
+             depserver.py -f make.db &
+           and then use the -S option of makeview.py, mrwalker.py and
+           showdep.py to query it. Anyone who may open the socket file
+           may query the server. Restart the server when the database
+           changes.'''))
+    parser.add_argument('-f', '--file', action='store', required=True,
+                        help='make database to serve')
+    parser.add_argument('-S', '--socket', action='store',
+                        help='path of the socket (default: <file>.sock)')
+    parser.add_argument('-l', '--logfile', action='store',
+                        help='optional file to store diagnostics in')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write the index file make.db.idx')
+    args = parser.parse_args()
+
+    if args.logfile:
+        logging.basicConfig(filename=args.logfile, level=logging.DEBUG)
+    socket_path = args.socket or depclient.socket_path(args.file)
+    remove_stale_socket(socket_path)
+
+    store = graphcache.load_store(args.file, not args.no_cache,
+                                  args.jobs or None)
+    server = DepServer(socket_path, store, args.file)
+    print 'Serving {} ({} nodes) on {}'.format(args.file, store.n,
+                                               socket_path)
+    sys.stdout.flush()
+    # Remove the socket also when killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+if __name__ == "__main__":
+    main()
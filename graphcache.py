@@ -0,0 +1,346 @@
+'''Persistent binary index of a parsed make database.
+
+   The first time a database is loaded, the dependency graph is
+   written to an index file next to it (make.db -> make.db.idx).
+   Later runs memory-map the index instead of parsing the database
+   again. The index is only used if the size, modification time
+   and a hash of the beginning and end of the database all match.
+
+   Index file layout (all integers little-endian):
+     header   MAGIC, version, db size, db mtime, db hash,
+              number of nodes and the offset of each section
+     names    node names, sorted, concatenated
+     name_off int64[n+1]   offsets into names
+     flags    uint8[n]     IS_TARGET | IS_PHONY
+     fwd_off  int64[n+1]   offsets into fwd
+     fwd_cnt  int32[n]     number of normal prerequisites
+     fwd      int32[]      prerequisites, normal ones first
+     rev_off  int64[n+1]   offsets into rev
+     rev      int32[]      targets having the node as prerequisite
+     cmd_off  int64[n+1]   offsets into cmds
+     cmds     commands, each one ending with a newline
+'''
+
+import os
+import mmap
+import bisect
+import struct
+import hashlib
+import logging
+import array
+import sys
+
+import graphstore
+import makedb
+
+MAGIC = 'MKDBIDX\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIqd16sq10q')
+SECTIONS = ['names', 'name_off', 'flags', 'fwd_off', 'fwd_cnt', 'fwd',
+            'rev_off', 'rev', 'cmd_off', 'cmds']
+
+# Number of bytes hashed at each end of the database
+HASH_SPAN = 1024 * 1024
+
+
+def cache_path(db_path):
+    return db_path + '.idx'
+
+
+def db_key(db_path):
+    '''Returns (size, mtime, hash) identifying a database file'''
+    st = os.stat(db_path)
+    h = hashlib.md5()
+    with open(db_path, 'rb') as fi:
+        h.update(fi.read(HASH_SPAN))
+        if st.st_size > HASH_SPAN:
+            fi.seek(max(HASH_SPAN, st.st_size - HASH_SPAN))
+            h.update(fi.read(HASH_SPAN))
+    return (st.st_size, st.st_mtime, h.digest())
+
+
+def int_array(typecode, values):
+    '''Returns values as little-endian integers of type typecode'''
+    size = struct.calcsize(typecode)
+    if (isinstance(values, array.array) and values.itemsize == size
+        and sys.byteorder == 'little'):
+        return values.tostring()
+    return struct.pack('<{}{}'.format(len(values), typecode), *values)
+
+
+def from_ints(typecode, data):
+    '''The reverse of int_array(): returns the little-endian integers
+       of type typecode in data, as an array'''
+    size = struct.calcsize(typecode)
+    values = array.array('l' if typecode == 'q' else typecode)
+    if values.itemsize == size and sys.byteorder == 'little':
+        values.fromstring(data)
+    else:
+        values.extend(struct.unpack('<{}{}'.format(len(data) // size,
+                                                   typecode), data))
+    return values
+
+
+def write_index(idx_path, key, store):
+    '''Writes a finished graphstore.GraphStore to idx_path'''
+    name_off = array.array('l', [0]) * (store.n + 1)
+    for i in xrange(store.n):
+        name_off[i + 1] = name_off[i] + len(store.names[i])
+    # The commands are written last, one node at a time, and their
+    # offsets are filled in afterwards. This way, commands which are
+    # kept in the database (makedb.LazyCmds) are never all decoded
+    # at the same time.
+    cmd_off = array.array('l', [0]) * (store.n + 1)
+
+    sections = [''.join(store.names),
+                int_array('q', name_off),
+                str(store.node_flags),
+                int_array('q', store.fwd_off),
+                int_array('i', store.fwd_cnt),
+                int_array('i', store.fwd),
+                int_array('q', store.rev_off),
+                int_array('i', store.rev),
+                int_array('q', cmd_off)]
+    offsets = []
+    pos = HEADER.size
+    for s in sections:
+        offsets.append(pos)
+        pos += len(s)
+    offsets.append(pos)
+    (size, mtime, digest) = key
+    tmp_path = idx_path + '.tmp'
+    with open(tmp_path, 'wb') as fo:
+        fo.write(HEADER.pack(MAGIC, VERSION, size, mtime, digest,
+                             store.n, *offsets))
+        for s in sections:
+            fo.write(s)
+        for i in xrange(store.n):
+            data = ''.join(c + '\n' for c in store.read_cmds(i))
+            fo.write(data)
+            cmd_off[i + 1] = cmd_off[i] + len(data)
+        fo.seek(offsets[SECTIONS.index('cmd_off')])
+        fo.write(int_array('q', cmd_off))
+    os.rename(tmp_path, idx_path)
+
+
+class GraphIndex:
+    '''A memory-mapped index file'''
+    def __init__(self, idx_path):
+        with open(idx_path, 'rb') as fi:
+            self.mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self.mm, 0)
+        (magic, version, self.size, self.mtime, self.digest,
+         self.n) = fields[:6]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a valid index'.format(idx_path))
+        self.off = dict(zip(SECTIONS, fields[6:]))
+
+    def close(self):
+        self.mm.close()
+
+    def _int(self, section, fmt, i):
+        size = struct.calcsize(fmt)
+        return struct.unpack_from('<' + fmt, self.mm,
+                                  self.off[section] + i * size)[0]
+
+    def _ints(self, section, fmt, start, end):
+        size = struct.calcsize(fmt)
+        return list(struct.unpack_from('<{}{}'.format(end - start, fmt),
+                                       self.mm,
+                                       self.off[section] + start * size))
+
+    def name(self, i):
+        start = self.off['names']
+        return self.mm[start + self._int('name_off', 'q', i):
+                       start + self._int('name_off', 'q', i + 1)]
+
+    def names_of(self, ids):
+        return [self.name(i) for i in ids]
+
+    def lookup(self, name):
+        '''Returns the id of a node name, or -1 if it is unknown'''
+        i = bisect.bisect_left(NameSeq(self), name)
+        if i < self.n and self.name(i) == name:
+            return i
+        return -1
+
+    def flags(self, i):
+        return ord(self.mm[self.off['flags'] + i])
+
+    def prerequisites(self, i):
+        '''Returns (normal, order-only) prerequisite ids of node i'''
+        start = self._int('fwd_off', 'q', i)
+        end = self._int('fwd_off', 'q', i + 1)
+        split = start + self._int('fwd_cnt', 'i', i)
+        return (self._ints('fwd', 'i', start, split),
+                self._ints('fwd', 'i', split, end))
+
+    def is_order_only(self, t, p):
+        '''Returns True if p is an order-only prerequisite of node t'''
+        start = self._int('fwd_off', 'q', t) + self._int('fwd_cnt', 'i', t)
+        end = self._int('fwd_off', 'q', t + 1)
+        return start < end and p in self._ints('fwd', 'i', start, end)
+
+    def parents(self, i):
+        return self._ints('rev', 'i', self._int('rev_off', 'q', i),
+                          self._int('rev_off', 'q', i + 1))
+
+    def cmds(self, i):
+        start = self.off['cmds']
+        data = self.mm[start + self._int('cmd_off', 'q', i):
+                       start + self._int('cmd_off', 'q', i + 1)]
+        return data.split('\n')[:-1]
+
+    # The commands of an index are never kept decoded
+    read_cmds = cmds
+
+    def name_list(self):
+        '''Returns all node names, sorted, as a list'''
+        name_off = self._array('name_off', 'q', self.n + 1)
+        start = self.off['names']
+        names = self.mm[start:start + name_off[self.n]]
+        return [names[name_off[i]:name_off[i + 1]] for i in xrange(self.n)]
+
+    def cmd_lists(self):
+        '''Yields (id, commands) for each node with commands, in id
+           order, reading the offsets at once'''
+        cmd_off = self._array('cmd_off', 'q', self.n + 1)
+        start = self.off['cmds']
+        data = self.mm[start:start + cmd_off[self.n]]
+        for i in xrange(self.n):
+            if cmd_off[i] != cmd_off[i + 1]:
+                yield (i, data[cmd_off[i]:cmd_off[i + 1]].split('\n')[:-1])
+
+    def _array(self, section, typecode, count):
+        start = self.off[section]
+        return from_ints(typecode, self.mm[start:start + count *
+                                           struct.calcsize(typecode)])
+
+    def to_store(self):
+        '''Returns a finished graphstore.GraphStore holding a copy of
+           the graph. Reading it is much faster than reading the index,
+           for code which visits most of the graph. The commands are
+           still read from the index when they are used.'''
+        n = self.n
+        store = graphstore.GraphStore()
+        store.names = self.name_list()
+        store.ids = dict((name, i) for (i, name) in enumerate(store.names))
+        start = self.off['flags']
+        store.node_flags = bytearray(self.mm[start:start + n])
+        store.node_cmds = IndexCmds(self)
+        store.fwd_off = self._array('fwd_off', 'q', n + 1)
+        store.fwd_cnt = self._array('fwd_cnt', 'i', n)
+        store.fwd = self._array('fwd', 'i', store.fwd_off[n])
+        store.rev_off = self._array('rev_off', 'q', n + 1)
+        store.rev = self._array('rev', 'i', store.rev_off[n])
+        store.n = n
+        del store.edge_src, store.edge_dst, store.edge_rule
+        del store.edge_order_only, store.last_rule
+        store.finished = True
+        return store
+
+
+class IndexCmds:
+    '''The commands of all nodes of an index, as a read-only list'''
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, i):
+        return self.index.cmds(i)
+
+
+class NameSeq:
+    '''The sorted node names of an index, as a sequence for bisect'''
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.n
+
+    def __getitem__(self, i):
+        return self.index.name(i)
+
+
+def open_index(db_path):
+    '''Returns the GraphIndex of db_path, or None if there is no
+       index or if it does not belong to the current database'''
+    idx_path = cache_path(db_path)
+    if not os.path.exists(idx_path):
+        return None
+    try:
+        index = GraphIndex(idx_path)
+    except (ValueError, struct.error, mmap.error) as e:
+        logging.info('Ignoring index %s: %s', idx_path, e)
+        return None
+    if (index.size, index.mtime, index.digest) != db_key(db_path):
+        logging.info('Index %s is out of date', idx_path)
+        index.close()
+        return None
+    return index
+
+
+def is_current(db_path):
+    '''Returns True if db_path has an up to date index'''
+    index = open_index(db_path)
+    if index:
+        index.close()
+        return True
+    return False
+
+
+def parse(db_path, jobs=1):
+    '''Parses db_path into a graphstore.GraphStore, using jobs
+       processes (None means one per CPU). Compressed databases are
+       always parsed by a single process.'''
+    # Commands are decoded from the database only when they are used
+    cmd_source = makedb.open_cmd_source(db_path)
+    if jobs == 1 or db_path.endswith('.gz'):
+        with makedb.open_db(db_path) as fi:
+            return graphstore.load(fi, cmd_source)
+    return graphstore.load_parallel(db_path, jobs, cmd_source)
+
+
+def build_index(db_path, jobs=1):
+    '''Parses db_path and writes its index.
+       Returns the parsed graphstore.GraphStore.'''
+    key = db_key(db_path)
+    store = parse(db_path, jobs)
+    try:
+        write_index(cache_path(db_path), key, store)
+    except (IOError, OSError) as e:
+        logging.info('Could not write index: %s', e)
+    return store
+
+
+def load_store(db_path, use_cache=True, jobs=1):
+    '''Returns the graph of the database db_path. This is the index
+       if it is up to date. Otherwise the database is parsed into a
+       graphstore.GraphStore, and the index is rewritten.'''
+    if not use_cache:
+        return parse(db_path, jobs)
+    index = open_index(db_path)
+    if index:
+        logging.debug('Using index %s', cache_path(db_path))
+        return index
+    return build_index(db_path, jobs)
+
+
+def load_store_from_make(make_args, save_path=None, use_cache=True):
+    '''Runs "make -qpR make_args", and parses its output while it is
+       being printed. If save_path is given, the database is saved
+       there, and an index is written for it unless use_cache is
+       False.'''
+    with makedb.MakeReader(make_args, save_path) as fi:
+        store = graphstore.load(fi)
+    if save_path and use_cache:
+        try:
+            write_index(cache_path(save_path), db_key(save_path), store)
+        except (IOError, OSError) as e:
+            logging.info('Could not write index: %s', e)
+    return store
+
+
+def load(db_path, use_cache=True, jobs=1):
+    '''Returns (all_targets, all_children) views of the graph of
+       the database db_path'''
+    return graphstore.views(load_store(db_path, use_cache, jobs))
@@ -0,0 +1,374 @@
+'''Compact in-memory store for the make dependency graph.
+
+   Each node name is stored once, and nodes are referred to by
+   integer ids. Ids are assigned in sorted name order. Prerequisites
+   and parents are kept in compressed-sparse-row arrays:
+   the prerequisites of node i are fwd[fwd_off[i]:fwd_off[i+1]],
+   of which the first fwd_cnt[i] are normal prerequisites and the
+   rest are order-only. The parents of node i are
+   rev[rev_off[i]:rev_off[i+1]].
+
+   TargetView and ChildView give a dictionary-like, read-only
+   interface to a store, compatible with the all_targets and
+   all_children dictionaries used by makeview.py and mrwalker.py.
+   They work both on a GraphStore and on a graphcache.GraphIndex.'''
+
+import array
+import marshal
+
+import makedb
+
+IS_TARGET = 1
+IS_PHONY = 2
+
+
+class GraphStore:
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.n = 0
+        self.finished = False
+        # Edges, in the order they appear in the database
+        self.edge_src = array.array('i')
+        self.edge_dst = array.array('i')
+        self.edge_rule = array.array('i')
+        self.edge_order_only = bytearray()
+        # Last rule seen for each node, and its commands
+        self.last_rule = array.array('i')
+        self.node_flags = bytearray()
+        self.node_cmds = []
+        self.rule_count = 0
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+            self.last_rule.append(-1)
+            self.node_flags.append(0)
+            self.node_cmds.append(None)
+        return i
+
+    def add_rule(self, rule):
+        '''Adds a makedb.Rule. As in all_targets, a later rule for the
+           same target replaces the prerequisites of an earlier one,
+           while the target stays a parent of all its prerequisites.'''
+        assert not self.finished
+        t = self.intern(rule.target)
+        seq = self.rule_count
+        self.rule_count += 1
+        self.last_rule[t] = seq
+        self.node_flags[t] |= IS_TARGET
+        if rule.is_phony:
+            self.node_flags[t] |= IS_PHONY
+        self.node_cmds[t] = rule.cmds
+        for (prereqs, order_only) in ((rule.prereqs, 0),
+                                      (rule.order_only, 1)):
+            for p in prereqs:
+                self.edge_src.append(t)
+                self.edge_dst.append(self.intern(p))
+                self.edge_rule.append(seq)
+                self.edge_order_only.append(order_only)
+
+    def to_part(self):
+        '''Returns the rules added so far, as a string, for
+           add_part(). Commands kept in the database are given as their
+           offsets.'''
+        cmds = [(c.start, c.end) if isinstance(c, makedb.LazyCmds) else c
+                for c in self.node_cmds]
+        return marshal.dumps((self.names, self.edge_src.tostring(),
+                              self.edge_dst.tostring(),
+                              self.edge_rule.tostring(),
+                              str(self.edge_order_only),
+                              self.last_rule.tostring(),
+                              str(self.node_flags), cmds, self.rule_count))
+
+    def add_part(self, part, cmd_source=None):
+        '''Adds the rules of a part returned by to_part(), as if they
+           were added by add_rule() after the ones already added. See
+           makedb.parse_rules() for cmd_source.'''
+        assert not self.finished
+        (names, src, dst, rule, order_only, last_rule, flags, cmds,
+         rule_count) = marshal.loads(part)
+        # The ids of the part are the positions of its names
+        ids = array.array('i', [self.intern(name) for name in names])
+        seq = self.rule_count
+        self.rule_count += rule_count
+        self.edge_src.extend([ids[i] for i in array.array('i', src)])
+        self.edge_dst.extend([ids[i] for i in array.array('i', dst)])
+        self.edge_rule.extend([r + seq for r in array.array('i', rule)])
+        self.edge_order_only.extend(order_only)
+        for (i, last) in enumerate(array.array('i', last_rule)):
+            if last < 0:
+                continue
+            t = ids[i]
+            self.last_rule[t] = last + seq
+            self.node_flags[t] |= ord(flags[i])
+            c = cmds[i]
+            if isinstance(c, tuple):
+                c = makedb.LazyCmds(cmd_source, c[0], c[1])
+            self.node_cmds[t] = c
+
+    def finish(self):
+        '''Sorts the nodes by name and builds the CSR arrays'''
+        n = len(self.names)
+        order = sorted(xrange(n), key=self.names.__getitem__)
+        new_id = array.array('i', [0]) * n
+        for (i, old) in enumerate(order):
+            new_id[old] = i
+        self.names = [self.names[old] for old in order]
+        self.ids = dict((name, i) for (i, name) in enumerate(self.names))
+        self.node_flags = bytearray(self.node_flags[old] for old in order)
+        self.node_cmds = [self.node_cmds[old] for old in order]
+        last_rule = self.last_rule
+        src = self.edge_src
+        dst = self.edge_dst
+
+        # Forward edges: only those of the last rule of each target.
+        # A stable counting sort on the source keeps the normal
+        # prerequisites ahead of the order-only ones.
+        fwd_cnt = array.array('i', [0]) * n
+        fwd_off = array.array('l', [0]) * (n + 1)
+        keep = [e for e in xrange(len(src))
+                if self.edge_rule[e] == last_rule[src[e]]]
+        for e in keep:
+            s = new_id[src[e]]
+            fwd_off[s + 1] += 1
+            if not self.edge_order_only[e]:
+                fwd_cnt[s] += 1
+        for i in xrange(n):
+            fwd_off[i + 1] += fwd_off[i]
+        fwd = array.array('i', [0]) * len(keep)
+        pos = array.array('l', fwd_off[:n])
+        for e in keep:
+            s = new_id[src[e]]
+            fwd[pos[s]] = new_id[dst[e]]
+            pos[s] += 1
+
+        # Reverse edges: all of them, in database order
+        rev_off = array.array('l', [0]) * (n + 1)
+        for d in dst:
+            rev_off[new_id[d] + 1] += 1
+        for i in xrange(n):
+            rev_off[i + 1] += rev_off[i]
+        rev = array.array('i', [0]) * len(dst)
+        pos = array.array('l', rev_off[:n])
+        for e in xrange(len(dst)):
+            d = new_id[dst[e]]
+            rev[pos[d]] = new_id[src[e]]
+            pos[d] += 1
+
+        self.fwd_cnt = fwd_cnt
+        self.fwd_off = fwd_off
+        self.fwd = fwd
+        self.rev_off = rev_off
+        self.rev = rev
+        self.n = n
+        # The edge list is not needed any more
+        del self.edge_src, self.edge_dst, self.edge_rule
+        del self.edge_order_only, self.last_rule
+        self.finished = True
+
+    def name(self, i):
+        return self.names[i]
+
+    def names_of(self, ids):
+        return [self.names[i] for i in ids]
+
+    def lookup(self, name):
+        '''Returns the id of a node name, or -1 if it is unknown'''
+        return self.ids.get(name, -1)
+
+    def flags(self, i):
+        return self.node_flags[i]
+
+    def prerequisites(self, i):
+        '''Returns (normal, order-only) prerequisite ids of node i'''
+        start = self.fwd_off[i]
+        split = start + self.fwd_cnt[i]
+        return (self.fwd[start:split].tolist(),
+                self.fwd[split:self.fwd_off[i + 1]].tolist())
+
+    def parents(self, i):
+        return self.rev[self.rev_off[i]:self.rev_off[i + 1]].tolist()
+
+    def is_order_only(self, t, p):
+        '''Returns True if p is an order-only prerequisite of node t'''
+        start = self.fwd_off[t] + self.fwd_cnt[t]
+        end = self.fwd_off[t + 1]
+        # Most targets have no order-only prerequisites
+        return start < end and p in self.fwd[start:end]
+
+    def cmds(self, i):
+        return self.node_cmds[i] or []
+
+    def read_cmds(self, i):
+        '''Returns the commands of node i, without keeping them decoded
+           when they are still in the database (see makedb.LazyCmds)'''
+        cmds = self.node_cmds[i]
+        if isinstance(cmds, makedb.LazyCmds):
+            return cmds.decode(cache=False)
+        return cmds or []
+
+
+def build(rules):
+    '''Returns a finished GraphStore holding rules'''
+    store = GraphStore()
+    for r in rules:
+        store.add_rule(r)
+    store.finish()
+    return store
+
+
+def load(fi, cmd_source=None):
+    '''Returns a finished GraphStore for the database in fi.
+       See makedb.parse_rules() for cmd_source.'''
+    return build(makedb.parse_rules(fi, cmd_source))
+
+
+def from_dicts(all_targets, all_children, phony=()):
+    '''Returns a finished GraphStore holding the graph in the
+       all_targets and all_children dictionaries'''
+    store = GraphStore()
+    store.names = sorted(set(all_targets).union(all_children))
+    store.ids = dict((name, i) for (i, name) in enumerate(store.names))
+    n = len(store.names)
+    ids = store.ids
+    store.node_flags = bytearray(n)
+    store.node_cmds = [None] * n
+    store.fwd_cnt = array.array('i', [0]) * n
+    store.fwd_off = array.array('l', [0]) * (n + 1)
+    store.fwd = array.array('i')
+    store.rev_off = array.array('l', [0]) * (n + 1)
+    store.rev = array.array('i')
+    for (i, name) in enumerate(store.names):
+        rule = all_targets.get(name)
+        if rule is not None:
+            (order, order_only, cmds) = rule
+            store.node_flags[i] = IS_TARGET
+            if name in phony:
+                store.node_flags[i] |= IS_PHONY
+            store.node_cmds[i] = cmds
+            store.fwd.extend([ids[p] for p in order])
+            store.fwd.extend([ids[p] for p in order_only])
+            store.fwd_cnt[i] = len(order)
+        store.fwd_off[i + 1] = len(store.fwd)
+        store.rev.extend([ids[p] for p in all_children.get(name, ())])
+        store.rev_off[i + 1] = len(store.rev)
+    store.n = n
+    del store.edge_src, store.edge_dst, store.edge_rule
+    del store.edge_order_only, store.last_rule
+    store.finished = True
+    return store
+
+
+def convert_range(job):
+    '''Worker function for load_parallel(), see makedb.map_chunks().
+       Returns the rules of a part of a database file, see
+       GraphStore.to_part().'''
+    (path, start, end, lazy_cmds) = job
+    store = GraphStore()
+    for r in makedb.parse_range(path, start, end, lazy_cmds):
+        store.add_rule(r)
+    return store.to_part()
+
+
+def load_parallel(path, jobs=None, cmd_source=None):
+    '''Returns a finished GraphStore for the database file at path,
+       parsed by a pool of processes. Each process adds the rules of
+       its chunks to a GraphStore of its own, and returns its arrays.
+       They are appended in file order, so the result is identical to
+       the one of load().'''
+    store = GraphStore()
+    for (chunk, part) in makedb.map_chunks(path, jobs, convert_range,
+                                           cmd_source is not None):
+        store.add_part(part, cmd_source)
+    store.finish()
+    return store
+
+
+class TargetView:
+    '''Read-only replacement for the all_targets dictionary'''
+    def __init__(self, store):
+        self.store = store
+
+    def _id(self, name):
+        i = self.store.lookup(name)
+        if i < 0 or not self.store.flags(i) & IS_TARGET:
+            return -1
+        return i
+
+    def __contains__(self, name):
+        return self._id(name) >= 0
+
+    def __getitem__(self, name):
+        i = self._id(name)
+        if i < 0:
+            raise KeyError(name)
+        (order, order_only) = self.store.prerequisites(i)
+        return (self.store.names_of(order), self.store.names_of(order_only),
+                self.store.cmds(i))
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def __iter__(self):
+        for i in xrange(self.store.n):
+            if self.store.flags(i) & IS_TARGET:
+                yield self.store.name(i)
+
+
+class NameList:
+    '''The names of a list of node ids, as a read-only list. A name is
+       only looked up when it is used, so that showing a node with
+       thousands of parents does not look up all their names.'''
+    def __init__(self, store, ids):
+        self.store = store
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.store.names_of(self.ids[i])
+        return self.store.name(self.ids[i])
+
+    def __iter__(self):
+        for i in self.ids:
+            yield self.store.name(i)
+
+
+class ChildView:
+    '''Read-only replacement for the all_children dictionary'''
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, name):
+        i = self.store.lookup(name)
+        return i >= 0 and len(self.store.parents(i)) > 0
+
+    def __getitem__(self, name):
+        i = self.store.lookup(name)
+        parents = self.store.parents(i) if i >= 0 else []
+        if not parents:
+            raise KeyError(name)
+        return NameList(self.store, parents)
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def __iter__(self):
+        for i in xrange(self.store.n):
+            if self.store.parents(i):
+                yield self.store.name(i)
+
+
+def views(store):
+    '''Returns (all_targets, all_children) views of store'''
+    return (TargetView(store), ChildView(store))
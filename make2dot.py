@@ -3,17 +3,27 @@
 '''Converts a GNU make database into a dot graph'''
 
 import argparse
+import os
 import sys
 import re
 import textwrap
 
+import depprofile
+import graphstore
+import makedb
+import reduction
+
+# Size of the output buffer. Large graphs are written in large blocks.
+BUFFER_SIZE = 1024 * 1024
+
+NON_ID_RE = re.compile('[^a-zA-Z0-9_]')
+
 '''Create a legal dot ID'''
 def make_id(s):
-    if re.search('[^a-zA-Z0-9_]',s):
+    if NON_ID_RE.search(s):
         # Need to enclose string in double quotes
         return '"{}"'.format(s)
-    else:
-        return s
+    return s
 
 
 def append_key_value(s, key, value):
@@ -29,10 +39,13 @@ def append_key_value(s, key, value):
 
 '''Defines a comma-separated list of key/value pairs
    specifying DOT node attributes'''
-def create_attr_list(is_phony):
+def create_attr_list(is_phony, label=None, color=None):
     attrs = ''
     if is_phony:
         attrs = append_key_value(attrs, 'style', 'dotted')
+    if label:
+        attrs = append_key_value(attrs, 'label', '"{}"'.format(label))
+    attrs = append_key_value(attrs, 'color', color)
     # Add more attribute definitions here, later
 
     # Close the attribute list
@@ -41,65 +54,117 @@ def create_attr_list(is_phony):
     return attrs
 
 
-'''Format of rule database:
-# Files
-
-[# Not a target]
-target: [prerequisite]*
-[#  A default, MAKEFILES, or -include/sinclude makefile.]
-#  Implicit rule search has [not] been done.
-# File has [not] been updated
-'''
-
-def convert():
-    l = ''
-    # Loop until start of files section (or EOF)
-    while True:
-        l = sys.stdin.readline()
-        if (not l) or (l == '# Files\n'):
-            break;
-
-    if not l:
-        return
-    # Process rules until done
-    while True:
-        # Move forward to the next rule
-        while True:
-            l = sys.stdin.readline()
-            if not l:
-                # EOF
-                break;
-            if l[0] == '#':
-                continue
-            if ':' in l:
-                break
-        if not l:
-            # EOF
-            break;
-        # Process this rule
-        (target, sep, prerequisites) = l.strip().partition(':')
-        t = make_id(target)
-        # We do not want .PHONY to show up as a node in the graph
-        if target != '.PHONY':
-            if prerequisites:
-                (order, sep2, order_only) = prerequisites.partition('|')
-                for p in order.split():
-                    # There may be a stray colon here from a double-colon rule
-                    if p != ':':
-                        print '{} -> {};'.format(t, make_id(p))
-                for p in order_only.split():
-                    print t, '->', make_id(p), '[style=dotted];'
-        # Read the comments below the rule, and use its info
-        # to color the node
-        is_phony = False;
-        while True:
-            l = sys.stdin.readline()
-            if l[0] != '#' and l[0] != '\t':
-                break;
-            if l.startswith('#  Phony target'):
-                is_phony = True;
-        attrs = create_attr_list(is_phony)
-        print '{} {};'.format(t, attrs)
+class DotWriter:
+    '''Writes the statements of a dot graph to out. In compact mode,
+       each node gets a number as its ID, and is declared once with
+       its name as label, so that long names are not repeated on every
+       edge.'''
+    def __init__(self, out, compact=False):
+        self.out = out
+        self.compact = compact
+        self.ids = {}
+
+    def declare(self, name, attrs=None):
+        '''Returns the new compact ID of name, after declaring it with
+           the attribute list attrs, by default one with its name as
+           label'''
+        result = str(len(self.ids))
+        self.ids[name] = result
+        self.out.write('{} {};\n'.format(
+            result, attrs or create_attr_list(False, name)))
+        return result
+
+    def node_id(self, name):
+        result = self.ids.get(name)
+        if result is None:
+            if self.compact:
+                result = self.declare(name)
+            else:
+                result = self.ids[name] = make_id(name)
+        return result
+
+    def edge(self, target, prerequisite, attrs=''):
+        self.out.write('{} -> {}{};\n'.format(
+            self.node_id(target), self.node_id(prerequisite), attrs))
+
+    def node(self, name, is_phony, label=None, color=None):
+        '''Writes the attributes of a node. In compact mode, the label
+           defaults to the name, and is only written when the node is
+           declared or given another one.'''
+        if not self.compact:
+            attrs = create_attr_list(is_phony, label, color)
+            self.out.write('{} {};\n'.format(self.node_id(name), attrs))
+        elif name not in self.ids:
+            self.declare(name, create_attr_list(is_phony, label or name,
+                                                color))
+        else:
+            attrs = create_attr_list(is_phony, label, color)
+            if attrs:
+                self.out.write('{} {};\n'.format(self.ids[name], attrs))
+
+
+'''With reduce, the edges implied by other paths are left out,
+   see reduction.py'''
+def convert(fi, reduce=False, out=None):
+    out = out or DotWriter(sys.stdout)
+    rules = makedb.parse_rules(fi)
+    redundant = ()
+    if reduce:
+        rules = list(rules)
+        redundant = reduction.redundant_edges(
+            (r.target, p) for r in rules for p in r.prereqs + r.order_only)
+    for r in rules:
+        for p in r.prereqs:
+            if (r.target, p) not in redundant:
+                out.edge(r.target, p)
+        for p in r.order_only:
+            if (r.target, p) not in redundant:
+                out.edge(r.target, p, ' [style=dotted]')
+        out.node(r.target, r.is_phony)
+
+
+'''Like convert(), but labels each node with its build time and its
+   slack, and colours the critical path red. With max_slack, only the
+   nodes with at most that much slack are printed.'''
+def convert_timed(fi, times, max_slack=None, reduce=False, out=None):
+    out = out or DotWriter(sys.stdout)
+    store = graphstore.build(makedb.parse_rules(fi))
+    (durations, unknown) = depprofile.durations_of(store, times)
+    if unknown:
+        sys.stderr.write('{} timed targets are not in the graph\n'.format(
+            len(unknown)))
+    cp = depprofile.CriticalPath(store, xrange(store.n), durations)
+    shown = [i for i in xrange(store.n)
+             if max_slack is None or cp.slack(i) <= max_slack]
+    is_shown = set(shown)
+    redundant = ()
+    if reduce:
+        redundant = reduction.redundant_edges(
+            (i, p) for i in shown for p in sum(store.prerequisites(i), [])
+            if p in is_shown)
+    # The nodes come first, so that in compact mode they are declared
+    # with their label
+    for i in shown:
+        label = None
+        if i in durations:
+            label = '{}\\n{:.1f} s, slack {:.1f} s'.format(
+                store.name(i), durations[i], cp.slack(i))
+        out.node(store.name(i), store.flags(i) & graphstore.IS_PHONY, label,
+                 'red' if cp.is_critical(i) else None)
+    for i in shown:
+        t = store.name(i)
+        (order, order_only) = store.prerequisites(i)
+        order = [p for p in order if (i, p) not in redundant]
+        order_only = [p for p in order_only if (i, p) not in redundant]
+        for p in order:
+            if p in is_shown:
+                if cp.is_critical(i) and cp.is_critical(p):
+                    out.edge(t, store.name(p), ' [color=red]')
+                else:
+                    out.edge(t, store.name(p))
+        for p in order_only:
+            if p in is_shown:
+                out.edge(t, store.name(p), ' [style=dotted]')
 
 
 def main():
@@ -108,14 +173,59 @@ def main():
         description=textwrap.dedent('''\
            Converts stdin data created by "make -qpR" into dot data on stdout.
                Example: make -qpR | make2dot > db.dot
+           or, without the pipe: make2dot -m "" > db.dot
            The .PHONY node is not present in the output.
            .PHONY nodes are marked with the attribute [style=dotted]
-           Edges for order-only dependencies are marked with [style=dotted]'''))
+           Edges for order-only dependencies are marked with [style=dotted]
+           With -t, the build time of each target is read from a CSV
+           file (target,start,end or target,duration in seconds), see
+           depprofile.py. Nodes are labelled with their build time and
+           slack, and the critical path is coloured red.
+           With -r, the transitive reduction of the graph is printed:
+           an edge from a to c is left out when c is also reached
+           from a through another prerequisite, e.g. from a module to
+           its intermediate file which its installed file depends on.
+           Edges closing a dependency cycle are kept.
+           With -c, each node is declared once with a number as ID and
+           its name as label, and the edges use the numbers. The file
+           is several times smaller, and faster for dot to read, but
+           showdep.py needs the node names as IDs.'''))
+    parser.add_argument('-m', '--make', action='store', metavar='ARGS',
+                        help='run "make -qpR ARGS" and convert its output '
+                             'instead of stdin')
+    parser.add_argument('-s', '--save', action='store',
+                        help='with -m, also save the make database in this '
+                             'file. A name ending with .gz compresses it.')
+    parser.add_argument('-t', '--times', action='store', metavar='CSV',
+                        help='annotate the graph with the build times in '
+                             'this file')
+    parser.add_argument('--max-slack', type=float, metavar='SECONDS',
+                        help='with -t, only print the nodes with at most '
+                             'this much slack (0: the critical path)')
+    parser.add_argument('-r', '--reduce', action='store_true',
+                        help='leave out the edges implied by other paths')
+    parser.add_argument('-c', '--compact', action='store_true',
+                        help='use numbers as node IDs, and the names as '
+                             'labels')
     global args
     args = parser.parse_args()
-    print 'digraph make {'
-    convert()
-    print '}'
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', BUFFER_SIZE)
+    writer = DotWriter(out, args.compact)
+    if args.times:
+        with open(args.times, 'rb') as fi:
+            times = depprofile.read_times(fi)
+        run = lambda fi: convert_timed(fi, times, args.max_slack,
+                                       args.reduce, writer)
+    else:
+        run = lambda fi: convert(fi, args.reduce, writer)
+    out.write('digraph make {\n')
+    if args.make is not None:
+        with makedb.MakeReader(args.make, args.save) as fi:
+            run(fi)
+    else:
+        run(sys.stdin)
+    out.write('}\n')
+    out.close()
 
 if __name__ == "__main__":
     main()
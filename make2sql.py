@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+'''Exports the graph of a GNU make database into an SQLite database,
+   for ad-hoc analysis with SQL.
+
+   The graph is read from the index of the database (make.db.idx) when
+   it is up to date, so that exporting takes less time than parsing.
+   The rows are inserted in batches with executemany(), one transaction
+   per table, and the indexes are created once the tables are filled,
+   which is much faster than updating them row by row.'''
+
+import argparse
+import itertools
+import os
+import sqlite3
+import sys
+import textwrap
+import time
+
+import graphcache
+import graphstore
+import makevars
+
+# The number of rows given to each executemany()
+BATCH_SIZE = 10000
+
+SCHEMA = '''
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    is_target INTEGER NOT NULL,
+    is_phony INTEGER NOT NULL
+);
+-- target depends on prerequisite. pos is the position of prerequisite
+-- in the rule, counting the normal prerequisites first.
+CREATE TABLE edges (
+    target INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    prerequisite INTEGER NOT NULL,
+    order_only INTEGER NOT NULL,
+    PRIMARY KEY (target, pos)
+) WITHOUT ROWID;
+CREATE TABLE cmds (
+    target INTEGER NOT NULL,
+    line INTEGER NOT NULL,
+    cmd TEXT NOT NULL,
+    PRIMARY KEY (target, line)
+) WITHOUT ROWID;
+-- The global variables have no pattern
+CREATE TABLE variables (
+    name TEXT NOT NULL,
+    flavor TEXT NOT NULL,
+    value TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    file TEXT,
+    line INTEGER,
+    pattern TEXT
+);
+'''
+
+# The edges and commands are found by target through their primary
+# keys, which are filled in order, as the rows are inserted sorted.
+INDEXES = '''
+CREATE UNIQUE INDEX nodes_name ON nodes (name);
+CREATE INDEX edges_prerequisite ON edges (prerequisite, target);
+CREATE INDEX variables_name ON variables (name);
+'''
+
+# The nodes reached from the node named ?1, going from target to
+# prerequisite (down) or back (up). Each node is walked once, so cycles
+# end the walk.
+SUBTREE_SQL = '''
+WITH RECURSIVE walk(id) AS (
+    SELECT id FROM nodes WHERE name = ?1
+    UNION
+    SELECT e.{to} FROM walk JOIN edges e ON e.{start} = walk.id
+)
+SELECT name FROM walk JOIN nodes USING (id) ORDER BY name
+'''
+
+# The same, up to ?2 edges away. A node is walked once for each number
+# of edges it is reached through, which the limit keeps finite.
+SUBTREE_DEPTH_SQL = '''
+WITH RECURSIVE walk(id, depth) AS (
+    SELECT id, 0 FROM nodes WHERE name = ?1
+    UNION
+    SELECT e.{to}, walk.depth + 1 FROM walk JOIN edges e
+    ON e.{start} = walk.id WHERE walk.depth < ?2
+)
+SELECT name FROM walk JOIN nodes USING (id) GROUP BY id ORDER BY name
+'''
+
+
+def batches(rows, size=BATCH_SIZE):
+    '''Yields the rows as lists of at most size rows'''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert(conn, table, columns, rows):
+    '''Inserts the rows into table in one transaction.
+       Returns the number of rows.'''
+    sql = 'INSERT INTO {} VALUES ({})'.format(
+        table, ', '.join('?' * columns))
+    count = 0
+    with conn:
+        for batch in batches(rows):
+            conn.executemany(sql, batch)
+            count += len(batch)
+    return count
+
+
+def node_rows(store):
+    for i in xrange(store.n):
+        flags = store.flags(i)
+        yield (i, store.name(i), flags & graphstore.IS_TARGET and 1,
+               flags & graphstore.IS_PHONY and 1)
+
+
+def edge_rows(store):
+    (fwd_off, fwd_cnt, fwd) = (store.fwd_off, store.fwd_cnt, store.fwd)
+    for i in xrange(store.n):
+        start = fwd_off[i]
+        count = fwd_off[i + 1] - start
+        if count:
+            normal = fwd_cnt[i]
+            for row in itertools.izip(itertools.repeat(i), xrange(count),
+                                      fwd[start:start + count],
+                                      [0] * normal + [1] * (count - normal)):
+                yield row
+
+
+def cmd_rows(store):
+    '''Yields the command rows of a graphstore.GraphStore or
+       graphcache.GraphIndex'''
+    if isinstance(store, graphcache.GraphIndex):
+        cmd_lists = store.cmd_lists()
+    else:
+        cmd_lists = ((i, store.read_cmds(i)) for i in xrange(store.n)
+                     if store.flags(i) & graphstore.IS_TARGET)
+    for (i, cmds) in cmd_lists:
+        for (line, cmd) in enumerate(cmds):
+            yield (i, line, cmd)
+
+
+def variable_rows(index):
+    for name in sorted(index):
+        for v in index[name]:
+            yield tuple(v)
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    # Names and commands are returned as they are in the database,
+    # without decoding them
+    conn.text_factory = str
+    return conn
+
+
+def export(store, variables, path, log=None):
+    '''Writes the graph of store, a graphstore.GraphStore or
+       graphcache.GraphIndex, and the variable index variables (see
+       makevars.py), into a new SQLite database at path. log, if
+       given, is called with the name of each table and its number of
+       rows.'''
+    graph = store
+    if isinstance(store, graphcache.GraphIndex):
+        graph = store.to_store()
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = connect(tmp_path)
+    # The file is renamed only when it is complete, so nothing needs
+    # to survive a crash
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.executescript(SCHEMA)
+    for (table, columns, rows) in [
+            ('nodes', 4, node_rows(graph)),
+            ('edges', 4, edge_rows(graph)),
+            ('cmds', 3, cmd_rows(store)),
+            ('variables', 7, variable_rows(variables))]:
+        count = insert(conn, table, columns, rows)
+        if log:
+            log(table, count)
+    conn.executescript(INDEXES)
+    conn.execute('ANALYZE')
+    conn.close()
+    os.rename(tmp_path, path)
+
+
+def subtree(conn, name, up=False, depth=0):
+    '''Returns the sorted names of the nodes reached from the node
+       name, including itself, going to the prerequisites, or to the
+       parents if up is True, at most depth edges away (0 = any)'''
+    (start, to) = ('prerequisite', 'target') if up else \
+        ('target', 'prerequisite')
+    sql = SUBTREE_DEPTH_SQL if depth else SUBTREE_SQL
+    params = (name, depth) if depth else (name,)
+    return [row[0] for row in
+            conn.execute(sql.format(start=start, to=to), params)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Exports a database created by "make -qpR" into the SQLite
+           database OUT, replacing it:
+             make2sql.py -f make.db make.sqlite
+           OUT has the tables
+             nodes(id, name, is_target, is_phony)
+             edges(target, pos, prerequisite, order_only)
+             cmds(target, line, cmd)
+             variables(name, flavor, value, origin, file, line, pattern)
+           where target and prerequisite are node ids. The edges are
+           indexed in both directions. For example,
+             sqlite3 make.sqlite "SELECT name FROM nodes JOIN edges
+               ON id = target GROUP BY id ORDER BY COUNT(*) DESC
+               LIMIT 10"
+           prints the targets with the most prerequisites.
+           Without -f, OUT is queried: --subtree NODE prints NODE and
+           the nodes it depends on (with -r, the nodes depending on
+           it), using a recursive query.'''))
+    parser.add_argument('out', metavar='OUT',
+                        help='SQLite database to write or query')
+    parser.add_argument('-f', '--file', action='store',
+                        help='make database to export')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write make.db.idx and '
+                             'make.db.vars')
+    parser.add_argument('--subtree', action='store', metavar='NODE',
+                        help='print the nodes reached from NODE')
+    parser.add_argument('-r', '--reverse', action='store_true',
+                        help='with --subtree, go to the parents')
+    parser.add_argument('-d', '--depth', type=int, default=0,
+                        help='with --subtree, maximum number of edges '
+                             '(0 = any)')
+    args = parser.parse_args()
+    if bool(args.file) == bool(args.subtree):
+        parser.error('give either -f or --subtree')
+
+    if args.file:
+        start = time.time()
+        store = graphcache.load_store(args.file, not args.no_cache,
+                                      args.jobs or None)
+        variables = makevars.load_index(args.file, not args.no_cache)
+        def log(table, count):
+            print >> sys.stderr, '{:10} {:9} rows'.format(table, count)
+        export(store, variables, args.out, log)
+        print >> sys.stderr, 'Exported in {:.1f} s'.format(
+            time.time() - start)
+        return
+
+    if not os.path.exists(args.out):
+        sys.exit('Error: {} does not exist'.format(args.out))
+    conn = connect(args.out)
+    names = subtree(conn, args.subtree, args.reverse, args.depth)
+    if not names:
+        sys.exit('Error: no node {}'.format(args.subtree))
+    for name in names:
+        print name
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+'''Shared parser for the GNU make database created by "make -qpR".
+
+   The database is read in large blocks, and the rules of the
+   "# Files" section are yielded one at a time, as a stream.
+   All the tools in this directory use this module instead of
+   carrying their own copy of the parser.'''
+
+import os
+import re
+import mmap
+import marshal
+import gc
+import logging
+import collections
+import multiprocessing
+import subprocess
+import shlex
+import gzip
+import sys
+
+
+'''Format of rule database:
+# Files
+
+[# Not a target]
+target: [prerequisite]*
+[#  A default, MAKEFILES, or -include/sinclude makefile.]
+#  Implicit rule search has [not] been done.
+# File has [not] been updated
+[	command]*
+'''
+
+FILES_HEADER = '# Files\n'
+
+# Number of bytes to read from the database at a time
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# A rule is a line which does not start with '#' and contains a colon.
+# It is followed by comments and commands, i.e. lines starting with '#'
+# or TAB. The first line after those (normally an empty line) ends
+# the rule, and is never itself considered as a rule line.
+RULE_RE = re.compile(r'^(?!#)([^\n]*:[^\n]*)(?:\n|\Z)'
+                     r'((?:[#\t][^\n]*\n)*)'
+                     r'[^\n]*(?:\n|\Z)', re.M)
+
+PHONY_MARK = '#  Phony target'
+
+Rule = collections.namedtuple('Rule', ['target', 'prereqs', 'order_only',
+                                       'cmds', 'is_phony'])
+
+
+def get_cmds(body):
+    '''Returns the non-empty commands from the body of a rule'''
+    cmds = []
+    for l in body.split('\n'):
+        if l[:1] == '\t':
+            l = l.strip()
+            if l:
+                cmds.append(l)
+    return cmds
+
+
+class DatabaseChanged(IOError):
+    '''Raised when the commands of a database are read after the file
+       was rewritten'''
+    pass
+
+
+class CmdSource(object):
+    '''A read-only mmap of a database file, which LazyCmds read their
+       commands from. The size and modification time of the file are
+       checked before each read: a file rewritten in place, e.g. by
+       "make -qpR > make.db", raises DatabaseChanged, instead of a
+       crash on a truncated mapping or the text of another rule. A
+       file replaced by renaming a new one over it is still read from
+       the old one.'''
+    def __init__(self, path):
+        self.path = path
+        self.fi = open(path, 'rb')
+        self.mm = mmap.mmap(self.fi.fileno(), 0, access=mmap.ACCESS_READ)
+        self.state = self.file_state()
+
+    def file_state(self):
+        st = os.fstat(self.fi.fileno())
+        return (st.st_size, st.st_mtime)
+
+    def read(self, start, end):
+        if self.file_state() != self.state:
+            raise DatabaseChanged(
+                '{} has changed since it was read'.format(self.path))
+        return self.mm[start:end]
+
+
+class LazyCmds(object):
+    '''The commands of a rule, kept as the position of the rule body
+       in a CmdSource. The commands are only decoded when they are
+       first used, and behave like a read-only list.'''
+    __slots__ = ('source', 'start', 'end', 'cmds')
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.cmds = None
+
+    def decode(self, cache=True):
+        '''Returns the commands as a list. With cache=False, the list
+           is not kept, for code reading the commands of every rule.'''
+        if self.cmds is not None:
+            return self.cmds
+        cmds = get_cmds(self.source.read(self.start, self.end))
+        if cache:
+            self.cmds = cmds
+        return cmds
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __getitem__(self, i):
+        return self.decode()[i]
+
+    def __eq__(self, other):
+        return self.decode() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.decode())
+
+
+def open_cmd_source(path):
+    '''Returns a CmdSource of the database file at path, to be used
+       for LazyCmds, or None if the file is compressed'''
+    if path.endswith('.gz'):
+        return None
+    return CmdSource(path)
+
+
+def is_phony_body(body):
+    return body.startswith(PHONY_MARK) or ('\n' + PHONY_MARK) in body
+
+
+def parse_rule(line, body, cmds=None):
+    '''Creates a Rule from a rule line and the comment/command lines
+       below it. The commands are taken from the body unless cmds is
+       given. Returns None for the .PHONY rule, which we do not
+       want to show up as a node in any graph.'''
+    (target, sep, prerequisites) = line.strip().partition(':')
+    if target == '.PHONY':
+        return None
+    if prerequisites[:1] == ':':
+        # Skip the second colon of a double-colon rule
+        prerequisites = prerequisites[1:]
+    (order, sep2, order_only) = prerequisites.partition('|')
+    if cmds is None:
+        cmds = get_cmds(body) if '\t' in body else []
+    return Rule(target, order.split(), order_only.split(),
+                cmds, is_phony_body(body))
+
+
+def parse_block(data, cmd_source=None, offset=0):
+    '''Yields the rules in a string holding a part of the files section.
+       The string must start at the beginning of a line, and must not
+       start in the middle of a rule.
+       If cmd_source is given, data is found at offset in it, and the
+       commands of the rules are returned as LazyCmds.'''
+    # This is parse_rule(), inlined: the loop runs once per rule, and
+    # the function calls took a third of the parsing time. The Rule is
+    # created the way its own __new__ does it, without another call.
+    new_tuple = tuple.__new__
+    for m in RULE_RE.finditer(data):
+        (line, body) = m.groups()
+        (target, sep, prerequisites) = line.strip().partition(':')
+        if target == '.PHONY':
+            continue
+        if prerequisites[:1] == ':':
+            # Skip the second colon of a double-colon rule
+            prerequisites = prerequisites[1:]
+        (order, sep, order_only) = prerequisites.partition('|')
+        if '\t' not in body:
+            cmds = []
+        elif cmd_source is not None:
+            cmds = LazyCmds(cmd_source, offset + m.start(2),
+                            offset + m.end(2))
+        else:
+            cmds = get_cmds(body)
+        # Most rules are not phony, which one search tells
+        is_phony = PHONY_MARK in body and is_phony_body(body)
+        yield new_tuple(Rule, (target, order.split(), order_only.split(),
+                               cmds, is_phony))
+
+
+def find_files_section(fi):
+    '''Reads fi until the start of the files section.
+       Returns the data following the section header, or None
+       if there is no files section.'''
+    tail = ''
+    while True:
+        block = fi.read(BLOCK_SIZE)
+        if not block:
+            return None
+        data = tail + block
+        if data.startswith(FILES_HEADER):
+            return data[len(FILES_HEADER):]
+        pos = data.find('\n' + FILES_HEADER)
+        if pos >= 0:
+            return data[pos + 1 + len(FILES_HEADER):]
+        # Keep the last line, it may be a partial header
+        tail = data[data.rfind('\n') + 1:]
+
+
+def read_blocks(fi, data, offset):
+    '''Yields (offset, block) for blocks of the files section, each one
+       ending on a rule boundary (an empty line), except possibly the
+       last one. data is what has already been read from fi, starting
+       at offset in the database.'''
+    while True:
+        block = fi.read(BLOCK_SIZE)
+        if not block:
+            break
+        data += block
+        cut = data.rfind('\n\n')
+        if cut < 0:
+            # No complete rule yet, read some more
+            continue
+        yield (offset, data[:cut + 2])
+        offset += cut + 2
+        data = data[cut + 2:]
+    if data:
+        yield (offset, data)
+
+
+def parse_rules(fi, cmd_source=None):
+    '''Yields all rules in the make database read from fi.
+       If cmd_source is an mmap of the same database (see
+       open_cmd_source()), the commands are returned as LazyCmds.'''
+    logging.debug('Starting to parse')
+    fi = CountingReader(fi)
+    data = find_files_section(fi)
+    if data is None:
+        return
+    for (offset, block) in read_blocks(fi, data, fi.count - len(data)):
+        for rule in parse_block(block, cmd_source, offset):
+            yield rule
+    logging.debug('Done parsing')
+
+
+def open_db(path):
+    '''Opens a make database, which may be compressed with gzip'''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'r')
+
+
+class TeeReader:
+    '''A file-like object which reads from fi, and writes a copy of
+       all data read to fo'''
+    def __init__(self, fi, fo):
+        self.fi = fi
+        self.fo = fo
+
+    def read(self, size=-1):
+        data = self.fi.read(size)
+        if data:
+            self.fo.write(data)
+        return data
+
+
+class CountingReader:
+    '''A file-like object which counts the bytes read from fi'''
+    def __init__(self, fi):
+        self.fi = fi
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fi.read(size)
+        self.count += len(data)
+        return data
+
+
+class MakeReader:
+    '''Runs "make -qpR" and gives access to the database it prints,
+       while it is being printed. If save_path is given, the database
+       is also saved there, compressed with gzip if the name ends
+       with .gz. Use as:
+           with MakeReader(['-C', 'src']) as fi:
+               for rule in parse_rules(fi): ...'''
+    def __init__(self, make_args, save_path=None):
+        if isinstance(make_args, basestring):
+            make_args = shlex.split(make_args)
+        self.cmd = ['make', '-qpR'] + list(make_args)
+        self.save_path = save_path
+
+    def __enter__(self):
+        logging.debug('Running %s', ' '.join(self.cmd))
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                     bufsize=BLOCK_SIZE)
+        self.save = None
+        if self.save_path:
+            if self.save_path.endswith('.gz'):
+                # Favour speed, the dump compresses well anyway
+                self.save = gzip.open(self.save_path, 'wb', 1)
+            else:
+                self.save = open(self.save_path, 'w')
+            return TeeReader(self.proc.stdout, self.save)
+        return self.proc.stdout
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Let make finish even if we stopped reading early
+        while self.proc.stdout.read(BLOCK_SIZE):
+            pass
+        status = self.proc.wait()
+        if self.save:
+            self.save.close()
+        # make -q exits with 1 when something needs to be remade
+        if status > 1:
+            sys.stderr.write('Warning: {} exited with status {}\n'.format(
+                ' '.join(self.cmd), status))
+        return False
+
+
+def add_to_child_list(all_children, children, target):
+    for c in children:
+        if c in all_children:
+            # Child already has a parent. Append to existing list
+            all_children[c].append(target)
+        else:
+            # First parent. Create a list
+            all_children[c] = [target]
+
+
+def convert(fi, all_targets, all_children, cmd_source=None):
+    '''Parses the make database into two dictionaries:
+       all_targets: lookup from target to
+                    (prerequisites, order-only prerequisites, commands)
+       all_children: lookup from prerequisite to list of targets
+       See parse_rules() for cmd_source.'''
+    for r in parse_rules(fi, cmd_source):
+        add_to_child_list(all_children, r.prereqs, r.target)
+        add_to_child_list(all_children, r.order_only, r.target)
+        all_targets[r.target] = (r.prereqs, r.order_only, r.cmds)
+
+
+def load(fi, cmd_source=None):
+    '''Returns (all_targets, all_children) for the database in fi'''
+    all_targets = {}
+    all_children = {}
+    convert(fi, all_targets, all_children, cmd_source)
+    return (all_targets, all_children)
+
+
+def files_section_offset(data):
+    '''Returns the offset of the first rule line candidate in data
+       (a string or an mmap), or -1 if there is no files section'''
+    if data[:len(FILES_HEADER)] == FILES_HEADER:
+        return len(FILES_HEADER)
+    pos = data.find('\n' + FILES_HEADER)
+    if pos < 0:
+        return -1
+    return pos + 1 + len(FILES_HEADER)
+
+
+def double_colon_rules(path):
+    '''Returns a dictionary from each target of the database file at
+       path which has double-colon rules, to the list of its rules, in
+       database order. Only these targets can have several rules: make
+       merges the rules of any other target.'''
+    with open_db(path) as fi:
+        data = fi.read()
+    result = {}
+    start = files_section_offset(data)
+    if start < 0:
+        return result
+    # Looking for "::" and then at its line is much faster than a
+    # regular expression matching every line
+    pos = data.find('::', start)
+    while pos >= 0:
+        line_start = data.rfind('\n', 0, pos) + 1
+        if (data[line_start] not in '#\t' and
+                ':' not in data[line_start:pos]):
+            m = RULE_RE.match(data, line_start)
+            for r in parse_block(m.group(0)):
+                result.setdefault(r.target, []).append(r)
+        pos = data.find('::', pos + 2)
+    return result
+
+
+def find_chunks(mm, count):
+    '''Splits the files section of the mmap mm into at most count
+       (start, end) ranges, each one starting on a rule boundary'''
+    start = files_section_offset(mm)
+    if start < 0:
+        return []
+    size = len(mm)
+    bounds = [start]
+    for k in range(1, count):
+        pos = start + (size - start) * k // count
+        cut = mm.find('\n\n', max(pos, bounds[-1]))
+        if cut < 0:
+            break
+        if cut + 2 < size:
+            bounds.append(cut + 2)
+    bounds.append(size)
+    return [(bounds[k], bounds[k + 1]) for k in range(len(bounds) - 1)
+            if bounds[k] < bounds[k + 1]]
+
+
+class OffsetSource:
+    '''Stands in for an mmap in worker processes, which only need
+       the offsets of the LazyCmds'''
+    pass
+
+
+def parse_range(path, start, end, lazy_cmds):
+    '''Returns the rules of the part [start, end) of the database file
+       at path, as a list. For worker processes: with lazy_cmds, the
+       commands are LazyCmds holding only their offsets.'''
+    with open(path, 'rb') as fi:
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        data = mm[start:end]
+        mm.close()
+    # The worker only allocates, and exits soon: skip cycle collection
+    gc.disable()
+    return list(parse_block(data, OffsetSource() if lazy_cmds else None,
+                            start))
+
+
+def convert_range(job):
+    '''Worker function for parse_parallel(). Parses the rules in
+       a part of a database file into partial dictionaries. With
+       lazy_cmds, the commands are (start, end) offsets of the rule
+       body instead of lists.'''
+    (path, start, end, lazy_cmds) = job
+    all_targets = {}
+    all_children = {}
+    phony = []
+    for r in parse_range(path, start, end, lazy_cmds):
+        add_to_child_list(all_children, r.prereqs, r.target)
+        add_to_child_list(all_children, r.order_only, r.target)
+        cmds = r.cmds
+        if lazy_cmds:
+            if isinstance(cmds, LazyCmds):
+                cmds = (cmds.start, cmds.end)
+            else:
+                cmds = None
+        all_targets[r.target] = (r.prereqs, r.order_only, cmds)
+        if r.is_phony:
+            phony.append(r.target)
+    # marshal is several times faster than the pickling done by
+    # multiprocessing for these plain containers
+    return marshal.dumps((all_targets, all_children, phony))
+
+
+def map_chunks(path, jobs, worker, lazy_cmds):
+    '''Cuts the files section of the database file at path into
+       chunks on rule boundaries, and runs worker((path, start, end,
+       lazy_cmds)) on each one in a pool of jobs processes (default:
+       one per CPU). Yields ((start, end), result) for each chunk, in
+       file order. Closing the generator early stops the processes.'''
+    jobs = jobs or multiprocessing.cpu_count()
+    with open(path, 'rb') as fi:
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        # A few chunks per process evens out the load
+        chunks = find_chunks(mm, jobs * 4)
+        mm.close()
+    logging.debug('Parsing %d chunks with %d processes', len(chunks), jobs)
+    pool = multiprocessing.Pool(jobs)
+    finished = False
+    try:
+        results = pool.imap(worker, [(path, s, e, lazy_cmds)
+                                     for (s, e) in chunks])
+        for item in zip(chunks, results):
+            yield item
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def parse_parallel(path, jobs=None, cmd_source=None):
+    '''Parses the database file at path using a pool of jobs
+       processes (default: one per CPU), see map_chunks(). Yields
+       (all_targets, all_children, phony, end) for each chunk, in file
+       order, where end is the offset of the end of the chunk. See
+       parse_rules() for cmd_source.'''
+    lazy_cmds = cmd_source is not None
+    for ((start, end), result) in map_chunks(path, jobs, convert_range,
+                                             lazy_cmds):
+        (targets, children, phony) = marshal.loads(result)
+        if lazy_cmds:
+            for (t, (order, order_only, cmds)) in targets.iteritems():
+                if cmds:
+                    cmds = LazyCmds(cmd_source, cmds[0], cmds[1])
+                else:
+                    cmds = []
+                targets[t] = (order, order_only, cmds)
+        yield (targets, children, phony, end)
+
+
+def merge_parts(all_targets, all_children, targets, children):
+    '''Adds the dictionaries of a chunk parsed after the ones
+       already in all_targets and all_children'''
+    all_targets.update(targets)
+    for (c, parents) in children.iteritems():
+        if c in all_children:
+            all_children[c].extend(parents)
+        else:
+            all_children[c] = parents
+
+
+def load_parallel(path, jobs=None, phony=None, cmd_source=None):
+    '''Same as load(), but parses the database file at path using a
+       pool of jobs processes (default: one per CPU), see
+       parse_parallel(). The partial results are merged in file order,
+       so the result is identical to the one of load(). If phony is a
+       set, the phony targets are added to it.'''
+    all_targets = {}
+    all_children = {}
+    for (targets, children, chunk_phony, end) in parse_parallel(
+            path, jobs, cmd_source):
+        merge_parts(all_targets, all_children, targets, children)
+        if phony is not None:
+            phony.update(chunk_phony)
+    return (all_targets, all_children)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+'''Compares the dependency graphs of two make databases'''
+
+import argparse
+import collections
+import multiprocessing
+import sys
+import textwrap
+
+import graphcache
+import graphstore
+import makedb
+
+
+def load_both(old_path, new_path, use_cache=True, jobs=1):
+    '''Returns the graphs of two databases. When neither has an up to
+       date index, the old one is parsed in another process while
+       this one parses the new one, and it is then read back from its
+       index.'''
+    if use_cache and not (graphcache.is_current(old_path) or
+                          graphcache.is_current(new_path)):
+        p = multiprocessing.Process(target=graphcache.build_index,
+                                    args=(old_path, jobs))
+        p.start()
+        new = load(new_path, use_cache, jobs)
+        p.join()
+        return (load(old_path, use_cache, jobs), new)
+    return (load(old_path, use_cache, jobs), load(new_path, use_cache, jobs))
+
+
+def load(db_path, use_cache, jobs):
+    '''Returns the graph of a database, in memory, as all of it is
+       compared'''
+    store = graphcache.load_store(db_path, use_cache, jobs)
+    if isinstance(store, graphcache.GraphIndex):
+        return store.to_store()
+    return store
+
+
+def common_names(old, new):
+    '''Yields (name, old id, new id) for the names of both graphs, in
+       sorted order. The id is -1 in the graph without the name.'''
+    (i, j) = (0, 0)
+    while i < old.n or j < new.n:
+        a = old.name(i) if i < old.n else None
+        b = new.name(j) if j < new.n else None
+        if b is None or (a is not None and a < b):
+            yield (a, i, -1)
+            i += 1
+        elif a is None or b < a:
+            yield (b, -1, j)
+            j += 1
+        else:
+            yield (a, i, j)
+            i += 1
+            j += 1
+
+
+class Rule:
+    '''The parts of the rules of a target which are compared. The
+       graph only holds the last rule of each target, so the rules of
+       a target with double-colon rules are given as a list of
+       makedb.Rule.'''
+    def __init__(self, store, i, rules=None):
+        self.exists = i >= 0 and bool(store.flags(i) & graphstore.IS_TARGET)
+        if not self.exists:
+            (self.order, self.order_only, self.phony) = ((), (), False)
+            return
+        self.phony = bool(store.flags(i) & graphstore.IS_PHONY)
+        self.rules = rules
+        if rules:
+            self.order = [p for r in rules for p in r.prereqs]
+            self.order_only = [p for r in rules for p in r.order_only]
+            return
+        (order, order_only) = store.prerequisites(i)
+        self.order = store.names_of(order)
+        self.order_only = store.names_of(order_only)
+        self.store = store
+        self.i = i
+
+    def cmds(self):
+        '''Returns the list of the commands of each rule'''
+        if not self.exists:
+            return []
+        if self.rules:
+            return [list(r.cmds) for r in self.rules]
+        return [list(self.store.cmds(self.i))]
+
+
+class Diff:
+    def __init__(self):
+        self.lines = []
+        self.counts = dict.fromkeys(['targets added', 'targets removed',
+                                     'edges added', 'edges removed',
+                                     'phony changed', 'recipes changed'],
+                                    0)
+
+    def add(self, kind, line):
+        self.counts[kind] += 1
+        self.lines.append(line)
+
+
+def edge_changes(diff, name, old, new, label):
+    '''Adds the edges of one kind which only one of the targets has,
+       or has more times, in more of its double-colon rules'''
+    if old == new:
+        # Most targets keep their prerequisites
+        return
+    for (kind, sign, edges, other) in (('edges removed', '-', old, new),
+                                       ('edges added', '+', new, old)):
+        extra = collections.Counter(edges)
+        extra.subtract(other)
+        for p in edges:
+            if extra[p] > 0:
+                diff.add(kind, '{}{} {} -> {}'.format(sign, label, name, p))
+                extra[p] -= 1
+
+
+def recipe_lines(sign, cmd_lists):
+    '''Returns the lines showing the commands of each rule of a
+       target, with a "::" line before each rule after the first'''
+    lines = []
+    for (k, cmds) in enumerate(cmd_lists):
+        if k:
+            lines.append('  {} ::'.format(sign))
+        lines.extend(['  {} {}'.format(sign, c) for c in cmds])
+    return lines
+
+
+def compare(old, new, recipes=True, old_rules=None, new_rules=None):
+    '''Returns the Diff between the graphs old and new. old_rules and
+       new_rules are their makedb.double_colon_rules(), if any.'''
+    diff = Diff()
+    (old_rules, new_rules) = (old_rules or {}, new_rules or {})
+    for (name, i, j) in common_names(old, new):
+        a = Rule(old, i, old_rules.get(name))
+        b = Rule(new, j, new_rules.get(name))
+        if not (a.exists or b.exists):
+            continue
+        if not b.exists:
+            diff.add('targets removed', '-target ' + name)
+        elif not a.exists:
+            diff.add('targets added', '+target ' + name)
+        elif a.phony != b.phony:
+            diff.add('phony changed', '{}phony {}'.format(
+                '+' if b.phony else '-', name))
+        edge_changes(diff, name, a.order, b.order, 'edge')
+        edge_changes(diff, name, a.order_only, b.order_only, 'order-only')
+        if recipes and a.exists and b.exists:
+            (old_cmds, new_cmds) = (a.cmds(), b.cmds())
+            if old_cmds != new_cmds:
+                diff.add('recipes changed', '~recipe ' + name)
+                diff.lines.extend(recipe_lines('-', old_cmds))
+                diff.lines.extend(recipe_lines('+', new_cmds))
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Compares two databases created by "make -qpR", e.g. before
+           and after a makefile change, and prints the differences
+           in their rules, one per line:
+             +target T / -target T   T has a rule only in new / old
+             +edge T -> P            P is a prerequisite of T only in new
+             -edge T -> P            P is a prerequisite of T only in old
+             +order-only T -> P      the same for order-only prerequisites
+             +phony T / -phony T     T became phony / stopped being phony
+             ~recipe T               the commands of T changed, followed
+                                     by the old (-) and new (+) ones
+           The order of the prerequisites is ignored. All the
+           double-colon rules of a target are compared: a prerequisite
+           of several of them is an edge for each one, and in recipes,
+           a "::" line starts the commands of the next rule.
+           Both databases get an index file (make.db.idx), so later
+           comparisons with the same files are much faster.
+           The exit status is 1 if the graphs differ, as with diff.'''))
+    parser.add_argument('old', help='make database before the change')
+    parser.add_argument('new', help='make database after the change')
+    parser.add_argument('-s', '--summary', action='store_true',
+                        help='only print the number of differences')
+    parser.add_argument('--no-recipes', action='store_true',
+                        help='do not compare the recipes')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing each database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write the index files')
+    args = parser.parse_args()
+
+    (old, new) = load_both(args.old, args.new, not args.no_cache,
+                           args.jobs or None)
+    diff = compare(old, new, not args.no_recipes,
+                   makedb.double_colon_rules(args.old),
+                   makedb.double_colon_rules(args.new))
+    summary = ', '.join('{} {}'.format(diff.counts[k], k)
+                        for k in sorted(diff.counts))
+    if args.summary:
+        print summary
+    else:
+        for l in diff.lines:
+            print l
+        if diff.lines:
+            sys.stderr.write(summary + '\n')
+    if diff.lines:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
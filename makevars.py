@@ -0,0 +1,205 @@
+'''Index of the variable definitions in a make database.
+
+   "make -qpR" prints every variable, preceded by a comment telling
+   where its value comes from:
+
+# Variables
+# makefile (from 'build/core/config.mk', line 42)
+TARGET_OUT := out/target/product/bxt_rvp
+# environment
+PATH = /usr/bin:/bin
+# makefile (from 'Makefile', line 4)
+define MULTI
+line1
+endef
+...
+# Pattern-specific Variable Values
+%.o :
+# makefile (from 'Makefile', line 17)
+# CFLAGS := -O2
+
+   The index maps each variable name to a list of VarDef, and is
+   saved next to the database (make.db -> make.db.vars), so that
+   later lookups do not have to read the database at all.'''
+
+import os
+import re
+import fnmatch
+import marshal
+import logging
+import collections
+
+import makedb
+import graphcache
+
+VarDef = collections.namedtuple('VarDef', ['name', 'flavor', 'value',
+                                           'origin', 'file', 'line',
+                                           'pattern'])
+
+ORIGIN_RE = re.compile(r"^# (default|environment|environment under -e|"
+                       r"automatic|makefile|command line|override|"
+                       r"'override' directive)"
+                       r"(?: \(from '(.*)', line (\d+)\))?$")
+# Variable names can not contain whitespace
+DEF_RE = re.compile(r'^(\S+) (=|:=|::=|\+=|\?=|!=) ?(.*)$')
+
+VARIABLES = '# Variables'
+PATTERN_VARIABLES = '# Pattern-specific Variable Values'
+# Other sections, where no variables are expected
+OTHER_SECTIONS = ('# Directories', '# Implicit Rules')
+
+VERSION = 1
+
+
+def read_lines(fi):
+    '''Yields the lines of fi, without newlines, up to the files
+       section of the database'''
+    tail = ''
+    while True:
+        block = fi.read(makedb.BLOCK_SIZE)
+        if not block:
+            break
+        lines = (tail + block).split('\n')
+        tail = lines.pop()
+        for l in lines:
+            if l + '\n' == makedb.FILES_HEADER:
+                return
+            yield l
+    if tail:
+        yield tail
+
+
+def parse_variables(fi):
+    '''Yields a VarDef for each variable in the database in fi'''
+    section = None
+    origin = None
+    pattern = None
+    lines = read_lines(fi)
+    for l in lines:
+        if l == VARIABLES or l == PATTERN_VARIABLES or l in OTHER_SECTIONS:
+            section = l
+            origin = None
+            continue
+        m = ORIGIN_RE.match(l)
+        if m:
+            origin = m.groups()
+            continue
+        if section == VARIABLES and origin and l[:1] != '#':
+            (name, flavor, value) = (None, None, None)
+            if l.startswith('define '):
+                # Multi-line value, up to endef
+                (name, sep, flavor) = l[7:].strip().partition(' ')
+                flavor = flavor or '='
+                value = []
+                for v in lines:
+                    if v == 'endef':
+                        break
+                    value.append(v)
+                value = '\n'.join(value)
+            else:
+                d = DEF_RE.match(l)
+                if d:
+                    (name, flavor, value) = d.groups()
+            if name:
+                yield make_def(name, flavor, value, origin, None)
+            origin = None
+        elif section == PATTERN_VARIABLES:
+            if l and l[0] != '#' and l.endswith(' :'):
+                pattern = l[:-2]
+            elif origin and l.startswith('# '):
+                d = DEF_RE.match(l[2:])
+                if d:
+                    (name, flavor, value) = d.groups()
+                    yield make_def(name, flavor, value, origin, pattern)
+                origin = None
+
+
+def make_def(name, flavor, value, origin, pattern):
+    (kind, path, line) = origin
+    return VarDef(name, flavor, value, kind, path,
+                  int(line) if line else None, pattern)
+
+
+def build_index(fi):
+    '''Returns a dictionary from variable name to list of VarDef.
+       Global definitions come before pattern-specific ones.'''
+    index = {}
+    for v in parse_variables(fi):
+        index.setdefault(v.name, []).append(v)
+    return index
+
+
+def cache_path(db_path):
+    return db_path + '.vars'
+
+
+def load_index(db_path, use_cache=True):
+    '''Returns the variable index of the database db_path, from the
+       file make.db.vars if it is up to date'''
+    if not use_cache:
+        with makedb.open_db(db_path) as fi:
+            return build_index(fi)
+    key = graphcache.db_key(db_path)
+    path = cache_path(db_path)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as fi:
+                (version, cached_key, data) = marshal.load(fi)
+            if version == VERSION and cached_key == key:
+                return dict((name, [VarDef(*d) for d in defs])
+                            for (name, defs) in data.iteritems())
+            logging.info('Variable index %s is out of date', path)
+        except (EOFError, ValueError, TypeError) as e:
+            logging.info('Ignoring variable index %s: %s', path, e)
+    with makedb.open_db(db_path) as fi:
+        index = build_index(fi)
+    data = dict((name, [tuple(d) for d in defs])
+                for (name, defs) in index.iteritems())
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fo:
+            marshal.dump((VERSION, key, data), fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logging.info('Could not write variable index: %s', e)
+    return index
+
+
+def lookup(index, name, origin=None, path=None):
+    '''Returns the VarDefs whose name matches name, which may contain
+       shell wildcards. origin and path restrict the result to
+       definitions with that origin, or made in that makefile.'''
+    if any(c in name for c in '*?['):
+        names = sorted(fnmatch.filter(index.iterkeys(), name))
+    elif name in index:
+        names = [name]
+    else:
+        names = []
+    result = []
+    for n in names:
+        for v in index[n]:
+            if origin and v.origin != origin:
+                continue
+            if path and v.file != path:
+                continue
+            result.append(v)
+    return result
+
+
+def format_def(v):
+    '''Returns the lines describing a VarDef, in the format of the
+       make database'''
+    where = '# ' + v.origin
+    if v.file:
+        where += " (from '{}', line {})".format(v.file, v.line)
+    lines = []
+    if v.pattern:
+        lines.append(v.pattern + ' :')
+    lines.append(where)
+    if '\n' in v.value:
+        lines.append('define {} {}'.format(v.name, v.flavor))
+        lines.extend(v.value.split('\n'))
+        lines.append('endef')
+    else:
+        lines.append('{} {} {}'.format(v.name, v.flavor, v.value))
+    return lines
@@ -9,17 +9,19 @@ import sys
 import textwrap
 import curses
 import logging
+import os
+import threading
+import time
 
+import depclient
+import graphcache
+import graphstore
+import makedb
+import makewatch
+import makevars
+import namesearch
+import nodelines
 
-'''Format of rule database:
-# Files
-
-[# Not a target]
-target: [prerequisite]*
-[#  A default, MAKEFILES, or -include/sinclude makefile.]
-#  Implicit rule search has [not] been done.
-# File has [not] been updated
-'''
 
 # Lookup from target to prerequisite
 all_targets = {}
@@ -27,16 +29,6 @@ all_targets = {}
 all_children = {}
 
 
-def add_to_child_list(children, target):
-    for c in children:
-        if c in all_children:
-            # Child already has a parent. Append to existing list
-            all_children[c].append(target)
-        else:
-            # First parent. Create a list
-            all_children[c] = [target]
-
-
 def readOneCmd(line):
     result = []
     noOfCols = 60
@@ -51,67 +43,6 @@ def readOneCmd(line):
         result = result[:-1]
     return result
 
-def convert(fi):
-    logging.debug('Starting to parse')
-    l = ''
-    # Loop until start of files section (or EOF)
-    while True:
-        l = fi.readline()
-        if (not l) or (l == '# Files\n'):
-            break;
-
-    if not l:
-        return
-    # Process rules until done
-    while True:
-        # Move forward to the next rule
-        while True:
-            l = fi.readline()
-            if not l:
-                # EOF
-                break;
-            if l[0] == '#':
-                continue
-            if ':' in l:
-                break
-        if not l:
-            # EOF
-            break;
-        # Process this rule
-        (target, sep, prerequisites) = l.strip().partition(':')
-#        logging.debug('Rule: %s', l)
-# No, this check does not work. There are double-colon rules.
-#        if (target in all_targets):
-#            print 'Error: target {} already exists!'.format(target);
-#            sys.exit(1);
-
-        # We do not want .PHONY to show up as a node in the graph
-        cmds = []
-        if target != '.PHONY':
-            prereq_list = []
-            order_prereq_list = []
-            if prerequisites:
-                (order, sep2, order_only) = prerequisites.partition('|')
-                prereq_list = order.split()
-                add_to_child_list(prereq_list, target)
-                order_prereq_list = order_only.split()
-                add_to_child_list(order_prereq_list, target)
-
-        # Skip the comments below the rule
-        while True:
-            l = fi.readline()
-            if l[0] == '\t':
-                # Save this command, we might want to display it
-                nextCmd = l.strip()
-                if nextCmd:
-                    cmds.append(nextCmd)
-            if l[0] != '#' and l[0] != '\t':
-                # Done with this rule, save and go to next
-                if target != '.PHONY':
-                    all_targets[target] = (prereq_list, order_prereq_list, cmds)
-                break;
-    logging.debug('Done parsing')
-
 def find_parents(child):
     if not child in all_children:
         return []
@@ -147,6 +78,8 @@ class BaseWindow:
     LEAVE_WINDOW = 1
     LEAVE_APP = 2
     SELECT_ITEM = 3
+    QUERY_VARIABLE = 4
+    FIND_NODE = 5
 
     def __init__(self, scr):
         self.scr = scr
@@ -160,6 +93,8 @@ class BaseWindow:
         self.selectEnabled = False
         self.cursor_y = 0
         self.lines = []
+        # Called as idleHandler(window) when getch() times out
+        self.idleHandler = None
         logging.debug('Done creating BaseWindow')
 
     def enableSelection(self):
@@ -251,6 +186,10 @@ class BaseWindow:
         (cursor_y, cursor_x) = self.scr.getyx()
         return cursor_y
 
+    def selectedItem(self):
+        '''Returns the node name on the line of the cursor'''
+        return self.lines[self.getCurrentLineIx()].split(':')[1].strip()
+
     def decodeKey(self, c):
         logging.debug('BaseWindow::decodeKey')
         r = (None, '')
@@ -259,12 +198,15 @@ class BaseWindow:
         elif c == curses.KEY_DOWN:
             r = self.handleKeyDown()
         elif (c == curses.KEY_ENTER) or (c == 10):
-            if self.selectEnabled:
-                cursor_y = self.getCurrentLineIx()
-                l = self.lines[cursor_y].split(':')[1].strip()
-                r = (BaseWindow.SELECT_ITEM, l)
+            item = self.selectEnabled and self.selectedItem()
+            if item:
+                r = (BaseWindow.SELECT_ITEM, item)
         elif c == ord('q'):
             r = (BaseWindow.LEAVE_APP, '')
+        elif c == ord('v'):
+            r = (BaseWindow.QUERY_VARIABLE, '')
+        elif c == ord('/'):
+            r = (BaseWindow.FIND_NODE, '')
         elif c == ord('\t'):
             logging.debug('BaseWindow::decodeKey: got TAB')
             r = (BaseWindow.LEAVE_WINDOW, '')
@@ -279,17 +221,24 @@ class BaseWindow:
         while not retVal[0]:
             logging.debug('BaseWindow::handleInput: about to read key')
             key = self.scr.getch()
+            if key == -1 and self.idleHandler:
+                # No key pressed before the timeout
+                retVal = self.idleHandler(self)
+                continue
             logging.debug('BaseWindow::handleInput: read key: %d', key)
             retVal = self.decodeKey(key)
         logging.debug('BaseWindow::handleInput: leaving function')
         return retVal
 
-    def writeLine(self, i, l):
+    def fitLine(self, l):
         if len(l) >= self.max_x:
             l = l[:self.max_x - 2] + '*'
+        return l
+
+    def writeLine(self, i, l):
 #        logging.debug('writeLine: len = %d', len(l))
 #        logging.debug('writeLine: line = "%s"', l)
-        self.scr.addstr(i, 0, l)
+        self.scr.addstr(i, 0, self.fitLine(l))
 
 
 class ScrollingWindow(BaseWindow):
@@ -299,26 +248,61 @@ class ScrollingWindow(BaseWindow):
     def __init__(self, scr):
         BaseWindow.__init__(self, scr)
         self.scroll_y = 0
+        # The text on each row of the window, so that only the rows
+        # which change are written
+        self.shown = []
         logging.debug('Done creating ScrollingWindow')
 
     def setCursorPos(self, y):
         self.scr.move(y, 0)
         self.cursor_y = y
 
-    def setContents(self, lines):
+    def setWinSize(self, newSize):
+        # The rows are rewritten as needed, so only clear the window
+        # when its size changes
+        if newSize != self.cur_size_y:
+            BaseWindow.setWinSize(self, newSize)
+            self.shown = []
+
+    def adjustWinSize(self, newSize):
+        BaseWindow.adjustWinSize(self, newSize)
+        del self.shown[self.cur_size_y:]
+
+    def setContents(self, lines, current=0):
+        '''Shows lines, a list or a NodeLines, with the cursor on line
+           current. If it is not on the first page, it is scrolled to
+           the top of the window.'''
+        self.scroll_y = current if current >= self.cur_size_y else 0
+        self.cursor_y = current - self.scroll_y
         self.setBaseContents(lines)
 
+    def selectedItem(self):
+        i = self.scroll_y + self.getCurrentLineIx()
+        if i >= len(self.lines):
+            return None
+        if isinstance(self.lines, nodelines.NodeLines):
+            return self.lines.name(i)
+        return self.lines[i].split(':')[1].strip()
 
     def fillWindow(self):
         logging.debug('ScrollingWindow::fillWindow: entry')
-        part_of_scr = min(self.cur_size_y,len(self.lines)- self.scroll_y)
+        part_of_scr = max(0, min(self.cur_size_y,
+                                 len(self.lines) - self.scroll_y))
         logging.debug('ScrollingWindow::fillWindow: part_of_scr = %d', part_of_scr)
-        for i in range(0, part_of_scr):
-            self.writeLine(i, self.lines[i + self.scroll_y])
+        rows = [self.fitLine(self.lines[i + self.scroll_y])
+                for i in xrange(part_of_scr)]
+        for (i, l) in enumerate(rows):
+            if i >= len(self.shown) or self.shown[i] != l:
+                self.scr.move(i, 0)
+                self.scr.clrtoeol()
+                self.scr.addstr(i, 0, l)
+        for i in xrange(part_of_scr, len(self.shown)):
+            self.scr.move(i, 0)
+            self.scr.clrtoeol()
+        self.shown = rows
         self.refreshCursor()
 
     def rePaint(self):
-            self.scr.clear()
             self.fillWindow()
             self.scr.refresh()
 
@@ -344,7 +328,7 @@ class ScrollingWindow(BaseWindow):
             if lastLineOnScreen < len(self.lines):
                 self.scroll_y += 1
                 self.rePaint()
-        else:
+        elif self.scroll_y + self.getCurrentLineIx() < len(self.lines) - 1:
             BaseWindow.handleKeyDown(self)
         return (None, '')
 
@@ -365,9 +349,17 @@ class ScrollingWindow(BaseWindow):
             self.scroll_y -= min(self.scroll_y, self.cur_size_y)
             self.rePaint()
 
+    def clampCursor(self):
+        '''Moves the cursor up to the last line, if a scroll left it
+           below the end of the lines'''
+        last = len(self.lines) - 1 - self.scroll_y
+        if self.cursor_y > last:
+            self.cursor_y = max(0, last)
+
     def handleKeyPgDown(self):
         if (len(self.lines) - self.scroll_y) > self.cur_size_y:
             self.scroll_y += self.cur_size_y
+            self.clampCursor()
             self.rePaint()
 
 
@@ -377,8 +369,12 @@ class ScrollingWindow(BaseWindow):
 
 
     def handleKeyEnd(self):
-        while (len(self.lines) - self.scroll_y) > self.cur_size_y:
-            self.scroll_y += self.cur_size_y
+        # Go down as many pages as needed to show the last line
+        pages = -(-(len(self.lines) - self.scroll_y - self.cur_size_y) //
+                  self.cur_size_y)
+        if pages > 0:
+            self.scroll_y += pages * self.cur_size_y
+            self.clampCursor()
         self.rePaint()
 
     def decodeKey(self, c):
@@ -396,15 +392,174 @@ class ScrollingWindow(BaseWindow):
         return r
 
 
+class BackgroundLoader(threading.Thread):
+    '''Parses a make database into all_targets and all_children in
+       a separate thread, so that the user interface can start at once.
+       The database is either the file db_path, or the output of
+       "make -qpR make_args". When done, the index file is written
+       unless use_cache is False. A db_path is parsed through
+       rule_index, a makewatch.RuleIndex, if given, or otherwise by
+       jobs processes if jobs is not 1. stop() makes it give up.'''
+    def __init__(self, all_targets, all_children, db_path=None,
+                 make_args=None, save_path=None, use_cache=True,
+                 rule_index=None, jobs=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.all_targets = all_targets
+        self.all_children = all_children
+        self.db_path = db_path
+        self.make_args = make_args
+        self.save_path = save_path
+        self.use_cache = use_cache
+        self.rule_index = rule_index
+        self.jobs = jobs
+        self.size = 0
+        if db_path and not db_path.endswith('.gz'):
+            self.size = os.path.getsize(db_path)
+        self.reader = None
+        # How far parse_parallel() has come
+        self.position = 0
+        self.rules = 0
+        self.done = False
+        self.error = None
+        self.stopping = False
+
+    def stop(self):
+        '''Makes run() return soon, without writing the index'''
+        self.stopping = True
+
+    def parse(self, fi, phony, cmd_source=None):
+        self.reader = makedb.CountingReader(fi)
+        if self.rule_index:
+            rules = self.rule_index.parse(self.reader)
+        else:
+            rules = makedb.parse_rules(self.reader, cmd_source)
+        for r in rules:
+            if self.stopping:
+                return
+            makedb.add_to_child_list(self.all_children, r.prereqs, r.target)
+            makedb.add_to_child_list(self.all_children, r.order_only,
+                                     r.target)
+            self.all_targets[r.target] = (r.prereqs, r.order_only, r.cmds)
+            if r.is_phony:
+                phony.add(r.target)
+            self.rules += 1
+
+    def parse_parallel(self, phony, cmd_source):
+        chunks = makedb.parse_parallel(self.db_path, self.jobs, cmd_source)
+        try:
+            for (targets, children, chunk_phony, end) in chunks:
+                if self.stopping:
+                    return
+                makedb.merge_parts(self.all_targets, self.all_children,
+                                   targets, children)
+                phony.update(chunk_phony)
+                self.rules += len(targets)
+                self.position = end
+        finally:
+            chunks.close()
+
+    def run(self):
+        phony = set()
+        try:
+            if self.make_args is not None:
+                with makedb.MakeReader(self.make_args, self.save_path) as fi:
+                    self.parse(fi, phony)
+                index_db = self.save_path
+                key = graphcache.db_key(index_db) if index_db else None
+            else:
+                index_db = self.db_path
+                key = graphcache.db_key(index_db)
+                cmd_source = None
+                if not self.rule_index:
+                    cmd_source = makedb.open_cmd_source(self.db_path)
+                if cmd_source and self.jobs != 1:
+                    self.parse_parallel(phony, cmd_source)
+                else:
+                    with makedb.open_db(self.db_path) as fi:
+                        self.parse(fi, phony, cmd_source)
+        except Exception as e:
+            logging.exception('Loading failed')
+            self.error = str(e)
+            self.done = True
+            return
+        self.done = True
+        if self.use_cache and index_db and not self.stopping:
+            store = graphstore.from_dicts(self.all_targets, self.all_children,
+                                          phony)
+            try:
+                graphcache.write_index(graphcache.cache_path(index_db), key,
+                                       store)
+            except (IOError, OSError) as e:
+                logging.info('Could not write index: %s', e)
+
+    def progress(self):
+        '''Returns a line describing how far the parsing has come'''
+        if self.error:
+            return 'Error while parsing: ' + self.error
+        if self.done:
+            return 'Parsed {} rules'.format(self.rules)
+        done = self.reader.count if self.reader else self.position
+        if self.size:
+            percent = '{}%, '.format(done * 100 // self.size)
+        else:
+            percent = '{} MB, '.format(done // 1000000)
+        return ('Parsing make database: {}{} rules. '
+                'Parents are partial.'.format(percent, self.rules))
+
+
+class Reloader(threading.Thread):
+    '''Reads a changed make database again through a
+       makewatch.RuleIndex in a separate thread. The resulting patch
+       is applied by the user interface thread.'''
+    def __init__(self, rule_index):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.rule_index = rule_index
+        self.patch = None
+        self.parsed = 0
+        self.done = False
+        self.error = None
+
+    def run(self):
+        try:
+            (self.patch, self.parsed) = self.rule_index.update()
+        except Exception as e:
+            logging.exception('Reloading failed')
+            self.error = str(e)
+        self.done = True
+
+
 class DependencyMgr:
     CMD_SCR_SIZE = 10
-    def __init__(self, scr, all_targets, all_children, show_commands):
+    # How often to check on the background loader, in ms
+    POLL_INTERVAL = 250
+    # How often to check the watched database for changes, in s
+    WATCH_INTERVAL = 1.0
+    def __init__(self, scr, all_targets, all_children, show_commands,
+                 loader=None, status_scr=None, db_path=None, client=None,
+                 rule_index=None, use_cache=True):
         self.win = ScrollingWindow(scr)
         self.win.enableSelection()
         self.win.adjustMode = BaseWindow.BOTTOM
         self.all_targets = all_targets
         self.all_children = all_children
         self.show_commands = show_commands
+        # The node given on the command line, and the one shown
+        self.init_node = None
+        self.node = None
+        self.waiting = False
+        self.error = None
+        self.loader = loader
+        self.status_scr = status_scr
+        self.db_path = db_path
+        self.client = client
+        self.var_index = None
+        self.name_index = None
+        self.use_cache = use_cache
+        self.rule_index = rule_index
+        self.reloader = None
+        self.last_check = 0
         if show_commands:
             cmd_scr = curses.newwin(self.CMD_SCR_SIZE, self.win.max_x)
             cmd_scr.nodelay(0)
@@ -414,8 +569,84 @@ class DependencyMgr:
             self.cmd_win.adjustMode = BaseWindow.TOP
             self.cmd_win.scr.mvwin(self.win.max_y-self.CMD_SCR_SIZE, 0)
             self.win.setWinSize(self.win.cur_size_y - self.CMD_SCR_SIZE)
+        if loader or rule_index:
+            for w in self.windows():
+                w.scr.timeout(self.POLL_INTERVAL)
+                w.idleHandler = self.handleIdle
         logging.info('Done creating DependencyMgr')
-        
+
+    def windows(self):
+        if self.show_commands:
+            return [self.win, self.cmd_win]
+        return [self.win]
+
+    def showStatus(self, text):
+        self.status_scr.erase()
+        self.status_scr.addstr(0, 0, text[:self.win.max_x - 1],
+                               curses.A_REVERSE)
+        self.status_scr.refresh()
+
+    def handleIdle(self, window):
+        '''Shows the progress of the loader, and updates the view
+           when it has more to show'''
+        loader = self.loader
+        if loader is None:
+            self.handleWatch()
+        elif loader.done:
+            if self.rule_index:
+                # Go on polling, for changes of the database
+                self.loader = None
+            else:
+                # Stop polling
+                for w in self.windows():
+                    w.scr.timeout(-1)
+                    w.idleHandler = None
+            self.showStatus(loader.progress())
+            if loader.error:
+                self.error = loader.progress()
+                return (BaseWindow.LEAVE_APP, '')
+            if not self.init_node in self.all_targets:
+                self.error = 'Error: target {} not in any rule'.format(
+                    self.init_node)
+                return (BaseWindow.LEAVE_APP, '')
+            # The parents are complete now
+            self.updateWinContent(self.node)
+        else:
+            self.showStatus(loader.progress())
+            if self.waiting and self.node in self.all_targets:
+                self.updateWinContent(self.node)
+        window.refreshCursor()
+        window.scr.refresh()
+        return (None, '')
+
+    def handleWatch(self):
+        '''Starts reading the database again when it has changed, and
+           updates the view when that is done'''
+        reloader = self.reloader
+        if reloader is None:
+            now = time.time()
+            if now - self.last_check < self.WATCH_INTERVAL:
+                return
+            self.last_check = now
+            if self.rule_index.changed():
+                self.reloader = Reloader(self.rule_index)
+                self.reloader.start()
+                self.showStatus('Make database changed, reloading')
+            return
+        if not reloader.done:
+            return
+        self.reloader = None
+        if reloader.error:
+            self.showStatus('Error while reloading: ' + reloader.error)
+            return
+        reloader.patch.apply(self.all_targets, self.all_children)
+        self.name_index = None
+        status = 'Reloaded: {} rules changed'.format(reloader.parsed)
+        if self.node in self.all_targets or self.node in self.all_children:
+            self.updateWinContent(self.node)
+        else:
+            status += ', {} is gone'.format(self.node)
+        self.showStatus(status)
 
     def find_parents(self, child):
         if not child in self.all_children:
@@ -424,22 +655,146 @@ class DependencyMgr:
 
 
     def updateWinContent(self, node):
+        self.node = node
         parents = self.find_parents(node)
-        (order, order_only, cmds) = self.all_targets[node]
-        all_lines = ['U: ' + x for x in parents]
-        all_lines.append(' T: ' + node)
-        all_lines.extend(['  P: ' + x for x in order])
-        all_lines.extend(['  O: ' + x for x in order_only])
+        # A node without a rule, or whose rule is not parsed yet
+        (order, order_only, cmds) = self.all_targets.get(node, ([], [], []))
+        self.waiting = self.loader and not self.loader.done and \
+            not node in self.all_targets
+        all_lines = nodelines.NodeLines(node, parents, order, order_only)
         newSize = self.win.max_y
         if self.show_commands:
+            # Decode the commands, if they are still in the database
+            try:
+                cmds = list(cmds)
+            except makedb.DatabaseChanged as e:
+                cmds = ['<{}>'.format(e)]
             cmdWinSize = min(len(cmds), self.CMD_SCR_SIZE)
             newSize -= cmdWinSize
             self.cmd_win.adjustWinSize(cmdWinSize)
             self.cmd_win.setContents(cmds)
         self.win.setWinSize(newSize)
-        self.win.setCursorPos(len(parents))
-        self.win.setContents(all_lines)
+        self.win.setContents(all_lines, len(parents))
         
+    def readVariableName(self):
+        '''Prompts for a variable name on the bottom line'''
+        prompt = 'Variable: '
+        scr = curses.newwin(1, self.win.max_x, self.win.max_y - 1, 0)
+        scr.addstr(0, 0, prompt, curses.A_REVERSE)
+        curses.echo()
+        try:
+            name = scr.getstr(0, len(prompt)).strip()
+        finally:
+            curses.noecho()
+        del scr
+        return name
+
+    def showVariable(self):
+        '''Shows the definitions of a variable in a panel covering
+           the screen, until a key other than a movement key is
+           pressed'''
+        name = self.readVariableName()
+        if not name:
+            lines = []
+        elif not (self.db_path or self.client):
+            lines = ['Variables are only available with -f or -S']
+        else:
+            if self.client:
+                defs = [makevars.VarDef(*v)
+                        for v in self.client.variables(name)]
+            else:
+                if self.var_index is None:
+                    self.var_index = makevars.load_index(self.db_path)
+                defs = makevars.lookup(self.var_index, name)
+            lines = []
+            for v in defs:
+                lines.extend(makevars.format_def(v))
+            if not lines:
+                lines = ['No variable ' + name]
+        if lines:
+            scr = curses.newwin(self.win.max_y, self.win.max_x, 0, 0)
+            scr.keypad(1)
+            panel = ScrollingWindow(scr)
+            panel.setContents(lines)
+            panel.setCursorPos(0)
+            panel.handleInput()
+            del panel, scr
+        self.redraw()
+
+    def redraw(self):
+        '''Shows the dependency windows again, after a panel covered
+           them'''
+        for w in self.windows():
+            w.scr.touchwin()
+            w.scr.refresh()
+        if self.status_scr:
+            self.status_scr.touchwin()
+            self.status_scr.refresh()
+
+    def nameFinder(self):
+        '''Returns an object whose find(text, mode, limit) returns
+           matching node names, or None while the database is still
+           being parsed'''
+        if self.client:
+            return self.client
+        if self.loader and not self.loader.done:
+            return None
+        if self.name_index is None:
+            names = namesearch.graph_names(self.all_targets,
+                                           self.all_children)
+            self.name_index = namesearch.load(self.db_path, names,
+                                              self.use_cache)
+        return self.name_index
+
+    def findNode(self):
+        '''Type-ahead search of a node: shows the nodes matching the
+           text typed on the bottom line in a panel covering the
+           screen. Returns the chosen node, or None if Esc is
+           pressed.'''
+        prompt = 'Find: '
+        scr = curses.newwin(self.win.max_y, self.win.max_x, 0, 0)
+        scr.keypad(1)
+        rows = self.win.max_y - 1
+        scr.addstr(rows, 0, self.win.fitLine('Indexing node names...'))
+        scr.refresh()
+        finder = self.nameFinder()
+        text = ''
+        matches = []
+        current = 0
+        while True:
+            scr.erase()
+            for (row, name) in enumerate(matches):
+                scr.addstr(row, 0, self.win.fitLine(name),
+                           curses.A_REVERSE if row == current else 0)
+            if finder is None:
+                scr.addstr(rows, 0, self.win.fitLine(
+                    'The node names can be searched when the database '
+                    'is parsed. Press a key.'))
+                scr.getch()
+                return None
+            scr.addstr(rows, 0, prompt, curses.A_REVERSE)
+            scr.addstr(self.win.fitLine(prompt + text)[len(prompt):])
+            scr.refresh()
+            c = scr.getch()
+            if c == curses.KEY_ENTER or c == 10:
+                return matches[current] if matches else None
+            elif c == 27:
+                return None
+            elif c == curses.KEY_UP:
+                current = max(0, current - 1)
+                continue
+            elif c == curses.KEY_DOWN:
+                current = min(len(matches) - 1, current + 1)
+                continue
+            elif c in (curses.KEY_BACKSPACE, 127, 8):
+                text = text[:-1]
+            elif 32 <= c < 127:
+                text += chr(c)
+            else:
+                continue
+            matches = finder.find(text, 'any', rows)
+            current = 0
+
     def handleInput(self):
         inputWindow = self.win
         while 1:     
@@ -451,6 +806,19 @@ class DependencyMgr:
                 self.updateWinContent(str)
             elif status == BaseWindow.LEAVE_APP:
                 break
+            elif status == BaseWindow.QUERY_VARIABLE:
+                self.showVariable()
+                inputWindow.refreshCursor()
+                inputWindow.scr.refresh()
+            elif status == BaseWindow.FIND_NODE:
+                node = self.findNode()
+                self.redraw()
+                if node:
+                    logging.info('Mgr: found target %s', node)
+                    inputWindow = self.win
+                    self.updateWinContent(node)
+                inputWindow.refreshCursor()
+                inputWindow.scr.refresh()
             elif status == BaseWindow.LEAVE_WINDOW:
                 logging.debug('ScrollingWindow::handleInput: got TAB')
                 # Switch cursor to other window
@@ -463,13 +831,28 @@ class DependencyMgr:
                 inputWindow.refreshCursor()
 
 
-def curses_app2(scr, init_node, show_commands):
+def curses_app2(scr, init_node, show_commands, loader=None, db_path=None,
+                client=None, rule_index=None, use_cache=True):
     scr.nodelay(0)
+    status_scr = None
+    if loader or rule_index:
+        # Leave the bottom line for the progress of the loader
+        (max_y, max_x) = scr.getmaxyx()
+        status_scr = curses.newwin(1, max_x, max_y - 1, 0)
+        scr = curses.newwin(max_y - 1, max_x, 0, 0)
+        scr.keypad(1)
     handler = DependencyMgr(scr, all_targets, all_children, 
-                            show_commands)
+                            show_commands, loader, status_scr, db_path,
+                            client, rule_index, use_cache)
+    handler.init_node = init_node
     handler.updateWinContent(init_node)
+    if loader:
+        handler.showStatus(loader.progress())
+        handler.win.refreshCursor()
+        handler.win.scr.refresh()
     logging.info('App: About to handle input')
     handler.handleInput()
+    return handler.error
 
 
                
@@ -496,12 +879,45 @@ def main():
            * home/end keys to move to the beginning/end of the list
            * Enter key to make the selected node the new target.
            * TAB key to switch between the tree window and the
-             command list window.'''))
+             command list window.
+           * v key to look up the definition of a make variable.
+           * / key to find a node by typing a part of its name. The
+             matching nodes are shown as the name is typed: the ones
+             starting with it first, then the ones containing it, then
+             the ones with a similar name. Up/down keys choose one,
+             Enter makes it the new target and Esc goes back.
+           With -W, the file is watched, and the view is updated when it
+           is regenerated. Only the rules which changed are parsed
+           again.'''))
     parser.add_argument('node')
     parser.add_argument('-f', '--file', action='store',
-                        help='make file to parse', required=True)
+                        help='make file to parse (may be gzip compressed)')
+    parser.add_argument('-m', '--make', action='store', metavar='ARGS',
+                        help='run "make -qpR ARGS" and parse its output '
+                             'instead of a file')
+    parser.add_argument('-s', '--save', action='store',
+                        help='with -m, also save the make database in this '
+                             'file. A name ending with .gz compresses it.')
+    parser.add_argument('-S', '--server', action='store', metavar='SOCKET',
+                        help='ask the depserver.py server listening on '
+                             'SOCKET, instead of loading the database')
     parser.add_argument('-l', '--logfile', action='store',
                         help='optional file to store diagnostics in')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        default=False,
+                        help='do not use or write the index file make.db.idx')
+    parser.add_argument('-w', '--wait', action='store_true',
+                        default=False,
+                        help='parse the whole database before starting, '
+                             'instead of in the background')
+    parser.add_argument('-W', '--watch', action='store_true',
+                        default=False,
+                        help='with -f, update the view when the file '
+                             'changes. The file is always parsed, in the '
+                             'background.')
     parser.add_argument('-c', '--commands', action='store_true',
                         default=False,
                         help='Show commands in a separate window')
@@ -512,20 +928,75 @@ def main():
     if args.logfile:
         logging.basicConfig(filename=args.logfile, level=logging.DEBUG)
 
-    if not args.file:
+    if not args.file and args.make is None and not args.server:
         print 'You must specify a file to parse!'
         sys.exit(1)
+    if args.watch and not args.file:
+        print 'Only a file given with -f can be watched'
+        sys.exit(1)
 
 
-    with open(args.file, 'r') as fi:
+    global all_targets, all_children
+    use_cache = not args.no_cache
+    loader = None
+    client = None
+    rule_index = None
+    if args.server:
+        try:
+            client = depclient.Client(args.server)
+        except depclient.ServerError as e:
+            print 'Error: {}'.format(e)
+            sys.exit(1)
+        (all_targets, all_children) = depclient.views(client, args.commands)
+    elif args.make is not None:
+        print 'Running make -qpR ' + args.make
+        if args.wait:
+            print 'Parsing make database. This may take a while.\n'
+            store = graphcache.load_store_from_make(args.make, args.save,
+                                                    use_cache)
+            (all_targets, all_children) = graphstore.views(store)
+        else:
+            loader = BackgroundLoader(all_targets, all_children,
+                                      make_args=args.make,
+                                      save_path=args.save,
+                                      use_cache=use_cache)
+    else:
         print 'Opening file ' + args.file
-        print 'Parsing make database. This may take a while.\n'
-        convert(fi)
-    if not args.node in all_targets:
+        if args.watch:
+            rule_index = makewatch.RuleIndex(args.file)
+            loader = BackgroundLoader(all_targets, all_children,
+                                      db_path=args.file,
+                                      use_cache=use_cache,
+                                      rule_index=rule_index)
+        elif use_cache and graphcache.is_current(args.file):
+            (all_targets, all_children) = graphcache.load(args.file)
+        elif args.wait:
+            print 'Parsing make database. This may take a while.\n'
+            (all_targets, all_children) = graphcache.load(
+                args.file, use_cache, args.jobs or None)
+        else:
+            loader = BackgroundLoader(all_targets, all_children,
+                                      db_path=args.file,
+                                      use_cache=use_cache,
+                                      jobs=args.jobs or None)
+    if loader:
+        loader.start()
+    elif not args.node in all_targets:
         print 'Error: target {} not in any rule'.format(args.node)
         sys.exit(1)
 
-    curses.wrapper(curses_app2, args.node, args.commands)
+    try:
+        error = curses.wrapper(curses_app2, args.node, args.commands, loader,
+                               args.file or args.save, client, rule_index,
+                               use_cache)
+    except depclient.ServerError as e:
+        error = 'Error: {}'.format(e)
+    if loader:
+        loader.stop()
+        loader.join()
+    if error:
+        print error
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,177 @@
+'''Incremental update of a parsed make database.
+
+   RuleIndex remembers a checksum (MD5) of every rule of a database,
+   made from its rule line, its commands and whether it is phony. When
+   the database is regenerated, update() reads it again but only parses
+   the rules whose checksum is new, and returns a Patch which turns
+   all_targets and all_children into those of the new database.
+   Comment lines, like the modification times of files, are not part
+   of the checksum, so they do not count as changes.'''
+
+import os
+import logging
+import hashlib
+
+import makedb
+
+
+def checksum(line, body):
+    '''Returns the checksum of a rule line and the lines below it'''
+    if '\t' in body:
+        cmds = '\n'.join(l for l in body.split('\n') if l[:1] == '\t')
+    else:
+        cmds = ''
+    h = hashlib.md5(line)
+    h.update('\n')
+    h.update(cmds)
+    h.update('\n1' if makedb.is_phony_body(body) else '\n0')
+    return h.digest()
+
+
+def scan(fi):
+    '''Yields (checksum, match of makedb.RULE_RE) for each rule in the
+       database read from fi'''
+    data = makedb.find_files_section(fi)
+    if data is None:
+        return
+    for (offset, block) in makedb.read_blocks(fi, data, 0):
+        for m in makedb.RULE_RE.finditer(block):
+            yield (checksum(m.group(1), m.group(2)), m)
+
+
+def rules_by_target(order, rules):
+    '''Returns a dictionary from each target to the checksums of its
+       rules, in database order'''
+    result = {}
+    for cs in order:
+        r = rules[cs]
+        if r:
+            result.setdefault(r.target, []).append(cs)
+    return result
+
+
+class Patch:
+    '''Changes to all_targets and all_children'''
+    def __init__(self):
+        # Target -> new value in all_targets, None to remove it
+        self.targets = {}
+        # (prerequisite, target, True to add / False to remove)
+        self.children = []
+
+    def apply(self, all_targets, all_children):
+        for (t, value) in self.targets.iteritems():
+            if value is None:
+                all_targets.pop(t, None)
+            else:
+                all_targets[t] = value
+        for (p, t, add) in self.children:
+            if add:
+                makedb.add_to_child_list(all_children, [p], t)
+                continue
+            parents = all_children.get(p)
+            if parents and t in parents:
+                parents.remove(t)
+                if not parents:
+                    del all_children[p]
+
+
+class RuleIndex:
+    '''The checksums of the rules of the database at path'''
+    def __init__(self, path):
+        self.path = path
+        # Checksum -> makedb.Rule, or None for the .PHONY rule
+        self.rules = {}
+        # Checksums of the rules, in database order
+        self.order = []
+        # rules_by_target() of order, once update() needed it
+        self.by_target = None
+        self.state = None
+        self.pending = None
+
+    def file_state(self):
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime)
+
+    def parse(self, fi):
+        '''Yields the rules of the database read from fi, as
+           makedb.parse_rules() does, and remembers their checksums.
+           The commands are always decoded, as the database may be
+           rewritten later.'''
+        self.state = self.file_state()
+        self.rules = {}
+        self.order = []
+        self.by_target = None
+        for (cs, m) in scan(fi):
+            if cs in self.rules:
+                rule = self.rules[cs]
+            else:
+                rule = makedb.parse_rule(m.group(1), m.group(2))
+                self.rules[cs] = rule
+            self.order.append(cs)
+            if rule:
+                yield rule
+
+    def changed(self):
+        '''Returns True if the database has changed since it was read.
+           To avoid reading a database which is still being written,
+           it must also be unchanged since the previous call.'''
+        try:
+            state = self.file_state()
+        except OSError:
+            return False
+        if state == self.state:
+            self.pending = None
+            return False
+        stable = state == self.pending
+        self.pending = state
+        return stable
+
+    def update(self):
+        '''Reads the database again. Returns a Patch from the graph
+           of the version read before to the graph of this one, and
+           the number of rules which had to be parsed.'''
+        state = self.file_state()
+        rules = {}
+        order = []
+        parsed = 0
+        with makedb.open_db(self.path) as fi:
+            for (cs, m) in scan(fi):
+                if cs not in rules:
+                    if cs in self.rules:
+                        rules[cs] = self.rules[cs]
+                    else:
+                        rules[cs] = makedb.parse_rule(m.group(1), m.group(2))
+                        parsed += 1
+                order.append(cs)
+        # A target changes with any of its rules, but also when its
+        # rules are repeated more or fewer times, like a double-colon
+        # rule, or come in another order: the order of all their
+        # prerequisites is the one of $^, and the last rule wins.
+        touched = set()
+        (old, new) = (self.by_target, self.by_target)
+        if order != self.order:
+            if old is None:
+                old = rules_by_target(self.order, self.rules)
+            new = rules_by_target(order, rules)
+            touched = set(t for (t, checksums) in new.iteritems()
+                          if old.get(t) != checksums)
+            touched.update(t for t in old if t not in new)
+        patch = Patch()
+        for t in touched:
+            for (checksums, rule_map, add) in (
+                    (old.get(t, []), self.rules, False),
+                    (new.get(t, []), rules, True)):
+                for cs in checksums:
+                    r = rule_map[cs]
+                    for p in r.prereqs + r.order_only:
+                        patch.children.append((p, t, add))
+            if t in new:
+                last = rules[new[t][-1]]
+                patch.targets[t] = (last.prereqs, last.order_only, last.cmds)
+            else:
+                patch.targets[t] = None
+        logging.info('%s: %d rules parsed, %d targets changed', self.path,
+                     parsed, len(touched))
+        (self.rules, self.order, self.by_target) = (rules, order, new)
+        self.state = state
+        return (patch, parsed)
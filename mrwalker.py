@@ -9,31 +9,23 @@ import sys
 import textwrap
 import logging
 from Tkinter import *
+import tkFont
 
-'''Format of rule database:
-# Files
-
-[# Not a target]
-target: [prerequisite]*
-[#  A default, MAKEFILES, or -include/sinclude makefile.]
-#  Implicit rule search has [not] been done.
-# File has [not] been updated
-'''
+import depclient
+import graphcache
+import graphstore
+import makedb
+import namesearch
+import nodelines
 
 # Lookup from target to prerequisite
 all_targets = {}
 # Lookup from prerequisite to target
 all_children = {}
-
-
-def add_to_child_list(children, target):
-    for c in children:
-        if c in all_children:
-            # Child already has a parent. Append to existing list
-            all_children[c].append(target)
-        else:
-            # First parent. Create a list
-            all_children[c] = [target]
+# Finds node names: a depclient.Client or a namesearch.NameIndex
+name_finder = None
+# The prefixes of the parents, the node and its prerequisites
+PREFIXES = ('', '  ', '    P: ', '    O: ')
 
 
 def readOneCmd(line):
@@ -50,94 +42,181 @@ def readOneCmd(line):
         result = result[:-1]
     return result
 
-def convert(fi):
-    logging.debug('Starting to parse')
-    l = ''
-    # Loop until start of files section (or EOF)
-    while True:
-        l = fi.readline()
-        if (not l) or (l == '# Files\n'):
-            break;
-
-    if not l:
-        return
-    # Process rules until done
-    while True:
-        # Move forward to the next rule
-        while True:
-            l = fi.readline()
-            if not l:
-                # EOF
-                break;
-            if l[0] == '#':
-                continue
-            if ':' in l:
-                break
-        if not l:
-            # EOF
-            break;
-        # Process this rule
-        (target, sep, prerequisites) = l.strip().partition(':')
-#        logging.debug('Rule: %s', l)
-# No, this check does not work. There are double-colon rules.
-#        if (target in all_targets):
-#            print 'Error: target {} already exists!'.format(target);
-#            sys.exit(1);
-
-        # We do not want .PHONY to show up as a node in the graph
-        cmds = []
-        if target != '.PHONY':
-            prereq_list = []
-            order_prereq_list = []
-            if prerequisites:
-                (order, sep2, order_only) = prerequisites.partition('|')
-                prereq_list = order.split()
-                add_to_child_list(prereq_list, target)
-                order_prereq_list = order_only.split()
-                add_to_child_list(order_prereq_list, target)
-
-        # Skip the comments below the rule
-        while True:
-            l = fi.readline()
-            if l[0] == '\t':
-                # Save this command, we might want to display it
-                nextCmd = l.strip()
-                if nextCmd:
-                    cmds.append(nextCmd)
-            if l[0] != '#' and l[0] != '\t':
-                # Done with this rule, save and go to next
-                if target != '.PHONY':
-                    all_targets[target] = (prereq_list, order_prereq_list, cmds)
-                break;
-    logging.debug('Done parsing')
-
+class VirtualList:
+    '''A list of lines in a Listbox which only holds the rows in view.
+       The lines can be any sequence, e.g. a NodeLines, so that a node
+       with tens of thousands of neighbours is shown as fast as any
+       other: Tk slows down badly with that many Listbox items.
+       The keys, the mouse wheel and the scrollbar move the view over
+       the lines, and the active line is the one to select.'''
+    def __init__(self, masterWindow, font='Courier'):
+        self.frame = Frame(masterWindow)
+        self.box = Listbox(self.frame, selectmode=SINGLE, font=font,
+                           exportselection=0)
+        self.bar = Scrollbar(self.frame, command=self.handleScroll)
+        self.bar.pack(side=RIGHT, fill=Y)
+        self.box.pack(side=LEFT, fill=BOTH, expand=1)
+        self.lineHeight = tkFont.Font(font=font).metrics('linespace')
+        self.lines = []
+        # Index of the line on the top row, and of the active line
+        self.top = 0
+        self.active = 0
+        self.rows = 1
+        self.box.bind('<Configure>', self.handleResize)
+        self.box.bind('<Button-1>', self.handleClick)
+        for (key, step) in (('<Up>', -1), ('<Down>', 1)):
+            self.box.bind(key, lambda event, step=step: self.move(step))
+        self.box.bind('<Prior>', lambda event: self.move(-self.rows))
+        self.box.bind('<Next>', lambda event: self.move(self.rows))
+        self.box.bind('<Home>', lambda event: self.moveTo(0))
+        self.box.bind('<End>', lambda event: self.moveTo(len(self.lines) - 1))
+        self.box.bind('<Button-4>', lambda event: self.scrollTo(self.top - 3))
+        self.box.bind('<Button-5>', lambda event: self.scrollTo(self.top + 3))
+        self.box.bind('<MouseWheel>', lambda event: self.scrollTo(
+            self.top - 3 * event.delta // abs(event.delta or 1)))
+
+    def setLines(self, lines, active=0):
+        '''Shows lines, with active as the active line. If it is not on
+           the first page, it is scrolled to the top row, or as high
+           as the end of the lines allows.'''
+        self.lines = lines
+        self.active = active
+        self.scrollTo(active if active >= self.rows else 0)
+
+    def activeName(self):
+        return self.lines.name(self.active)
+
+    def show(self):
+        '''Puts the rows in view into the Listbox'''
+        end = min(len(self.lines), self.top + self.rows)
+        self.box.delete(0, END)
+        rows = [self.lines[i] for i in xrange(self.top, end)]
+        if rows:
+            self.box.insert(END, *rows)
+        self.box.selection_clear(0, END)
+        if self.top <= self.active < end:
+            self.box.activate(self.active - self.top)
+            self.box.selection_set(self.active - self.top)
+        if self.lines:
+            self.bar.set(float(self.top) / len(self.lines),
+                         float(end) / len(self.lines))
+        else:
+            self.bar.set(0, 1)
+        return 'break'
+
+    def scrollTo(self, top):
+        self.top = max(0, min(top, len(self.lines) - self.rows))
+        return self.show()
+
+    def moveTo(self, i):
+        '''Makes line i the active line, and scrolls it into view'''
+        self.active = max(0, min(i, len(self.lines) - 1))
+        if self.active < self.top:
+            self.top = self.active
+        elif self.active >= self.top + self.rows:
+            self.top = self.active - self.rows + 1
+        return self.show()
+
+    def move(self, step):
+        return self.moveTo(self.active + step)
+
+    def handleClick(self, event):
+        self.box.focus_set()
+        return self.moveTo(self.top + self.box.nearest(event.y))
+
+    def handleScroll(self, *args):
+        if args[0] == 'moveto':
+            self.scrollTo(int(float(args[1]) * len(self.lines)))
+        elif args[0] == 'scroll':
+            unit = self.rows if args[2] == 'pages' else 1
+            self.scrollTo(self.top + int(args[1]) * unit)
+
+    def handleResize(self, event):
+        # Leave out the border of the Listbox
+        rows = max(1, (event.height - 4) // self.lineHeight)
+        if rows != self.rows:
+            self.rows = rows
+            self.scrollTo(self.top)
+
+
+class MatchLines(list):
+    '''The node names found by a search, as lines of a VirtualList'''
+    def name(self, i):
+        return self[i]
+
+
+def getNameFinder():
+    '''Returns name_finder, making the namesearch.NameIndex of the
+       graph the first time'''
+    global name_finder
+    if name_finder is None:
+        names = namesearch.graph_names(all_targets, all_children)
+        name_finder = namesearch.load(args.file or args.save, names,
+                                      not args.no_cache)
+    return name_finder
+
+
+class FindWindow:
+    '''Type-ahead search of a node, in a window of its own. The nodes
+       matching the text of the entry are listed as it is typed: the
+       ones starting with it first, then the ones containing it, then
+       the ones with a similar name. Enter shows the active one.'''
+    MAX_MATCHES = 1000
+
+    def __init__(self, masterWindow, finder, select):
+        self.finder = finder
+        self.select = select
+        self.win = Toplevel(masterWindow)
+        self.win.title('Find node')
+        self.text = StringVar()
+        self.entry = Entry(self.win, textvariable=self.text, font='Courier')
+        self.entry.pack(fill=X)
+        self.list = VirtualList(self.win)
+        self.list.frame.pack(fill=BOTH, expand=1)
+        self.text.trace('w', self.handleText)
+        for widget in (self.entry, self.list.box):
+            widget.bind('<Return>', self.handleSelect)
+            widget.bind('<Escape>', lambda event: self.win.destroy())
+        self.entry.bind('<Up>', lambda event: self.list.move(-1))
+        self.entry.bind('<Down>', lambda event: self.list.move(1))
+        self.entry.focus_set()
+
+    def handleText(self, *args):
+        matches = self.finder.find(self.text.get(), 'any', self.MAX_MATCHES)
+        self.list.setLines(MatchLines(matches))
+
+    def handleSelect(self, event):
+        if self.list.lines:
+            node = self.list.activeName()
+            self.win.destroy()
+            self.select(node)
+        return 'break'
 
 
 class SelectionWindow:
     def __init__(self, masterWindow, cmdWindow):
-        self.win = Listbox(masterWindow, 
-                           selectmode=SINGLE,
-                           font='Courier')
+        self.list = VirtualList(masterWindow)
+        self.win = self.list.frame
         self.cmdWin = cmdWindow
-        self.win.bind('<Return>', self.handleKey)
+        self.list.box.bind('<Return>', self.handleKey)
+        self.list.box.bind('/', self.handleFind)
                
     def handleKey(self, event):
-        l = self.win.get(ACTIVE).split(':')[-1].strip()
+        l = self.list.activeName()
         self.update(l, all_targets, all_children)
 
+    def handleFind(self, event):
+        FindWindow(self.win, getNameFinder(), lambda node: self.update(
+            node, all_targets, all_children))
+        return 'break'
+
     def update(self, node, targets, children):
-        self.win.delete(0, END)
         parents = children[node] if node in children else []
-        (order, order_only, cmds) = targets[node]
-        all_lines = parents
-        all_lines.append('  ' + node)
-        all_lines.extend(['    P: ' + x for x in order])
-        all_lines.extend(['    O: ' + x for x in order_only])
-        for l in all_lines:
-            self.win.insert(END, l)
-        target_ix = len(parents)
-        self.win.activate(target_ix)
-        self.win.see(target_ix)
+        # A node without a rule has no prerequisites
+        (order, order_only, cmds) = targets.get(node, ([], [], []))
+        all_lines = nodelines.NodeLines(node, parents, order, order_only,
+                                        PREFIXES)
+        self.list.setLines(all_lines, len(parents))
         self.cmdWin.update(cmds)
 
 
@@ -149,6 +228,11 @@ class CmdWindow:
     def update(self, cmds):
         self.win.config(state=NORMAL)
         self.win.delete(1.0, END)
+        try:
+            # Decode the commands, if they are still in the database
+            cmds = list(cmds)
+        except makedb.DatabaseChanged as e:
+            cmds = ['<{}>'.format(e)]
         for l in cmds:
             self.win.insert(END, l)
         self.win.config(state=DISABLED)
@@ -172,13 +256,29 @@ def main():
            * up/down keys to move the cursor to the desired node.
            * pgup/pgdn keys to move one page at a time.
            * home/end keys to move to the beginning/end of the list
-           * Enter key to make the selected node the new target.'''))
+           * Enter key to make the selected node the new target.
+           * / key to find a node by typing a part of its name.'''))
 
     parser.add_argument('node')
     parser.add_argument('-f', '--file', action='store',
-                        help='make file to parse', required=True)
+                        help='make file to parse (may be gzip compressed)')
+    parser.add_argument('-m', '--make', action='store', metavar='ARGS',
+                        help='run "make -qpR ARGS" and parse its output '
+                             'instead of a file')
+    parser.add_argument('-s', '--save', action='store',
+                        help='with -m, also save the make database in this '
+                             'file. A name ending with .gz compresses it.')
+    parser.add_argument('-S', '--server', action='store', metavar='SOCKET',
+                        help='ask the depserver.py server listening on '
+                             'SOCKET, instead of loading the database')
     parser.add_argument('-l', '--logfile', action='store',
                         help='optional file to store diagnostics in')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        default=False,
+                        help='do not use or write the index file make.db.idx')
 
     global args
     args = parser.parse_args()
@@ -186,15 +286,33 @@ def main():
     if args.logfile:
         logging.basicConfig(filename=args.logfile, level=logging.DEBUG)
 
-    if not args.file:
+    if not args.file and args.make is None and not args.server:
         print 'You must specify a file to parse!'
         sys.exit(1)
 
 
-    with open(args.file, 'r') as fi:
-        print 'Opening file ' + args.file
+    global all_targets, all_children, name_finder
+    if args.server:
+        try:
+            client = depclient.Client(args.server)
+        except depclient.ServerError as e:
+            print 'Error: {}'.format(e)
+            sys.exit(1)
+        (all_targets, all_children) = depclient.views(client, True)
+        name_finder = client
+    elif args.make is not None:
+        print 'Running make -qpR ' + args.make
         print 'Parsing make database. This may take a while.\n'
-        convert(fi)
+        store = graphcache.load_store_from_make(args.make, args.save,
+                                                not args.no_cache)
+        (all_targets, all_children) = graphstore.views(store)
+    else:
+        print 'Opening file ' + args.file
+        use_cache = not args.no_cache
+        if not (use_cache and graphcache.is_current(args.file)):
+            print 'Parsing make database. This may take a while.\n'
+        (all_targets, all_children) = graphcache.load(args.file, use_cache,
+                                                      args.jobs or None)
     if not args.node in all_targets:
         print 'Error: target {} not in any rule'.format(args.node)
         sys.exit(1)
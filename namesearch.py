@@ -0,0 +1,212 @@
+'''Search of the node names of a make database.
+
+   The names are kept sorted, so the names starting with a prefix are
+   found by bisection. For substrings, every name is listed under
+   each trigram (sequence of three characters) it contains: a name
+   containing the query contains all trigrams of the query, so only
+   the names listed under the rarest of them are compared with it.
+   A fuzzy match is a name sharing most trigrams with the query,
+   which finds names despite a typo or a missing part.
+
+   Building the trigram lists takes a few seconds for a large build,
+   so they are saved next to the database (make.db -> make.db.names),
+   and later searches start in milliseconds.'''
+
+import os
+import math
+import bisect
+import marshal
+import logging
+import array
+import itertools
+
+import graphcache
+
+VERSION = 1
+GRAM = 3
+# The share of the trigrams of a query which a fuzzy match must have
+FUZZY_SHARE = 0.5
+# The number of names compared with a fuzzy query. Queries made of
+# common trigrams need a larger share, to stay below it.
+FUZZY_CANDIDATES = 20000
+# any: prefix matches first, then other substring matches, then fuzzy
+# matches
+MODES = ['any', 'prefix', 'substring', 'fuzzy']
+
+
+def trigrams(text):
+    '''Returns the set of the trigrams of text'''
+    return set([text[k:k + GRAM] for k in xrange(len(text) - GRAM + 1)])
+
+
+def build_grams(names):
+    '''Returns a dictionary from each trigram to the array of the
+       indexes of the names containing it, in increasing order. A
+       name shorter than a trigram is listed under itself.'''
+    grams = {}
+    for (i, name) in enumerate(names):
+        for g in trigrams(name) if len(name) >= GRAM else [name]:
+            ids = grams.get(g)
+            if ids is None:
+                ids = grams[g] = array.array('i')
+            ids.append(i)
+    return grams
+
+
+class NameIndex:
+    '''The sorted sequence names, with its trigram lists. The
+       searches return indexes into names.'''
+    def __init__(self, names, grams=None):
+        self.names = names
+        if grams is None:
+            grams = build_grams(names)
+        self.grams = grams
+
+    def postings(self, gram):
+        return self.grams.get(gram, ())
+
+    def prefix(self, text):
+        '''Yields the names starting with text, in sorted order'''
+        names = self.names
+        i = bisect.bisect_left(names, text)
+        while i < len(names) and names[i].startswith(text):
+            yield i
+            i += 1
+
+    def substring(self, text):
+        '''Yields the names containing text, in sorted order'''
+        if not text:
+            return
+        names = self.names
+        if len(text) < GRAM:
+            # Most names contain a short text, so comparing all of
+            # them is faster than merging the lists of the trigrams
+            # containing it
+            candidates = xrange(len(names))
+        else:
+            lists = [self.postings(g) for g in trigrams(text)]
+            candidates = min(lists, key=len)
+        for i in candidates:
+            if text in names[i]:
+                yield i
+
+    def fuzzy(self, text):
+        '''Returns the names sharing at least FUZZY_SHARE of the
+           trigrams of text, the ones sharing most first, and then
+           the shorter ones. A text shorter than a trigram has to be
+           a substring.'''
+        grams = trigrams(text)
+        if not grams:
+            return self.substring(text)
+        need = max(1, int(math.ceil(len(grams) * FUZZY_SHARE)))
+        # A name sharing need trigrams has one of the len(grams) -
+        # need + 1 rarest ones
+        lists = sorted((self.postings(g) for g in grams), key=len)
+        candidates = set()
+        used = 0
+        for ids in lists[:len(grams) - need + 1]:
+            if used and len(candidates) + len(ids) > FUZZY_CANDIDATES:
+                break
+            # For a query made of very common trigrams, only the first
+            # names of the rarest one are compared
+            candidates.update(ids[:FUZZY_CANDIDATES])
+            used += 1
+        need = max(need, len(grams) - used + 1)
+        scored = []
+        for i in candidates:
+            name = self.names[i]
+            shared = sum(1 for g in grams if g in name)
+            if shared >= need:
+                scored.append((-shared, len(name), i))
+        scored.sort()
+        return [i for (shared, length, i) in scored]
+
+    def search(self, text, mode='any', limit=0):
+        '''Returns up to limit (0 = all) indexes of the names matching
+           text in mode, one of MODES'''
+        if mode == 'prefix':
+            found = self.prefix(text)
+        elif mode == 'substring':
+            found = self.substring(text)
+        elif mode == 'fuzzy':
+            found = self.fuzzy(text)
+        elif mode == 'any':
+            found = self.any(text)
+        else:
+            raise ValueError('unknown search mode {}'.format(mode))
+        return list(itertools.islice(found, limit or None))
+
+    def any(self, text):
+        '''Yields the matches of all modes, best first'''
+        if not text:
+            return
+        seen = set()
+        for found in (self.prefix(text), self.substring(text)):
+            for i in found:
+                if i not in seen:
+                    seen.add(i)
+                    yield i
+        if len(text) < GRAM:
+            return
+        for i in self.fuzzy(text):
+            if i not in seen:
+                yield i
+
+    def find(self, text, mode='any', limit=0):
+        '''Same as search(), but returns the names'''
+        return [self.names[i] for i in self.search(text, mode, limit)]
+
+
+def graph_names(all_targets, all_children):
+    '''Returns the sorted names of the nodes of a graph, given as the
+       dictionaries all_targets and all_children or as views of a
+       graphstore.GraphStore or graphcache.GraphIndex'''
+    store = getattr(all_targets, 'store', None)
+    if store is None:
+        return sorted(set(all_targets).union(all_children))
+    return store_names(store)
+
+
+def store_names(store):
+    '''Returns the sorted node names of a graphstore.GraphStore or
+       graphcache.GraphIndex, as a list'''
+    if isinstance(store, graphcache.GraphIndex):
+        return store.name_list()
+    return store.names
+
+
+def cache_path(db_path):
+    return db_path + '.names'
+
+
+def load(db_path, names, use_cache=True):
+    '''Returns the NameIndex of names, the sorted node names of the
+       database db_path, with the trigram lists of the file
+       make.db.names if it is up to date. Without db_path, the lists
+       are built and not saved.'''
+    if not (db_path and use_cache):
+        return NameIndex(names)
+    key = (graphcache.db_key(db_path), len(names))
+    path = cache_path(db_path)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as fi:
+                (version, cached_key, data) = marshal.load(fi)
+            if version == VERSION and cached_key == key:
+                return NameIndex(names, dict(
+                    (g, graphcache.from_ints('i', ids))
+                    for (g, ids) in data.iteritems()))
+            logging.info('Name index %s is out of date', path)
+        except (EOFError, ValueError, TypeError) as e:
+            logging.info('Ignoring name index %s: %s', path, e)
+    index = NameIndex(names)
+    data = dict((g, graphcache.int_array('i', ids))
+                for (g, ids) in index.grams.iteritems())
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fo:
+            marshal.dump((VERSION, key, data), fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logging.info('Could not write name index: %s', e)
+    return index
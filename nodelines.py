@@ -0,0 +1,32 @@
+'''The list of lines shown for a node by makeview.py and mrwalker.py.'''
+
+# The prefixes of the parents (U:), the node itself (T:) and its
+# prerequisites (P:) and order-only prerequisites (O:) in makeview.py
+PREFIXES = ('U: ', ' T: ', '  P: ', '  O: ')
+
+
+class NodeLines:
+    '''The lines shown for a node: its parents, the node itself and its
+       prerequisites, each one after its prefix in prefixes, as a
+       read-only list. A line is only made when it is shown, from the
+       lists in all_children and all_targets, so that a node with
+       thousands of parents takes no longer to show than any other.'''
+    def __init__(self, node, parents, order, order_only, prefixes=PREFIXES):
+        self.parts = zip(prefixes, [parents, [node], order, order_only])
+
+    def __len__(self):
+        return sum(len(names) for (prefix, names) in self.parts)
+
+    def locate(self, i):
+        for (prefix, names) in self.parts:
+            if i < len(names):
+                return (prefix, names[i])
+            i -= len(names)
+        raise IndexError(i)
+
+    def __getitem__(self, i):
+        (prefix, name) = self.locate(i)
+        return prefix + name
+
+    def name(self, i):
+        return self.locate(i)[1]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+'''Measures the throughput of the make database parser in makedb.py,
+   and checks that its output is identical to the one of the old
+   line-by-line parser, apart from the second colon of double-colon
+   rules, which the old parser took for a prerequisite.'''
+
+import argparse
+import logging
+import os
+import sys
+import time
+import textwrap
+
+import makedb
+
+
+# The state of the old parser, which kept its results in globals
+all_targets = {}
+# Lookup from prerequisite to target
+all_children = {}
+
+
+# add_to_child_list() and convert() are copied unchanged from the
+# makeview.py which came before makedb.py, and kept as a reference.
+def add_to_child_list(children, target):
+    for c in children:
+        if c in all_children:
+            # Child already has a parent. Append to existing list
+            all_children[c].append(target)
+        else:
+            # First parent. Create a list
+            all_children[c] = [target]
+
+
+def convert(fi):
+    logging.debug('Starting to parse')
+    l = ''
+    # Loop until start of files section (or EOF)
+    while True:
+        l = fi.readline()
+        if (not l) or (l == '# Files\n'):
+            break;
+
+    if not l:
+        return
+    # Process rules until done
+    while True:
+        # Move forward to the next rule
+        while True:
+            l = fi.readline()
+            if not l:
+                # EOF
+                break;
+            if l[0] == '#':
+                continue
+            if ':' in l:
+                break
+        if not l:
+            # EOF
+            break;
+        # Process this rule
+        (target, sep, prerequisites) = l.strip().partition(':')
+#        logging.debug('Rule: %s', l)
+# No, this check does not work. There are double-colon rules.
+#        if (target in all_targets):
+#            print 'Error: target {} already exists!'.format(target);
+#            sys.exit(1);
+
+        # We do not want .PHONY to show up as a node in the graph
+        cmds = []
+        if target != '.PHONY':
+            prereq_list = []
+            order_prereq_list = []
+            if prerequisites:
+                (order, sep2, order_only) = prerequisites.partition('|')
+                prereq_list = order.split()
+                add_to_child_list(prereq_list, target)
+                order_prereq_list = order_only.split()
+                add_to_child_list(order_prereq_list, target)
+
+        # Skip the comments below the rule
+        while True:
+            l = fi.readline()
+            if l[0] == '\t':
+                # Save this command, we might want to display it
+                nextCmd = l.strip()
+                if nextCmd:
+                    cmds.append(nextCmd)
+            if l[0] != '#' and l[0] != '\t':
+                # Done with this rule, save and go to next
+                if target != '.PHONY':
+                    all_targets[target] = (prereq_list, order_prereq_list, cmds)
+                break;
+    logging.debug('Done parsing')
+
+
+def drop_double_colons(targets, children):
+    '''Removes the second colon of double-colon rules, which the old
+       parser kept as a prerequisite, from its results. This is the
+       one known difference with makedb.py.'''
+    for (t, (order, order_only, cmds)) in targets.items():
+        if ':' in order:
+            targets[t] = ([p for p in order if p != ':'], order_only, cmds)
+    children.pop(':', None)
+
+
+def timed(name, size, func, *args):
+    start = time.time()
+    result = func(*args)
+    elapsed = max(time.time() - start, 1e-6)
+    print '{:10} {:8.2f} s {:8.1f} MB/s'.format(name, elapsed,
+                                               size / elapsed / 1e6)
+    return result
+
+
+def run_new(path):
+    with open(path, 'r') as fi:
+        return makedb.load(fi)
+
+
+def run_legacy(path):
+    global all_targets, all_children
+    all_targets = {}
+    all_children = {}
+    with open(path, 'r') as fi:
+        convert(fi)
+    return (all_targets, all_children)
+
+
+def run_parallel(path, jobs):
+    return makedb.load_parallel(path, jobs)
+
+
+def run_stream(path):
+    n = 0
+    with open(path, 'r') as fi:
+        for r in makedb.parse_rules(fi):
+            n += 1
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Benchmarks makedb.py on a database created by "make -qpR".
+           Prints the throughput of the rule stream, of the complete
+           conversion into all_targets/all_children, and of the old
+           line-by-line parser. With -j, the parallel parser is also
+           measured. Exits with status 1 if the results of any of the
+           parsers differ. The old parser took the second colon of
+           double-colon rules for a prerequisite; it is removed from
+           its results before they are compared.'''))
+    parser.add_argument('-f', '--file', action='store',
+                        help='make database to parse', required=True)
+    parser.add_argument('--no-legacy', action='store_true',
+                        help='do not run the old parser')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='also run the parallel parser with this many '
+                             'processes, and compare it with the serial one')
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.file)
+    print 'Database size: {:.1f} MB'.format(size / 1e6)
+    n = timed('stream', size, run_stream, args.file)
+    print '{:10} {} rules'.format('', n)
+    new = timed('convert', size, run_new, args.file)
+    if args.jobs:
+        par = timed('parallel', size, run_parallel, args.file, args.jobs)
+        if par != new:
+            print 'Error: parallel and serial results differ!'
+            sys.exit(1)
+    if args.no_legacy:
+        return
+    old = timed('legacy', size, run_legacy, args.file)
+    drop_double_colons(*old)
+    if new != old:
+        print 'Error: results differ!'
+        sys.exit(1)
+    print 'Results are identical'
+
+if __name__ == "__main__":
+    main()
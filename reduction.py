@@ -0,0 +1,81 @@
+'''Transitive reduction of a dependency graph.
+
+   An edge a -> c is redundant when c is also reached from a through
+   another prerequisite b, e.g. a phony module target pointing both at
+   the installed file and at the intermediate file it is copied from.
+   Leaving the redundant edges out keeps every dependency visible as a
+   path, with far fewer edges for dot to lay out.
+
+   The nodes are numbered in depth-first post-order, so that the
+   prerequisites of a node are numbered before it, and the nodes
+   reachable from a node are kept as a bitset: a long with one bit per
+   node number. The bitset of a node is dropped as soon as all its
+   parents are handled.
+   Edges closing a dependency cycle are always kept, and are not
+   counted as paths.'''
+
+import collections
+
+
+def post_order(succ):
+    '''Returns (nodes in depth-first post-order, set of the edges
+       closing a cycle) of the graph succ, a dictionary from node to
+       its successors'''
+    state = {}
+    order = []
+    back = set()
+    for root in succ:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(succ[root]))]
+        while stack:
+            (v, successors) = stack[-1]
+            for w in successors:
+                if w not in state:
+                    state[w] = 1
+                    stack.append((w, iter(succ.get(w, ()))))
+                    break
+                if state[w] == 1:
+                    back.add((v, w))
+            else:
+                stack.pop()
+                state[v] = 2
+                order.append(v)
+    return (order, back)
+
+
+def redundant_edges(edges):
+    '''Returns the set of the redundant edges among edges, an iterable
+       of (source, destination) pairs'''
+    succ = collections.defaultdict(list)
+    for (s, d) in edges:
+        if s != d:
+            succ[s].append(d)
+    (order, back) = post_order(succ)
+    number = dict((v, i) for (i, v) in enumerate(order))
+    dag = {}
+    parents = collections.Counter()
+    for (v, successors) in succ.iteritems():
+        dag[v] = [w for w in set(successors) if (v, w) not in back]
+        parents.update(dag[v])
+    # Node -> bitset of the nodes reachable from it, not counting itself
+    reach = {}
+    redundant = set()
+    for v in order:
+        successors = dag.get(v, ())
+        below = 0
+        for w in successors:
+            below |= reach.get(w, 0)
+        mine = below
+        for w in successors:
+            bit = 1 << number[w]
+            if below & bit:
+                redundant.add((v, w))
+            mine |= bit
+            parents[w] -= 1
+            if not parents[w]:
+                reach.pop(w, None)
+        if parents[v]:
+            reach[v] = mine
+    return redundant
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''Shows the targets whose recipe runs a tool or passes a flag'''
+
+import argparse
+import sys
+import textwrap
+
+import cmdindex
+import graphcache
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Finds the targets of a database created by "make -qpR"
+           with a command line holding all the given words, e.g.
+             showcmd.py -f make.db javac -- -g
+           and prints each of them, followed by the matching command
+           lines. A word matches a word of the command, the last part
+           of a path (javac matches prebuilts/jdk/bin/javac), or the
+           name of an option with a value (-std matches -std=c++11).
+           A word ending with * matches the words starting with the
+           rest of it, e.g. '-W*'. Words starting with - must follow
+           "--", or be quoted together with a word which does not.
+           The command index is saved in make.db.cmds, so only the
+           first search has to read all commands.'''))
+    parser.add_argument('words', nargs='+')
+    parser.add_argument('-f', '--file', action='store', required=True,
+                        help='make database to read')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='only print the names of the targets')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write make.db.idx and '
+                             'make.db.cmds')
+    args = parser.parse_args()
+
+    store = graphcache.load_store(args.file, not args.no_cache,
+                                  args.jobs or None)
+    index = cmdindex.load(args.file, store, not args.no_cache)
+    query = cmdindex.query_words(' '.join(args.words))
+    try:
+        found = index.search(store, query)
+    except ValueError as e:
+        sys.exit('Error: {}'.format(e))
+    for (i, lines) in found:
+        print store.name(i)
+        if not args.list:
+            for l in lines:
+                print '    ' + l
+    if not found:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,24 @@
 '''extracts dependencies to a node from a dot graph'''
 
 import os
+import sys
 import subprocess
 import argparse
+import collections
+import itertools
+import multiprocessing
+import shlex
+import StringIO
+
+import cmdindex
+import depclient
+import graphcache
+import graphstore
+import make2dot
+import namesearch
+import reduction
+import subgraph
+
 
 def filter(node, direction, mode, depth):
     script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -18,12 +34,284 @@ def filter(node, direction, mode, depth):
     p = subprocess.Popen(cmd_args)
     out, err = p.communicate()
 
-def main():
-    usage = '''A filter which produces a subgraph containing the recursive
-               targets or prerequisites of a make target.
-               The filter makes use of the gvpr command internally.'''
-    parser = argparse.ArgumentParser(description=usage)
-    parser.add_argument('node')
+
+def neighbours(store, i, direction):
+    '''Returns the prerequisites (down) or the parents (up) of node i'''
+    if direction == 'down':
+        (order, order_only) = store.prerequisites(i)
+        return order + order_only
+    return store.parents(i)
+
+
+def edges(store, i, direction):
+    '''Yields (source, destination, order_only) for the edges of node i,
+       in the direction of the make graph'''
+    if direction == 'down':
+        (order, order_only) = store.prerequisites(i)
+        for p in order:
+            yield (i, p, False)
+        for p in order_only:
+            yield (i, p, True)
+    else:
+        for p in store.parents(i):
+            yield (p, i, store.is_order_only(p, i))
+
+
+def walk(store, root, direction, depth=0, bfs=False):
+    '''Yields (node, level) once for each node reachable from root,
+       in depth-first pre-order or in breadth-first order.
+       Nodes beyond depth levels are not visited (0 means no limit).'''
+    seen = set()
+    todo = collections.deque([(root, 0)])
+    pop = todo.popleft if bfs else todo.pop
+    while todo:
+        (i, level) = pop()
+        if i in seen:
+            continue
+        seen.add(i)
+        yield (i, level)
+        if depth and level >= depth:
+            continue
+        nb = neighbours(store, i, direction)
+        if not bfs:
+            # Visit the neighbours in their original order
+            nb.reverse()
+        todo.extend([(j, level + 1) for j in nb])
+
+
+class PathFinder:
+    '''Answers "why does a depend on b" questions: finds the shortest
+       chain of prerequisites from one node to another, with a
+       bidirectional breadth-first search. Results are remembered,
+       so that later queries in the same run reuse earlier work:
+       * the tails of found chains are shortest chains themselves
+       * a search that visits all descendants of its source (or all
+         ancestors of its destination) answers every later query
+         from that source (to that destination)'''
+    def __init__(self, store):
+        self.store = store
+        self.paths = {}
+        self.descendants = {}
+        self.ancestors = {}
+
+    def path(self, src, dst):
+        '''Returns the list of nodes from src to dst, or None'''
+        key = (src, dst)
+        if key in self.paths:
+            return self.paths[key]
+        if src in self.descendants and dst not in self.descendants[src]:
+            return None
+        if dst in self.ancestors and src not in self.ancestors[dst]:
+            return None
+        path = self.search(src, dst)
+        if path:
+            for i in xrange(len(path)):
+                self.paths[(path[i], dst)] = path[i:]
+        else:
+            self.paths[key] = None
+        return path
+
+    def reaches(self, src, dst):
+        return self.path(src, dst) is not None
+
+    def search(self, src, dst):
+        if src == dst:
+            return [src]
+        # Each side maps the nodes it has seen to the node it came from
+        fwd = {src: None}
+        bwd = {dst: None}
+        fwd_front = [src]
+        bwd_front = [dst]
+        while fwd_front and bwd_front:
+            # Expand the smaller frontier
+            if len(fwd_front) <= len(bwd_front):
+                (fwd_front, meet) = self.expand(fwd_front, fwd, bwd, 'down')
+            else:
+                (bwd_front, meet) = self.expand(bwd_front, bwd, fwd, 'up')
+            if meet is not None:
+                return self.join(meet, fwd, bwd)
+        if not fwd_front:
+            self.descendants[src] = frozenset(fwd)
+        else:
+            self.ancestors[dst] = frozenset(bwd)
+        return None
+
+    def expand(self, front, seen, other, direction):
+        '''Visits the neighbours of one BFS level. Returns the next
+           level, and a node seen from both sides, if any.'''
+        next_front = []
+        for i in front:
+            for j in neighbours(self.store, i, direction):
+                if j in seen:
+                    continue
+                seen[j] = i
+                if j in other:
+                    return (next_front, j)
+                next_front.append(j)
+        return (next_front, None)
+
+    def join(self, meet, fwd, bwd):
+        path = []
+        i = meet
+        while i is not None:
+            path.append(i)
+            i = fwd[i]
+        path.reverse()
+        i = bwd[meet]
+        while i is not None:
+            path.append(i)
+            i = bwd[i]
+        return path
+
+
+def print_path(store, path, mode, out):
+    '''Prints a chain of prerequisites, as an indented list or as
+       a dot graph'''
+    if mode == 'indent':
+        for (level, i) in enumerate(path):
+            out.write(' ' * level + store.name(i) + '\n')
+        return
+    lines = ['digraph out {']
+    for k in xrange(len(path) - 1):
+        (s, d) = (path[k], path[k + 1])
+        line = '{} -> {}'.format(make2dot.make_id(store.name(s)),
+                                 make2dot.make_id(store.name(d)))
+        if not d in store.prerequisites(s)[0]:
+            line += ' [style=dotted]'
+        lines.append(line + ';')
+    lines.append('}')
+    out.write('\n'.join(lines) + '\n')
+
+
+def leading_to(store, walked, targets, direction):
+    '''Returns the set of the nodes of walked, an iterable of (node id,
+       level), from which one of targets is reached through nodes of
+       walked, including those of targets'''
+    inside = set(i for (i, level) in walked)
+    back = collections.defaultdict(list)
+    for i in inside:
+        for j in neighbours(store, i, direction):
+            if j in inside:
+                back[j].append(i)
+    keep = inside.intersection(targets)
+    todo = list(keep)
+    while todo:
+        for i in back[todo.pop()]:
+            if i not in keep:
+                keep.add(i)
+                todo.append(i)
+    return keep
+
+
+def print_indent(store, root, direction, depth, bfs, out, keep=None):
+    '''Prints the visited nodes, or only those of keep, indented by
+       their level'''
+    for (i, level) in walk(store, root, direction, depth, bfs):
+        if keep is None or i in keep:
+            out.write(' ' * level + store.name(i) + '\n')
+
+
+def print_graph(store, root, direction, depth, bfs, out, reduce=False,
+                keep=None):
+    '''Prints the visited subgraph in the dot language. With reduce,
+       its transitive reduction. With keep, only the nodes in keep.'''
+    # (node, its edges) in the order visited
+    visited = []
+    for (i, level) in walk(store, root, direction, depth, bfs):
+        if keep is not None and i not in keep:
+            continue
+        if depth and level >= depth:
+            visited.append((i, []))
+        elif keep is not None:
+            visited.append((i, [(s, d, o) for (s, d, o) in
+                                edges(store, i, direction)
+                                if s in keep and d in keep]))
+        else:
+            visited.append((i, list(edges(store, i, direction))))
+    redundant = ()
+    if reduce:
+        redundant = reduction.redundant_edges(
+            (s, d) for (i, node_edges) in visited
+            for (s, d, order_only) in node_edges)
+    lines = ['digraph out {']
+    for (i, node_edges) in visited:
+        for (s, d, order_only) in node_edges:
+            if (s, d) in redundant:
+                continue
+            line = '{} -> {}'.format(make2dot.make_id(store.name(s)),
+                                     make2dot.make_id(store.name(d)))
+            if order_only:
+                line += ' [style=dotted]'
+            lines.append(line + ';')
+        attrs = make2dot.create_attr_list(
+            store.flags(i) & graphstore.IS_PHONY)
+        lines.append('{} {};'.format(make2dot.make_id(store.name(i)), attrs))
+    lines.append('}')
+    out.write('\n'.join(lines) + '\n')
+
+
+def query(store, node, direction, mode, depth, bfs=False, out=sys.stdout,
+          err=sys.stderr, limits=None, reduce=False, targets=None):
+    '''Same as filter(), but uses a graph loaded into this process.
+       A dot graph is reduced according to limits, a subgraph.Limits,
+       if given, and to its transitive reduction with reduce.
+       If targets is given, only the nodes leading to one of them
+       are kept.'''
+    root = store.lookup(node)
+    if root < 0:
+        err.write('Error: {} is not in the graph\n'.format(node))
+        return False
+    keep = None
+    if targets is not None:
+        keep = leading_to(store, walk(store, root, direction, depth),
+                          targets, direction)
+        if not keep:
+            err.write('No command reached from {} matches\n'.format(node))
+            return False
+    if mode == 'indent':
+        print_indent(store, root, direction, depth, bfs, out, keep)
+    elif limits:
+        walked = walk(store, root, direction, depth, True)
+        if keep is not None:
+            walked = [(i, level) for (i, level) in walked if i in keep]
+        sub = subgraph.extract(store, walked, limits)
+        if reduce:
+            sub.reduce()
+        sub.write_dot(out)
+    else:
+        print_graph(store, root, direction, depth, bfs, out, reduce, keep)
+    return True
+
+
+def query_path(finder, node, other, direction, mode, reach_only=False,
+               out=sys.stdout, err=sys.stderr):
+    '''Prints the shortest chain of prerequisites from node down to
+       other (direction down), or from other down to node (up).
+       With reach_only, just prints yes or no.
+       Returns True if there is such a chain.'''
+    store = finder.store
+    ids = []
+    for name in (node, other):
+        ids.append(store.lookup(name))
+        if ids[-1] < 0:
+            err.write('Error: {} is not in the graph\n'.format(name))
+            return False
+    if direction == 'up':
+        ids.reverse()
+    path = finder.path(ids[0], ids[1])
+    if reach_only:
+        out.write('yes\n' if path else 'no\n')
+    elif path:
+        print_path(store, path, mode, out)
+    else:
+        err.write('{} does not depend on {}\n'.format(
+            store.name(ids[0]), store.name(ids[1])))
+    return path is not None
+
+
+def add_query_arguments(parser):
+    '''Adds the options describing one query. They are used both on
+       the command line and on each line of a batch file.'''
     parser.add_argument('-r', '--reverse', action='store_true',
                         help='traverse graph backwards')
     parser.add_argument('-i', '--indent', action='store_true',
@@ -31,7 +319,44 @@ def main():
     parser.add_argument('-d', '--depth', type=int,
                         default=0,
                         help='number of levels to descend.')
-    args = parser.parse_args()
+    parser.add_argument('-p', '--path', action='store', metavar='NODE',
+                        help='print the shortest chain of prerequisites from '
+                             'node to NODE (with -r: from NODE to node). '
+                             'Needs -f or -S.')
+    parser.add_argument('--reach', action='store', metavar='NODE',
+                        help='print yes if node depends on NODE, '
+                             'directly or not, and no otherwise '
+                             '(with -r: if NODE depends on node). '
+                             'Needs -f or -S.')
+    parser.add_argument('--bfs', action='store_true',
+                        help='traverse breadth-first instead of depth-first '
+                             '(only used with -f or -S)')
+    parser.add_argument('--max-nodes', type=int, default=0,
+                        help='keep at most this many nodes of a dot graph, '
+                             'the ones closest to node. Needs -f or -S.')
+    parser.add_argument('--max-edges', type=int, default=0,
+                        help='keep at most this many edges of a dot graph. '
+                             'Needs -f or -S.')
+    parser.add_argument('--collapse', type=int, metavar='N',
+                        help='replace each group of at least N nodes in '
+                             'the same directory and with the same suffix '
+                             'by one node in a dot graph (default: {} with '
+                             '--max-nodes or --max-edges, 0 = never). '
+                             'Needs -f or -S.'.format(subgraph.COLLAPSE))
+    parser.add_argument('--reduce', action='store_true',
+                        help='leave out the edges of a dot graph which are '
+                             'implied by other paths (transitive '
+                             'reduction). Needs -f or -S.')
+    parser.add_argument('--cmd', action='store', metavar='WORDS',
+                        help='only keep the nodes with a command line '
+                             'holding all WORDS, as with showcmd.py, and '
+                             'the nodes leading to them, e.g. '
+                             '--cmd "javac -g" or --cmd=-Werror. Needs -f '
+                             'or -S.')
+
+
+def query_mode(args):
+    '''Returns (direction, mode) of the query in args'''
     if args.reverse:
         direction = 'up'
     else:
@@ -40,7 +365,275 @@ def main():
         mode = 'indent'
     else:
         mode = 'graph'
-    filter(args.node, direction, mode, args.depth)
+    return (direction, mode)
+
+
+def query_limits(args):
+    '''Returns the subgraph.Limits of the query in args, or None'''
+    collapse = args.collapse
+    if collapse is None:
+        if not (args.max_nodes or args.max_edges):
+            return None
+        collapse = subgraph.COLLAPSE
+    return subgraph.Limits(args.max_nodes, args.max_edges, collapse)
+
+
+def run_query(finder, args, out=sys.stdout, err=sys.stderr, cmds=None):
+    '''Runs the query described by args on the graph of finder.
+       cmds returns the cmdindex.CmdIndex of the graph, for --cmd.
+       Returns True if it succeeded.'''
+    (direction, mode) = query_mode(args)
+    if args.path or args.reach:
+        return query_path(finder, args.node, args.path or args.reach,
+                          direction, mode, args.reach is not None, out, err)
+    targets = None
+    if args.cmd:
+        if not cmds:
+            err.write('Error: --cmd needs a make database\n')
+            return False
+        try:
+            targets = cmds().targets(finder.store,
+                                     cmdindex.query_words(args.cmd))
+        except ValueError as e:
+            err.write('Error: {}\n'.format(e))
+            return False
+    return query(finder.store, args.node, direction, mode, args.depth,
+                 args.bfs, out, err, query_limits(args), args.reduce,
+                 targets)
+
+
+class QueryError(Exception):
+    pass
+
+
+class QueryParser(argparse.ArgumentParser):
+    '''Parses the queries of a batch file'''
+    def __init__(self):
+        argparse.ArgumentParser.__init__(self, prog='query', add_help=False)
+        self.add_argument('node')
+        add_query_arguments(self)
+
+    def error(self, message):
+        raise QueryError(message)
+
+
+# The graph used by the batch workers, and the function returning its
+# command index. They are set before the worker processes are forked,
+# so that they share them with the parent.
+batch_finder = None
+batch_cmds = None
+
+
+def run_batch_query(line):
+    '''Runs one line of a batch file. Returns (ok, output).'''
+    out = StringIO.StringIO()
+    try:
+        args = QueryParser().parse_args(shlex.split(line))
+    except QueryError as e:
+        sys.stderr.write('Error: {}: {}\n'.format(line, e))
+        return (False, '')
+    ok = run_query(batch_finder, args, out, cmds=batch_cmds)
+    return (ok, out.getvalue())
+
+
+def query_argv(args):
+    '''Returns the command line arguments of the query in args'''
+    argv = [args.node]
+    for (option, value) in (('-r', args.reverse), ('-i', args.indent),
+                            ('--bfs', args.bfs), ('--reduce', args.reduce)):
+        if value:
+            argv.append(option)
+    for (option, value) in (('-d', args.depth), ('-p', args.path),
+                            ('--reach', args.reach),
+                            ('--max-nodes', args.max_nodes),
+                            ('--max-edges', args.max_edges)):
+        if value:
+            argv.extend([option, str(value)])
+    if args.collapse is not None:
+        argv.extend(['--collapse', str(args.collapse)])
+    if args.cmd:
+        # The words may start with -
+        argv.append('--cmd=' + args.cmd)
+    return argv
+
+
+def remote_query(client, argv, out=sys.stdout):
+    '''Runs a query on a depserver.py server. Returns True if it
+       succeeded.'''
+    result = client.query(argv)
+    out.write(result['output'])
+    sys.stderr.write(result['errors'])
+    return result['ok']
+
+
+def run_remote_batch_query(client, line):
+    out = StringIO.StringIO()
+    ok = remote_query(client, shlex.split(line), out)
+    return (ok, out.getvalue())
+
+
+def read_batch(path):
+    '''Returns the queries of a batch file ('-' is stdin), skipping
+       empty lines and comments'''
+    fi = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        lines = [l.strip() for l in fi]
+    finally:
+        if fi is not sys.stdin:
+            fi.close()
+    return [l for l in lines if l and not l.startswith('#')]
+
+
+def run_batch(store, path, output_dir=None, jobs=1, client=None, cmds=None):
+    '''Runs all queries of a batch file on store, or on the server of
+       client. The output of each query is written to stdout, after
+       a comment line repeating the query, or to a numbered file in
+       output_dir. cmds returns the command index of store.
+       Returns True if all queries succeeded.'''
+    global batch_finder, batch_cmds
+    queries = read_batch(path)
+    pool = None
+    if client:
+        results = (run_remote_batch_query(client, line) for line in queries)
+    else:
+        batch_finder = PathFinder(store)
+        batch_cmds = cmds
+        if cmds and jobs != 1 and any('--cmd' in l for l in queries):
+            # Load it once, before the workers are forked
+            cmds()
+        if jobs == 1:
+            results = itertools.imap(run_batch_query, queries)
+        else:
+            pool = multiprocessing.Pool(jobs or None)
+            results = pool.imap(run_batch_query, queries)
+    all_ok = True
+    try:
+        answers = itertools.izip(queries, results)
+        for (n, (line, (ok, output))) in enumerate(answers):
+            all_ok = all_ok and ok
+            if output_dir:
+                name = '{:04d}.{}'.format(n + 1, 'dot' if 'digraph' in
+                                          output[:20] else 'txt')
+                with open(os.path.join(output_dir, name), 'w') as fo:
+                    fo.write(output)
+            else:
+                # dot ignores lines starting with '#'
+                sys.stdout.write('# query {}: {}\n'.format(n + 1, line))
+                sys.stdout.write(output)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return all_ok
+
+
+def find(args, parser):
+    '''Prints the node names matching args.find. Exits with status 1
+       if there are none.'''
+    if args.server:
+        try:
+            names = depclient.Client(args.server).find(args.find, args.match,
+                                                       args.limit)
+        except depclient.ServerError as e:
+            sys.exit('Error: {}'.format(e))
+    elif args.file:
+        store = graphcache.load_store(args.file, not args.no_cache,
+                                      args.jobs or None)
+        index = namesearch.load(args.file, namesearch.store_names(store),
+                                not args.no_cache)
+        names = index.find(args.find, args.match, args.limit)
+    else:
+        parser.error('--find needs a make database (-f) or a server (-S)')
+    for name in names:
+        print name
+    if not names:
+        sys.exit(1)
+
+
+def main():
+    usage = '''A filter which produces a subgraph containing the recursive
+               targets or prerequisites of a make target.
+               The graph is read from a make database if the -f option
+               is used. Otherwise a dot graph is read from stdin, and
+               the filter makes use of the gvpr command internally.
+               With --batch, many queries are answered from one
+               loaded graph: each line of the batch file holds a node
+               and the options of one query, e.g. "libtcs -i -d 4".
+               With -S, the queries are sent to a depserver.py server,
+               which already has the graph loaded.
+               With --find, the names of the nodes matching a text are
+               printed instead, the best matches first.'''
+    parser = argparse.ArgumentParser(description=usage)
+    parser.add_argument('node', nargs='?')
+    add_query_arguments(parser)
+    parser.add_argument('-f', '--file', action='store',
+                        help='make database to read the graph from, '
+                             'instead of a dot graph on stdin')
+    parser.add_argument('-S', '--server', action='store', metavar='SOCKET',
+                        help='send the queries to the depserver.py server '
+                             'listening on SOCKET, instead of loading a '
+                             'graph')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing the database '
+                             '(0 = one per CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write the index file make.db.idx')
+    parser.add_argument('-b', '--batch', action='store', metavar='FILE',
+                        help='read queries from FILE (- for stdin), one '
+                             'per line. Needs -f or -S.')
+    parser.add_argument('-o', '--output-dir', action='store',
+                        help='with --batch, write the output of query n to '
+                             'the file n.dot or n.txt in this directory')
+    parser.add_argument('--batch-jobs', type=int, default=1,
+                        help='with --batch, number of processes running '
+                             'queries (0 = one per CPU)')
+    parser.add_argument('--find', action='store', metavar='TEXT',
+                        help='print the node names matching TEXT. Needs -f '
+                             'or -S.')
+    parser.add_argument('--match', choices=namesearch.MODES, default='any',
+                        help='with --find, how names match: starting with '
+                             'TEXT (prefix), containing it (substring), '
+                             'sharing most of its parts (fuzzy), or any of '
+                             'these (any, the default)')
+    parser.add_argument('--limit', type=int, default=0,
+                        help='with --find, print at most this many names')
+    args = parser.parse_args()
+    if args.find is not None:
+        find(args, parser)
+        return
+    if (args.path or args.reach or args.batch or query_limits(args) or
+            args.reduce or args.cmd) and not (args.file or args.server):
+        parser.error('--path, --reach, --batch, --max-nodes, --max-edges, '
+                     '--collapse, --reduce and --cmd need a make database '
+                     '(-f) or a server (-S)')
+    if not args.node and not args.batch:
+        parser.error('a node or --batch is needed')
+    if args.server:
+        try:
+            client = depclient.Client(args.server)
+            if args.batch:
+                ok = run_batch(None, args.batch, args.output_dir,
+                               client=client)
+            else:
+                ok = remote_query(client, query_argv(args))
+        except depclient.ServerError as e:
+            sys.exit('Error: {}'.format(e))
+        if not ok:
+            sys.exit(1)
+    elif args.file:
+        store = graphcache.load_store(args.file, not args.no_cache,
+                                       args.jobs or None)
+        cmds = cmdindex.Loader(args.file, store, not args.no_cache)
+        if args.batch:
+            ok = run_batch(store, args.batch, args.output_dir,
+                           args.batch_jobs, cmds=cmds)
+        else:
+            ok = run_query(PathFinder(store), args, cmds=cmds)
+        if not ok:
+            sys.exit(1)
+    else:
+        (direction, mode) = query_mode(args)
+        filter(args.node, direction, mode, args.depth)
 
 if __name__ == "__main__":
     main()
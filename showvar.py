@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+'''Shows where make variables are defined, and their values'''
+
+import argparse
+import sys
+import textwrap
+
+import makevars
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Looks up variables in a database created by "make -qpR".
+           For each definition, the origin of the value (makefile,
+           environment, default, ...) is printed, with the makefile
+           and line number when known, and then the value.
+           The names may contain shell wildcards, e.g. 'TARGET_OUT*'.
+           The variable index is saved in make.db.vars, so only the
+           first lookup has to read the database.'''))
+    parser.add_argument('name', nargs='+')
+    parser.add_argument('-f', '--file', action='store', required=True,
+                        help='make database to read')
+    parser.add_argument('-o', '--origin', action='store',
+                        help='only show definitions with this origin, '
+                             'e.g. makefile or environment')
+    parser.add_argument('-m', '--makefile', action='store',
+                        help='only show definitions made in this makefile')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write make.db.vars')
+    args = parser.parse_args()
+
+    index = makevars.load_index(args.file, not args.no_cache)
+    found = False
+    for name in args.name:
+        for v in makevars.lookup(index, name, args.origin, args.makefile):
+            print '\n'.join(makevars.format_def(v))
+            found = True
+    if not found:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+'''Reduces a part of the make graph to a size which dot can lay out.
+
+   Two reductions are made, in this order:
+   * collapsing: nodes in the same directory and with the same suffix
+     (e.g. all out/obj/libfoo_intermediates/*.o) are replaced by one
+     summary node, when there are at least "collapse" of them.
+     See group_key().
+     Edges to and from the members go to the summary node instead.
+   * budget: only the most significant nodes are kept, at most
+     max_nodes nodes and max_edges edges. Nodes closer to the root
+     come first, and among nodes at the same distance, the ones with
+     more edges. The kept nodes are always connected to the root.
+     A node whose neighbours were not all kept is labelled with the
+     number of missing ones.'''
+
+import collections
+import os
+
+import graphstore
+import make2dot
+import reduction
+
+Limits = collections.namedtuple('Limits', ['max_nodes', 'max_edges',
+                                           'collapse'])
+
+# Group size from which nodes are collapsed, when a budget is set
+# but no group size is
+COLLAPSE = 10
+
+
+def group_key(name):
+    '''Returns the pattern of the group of a node name, e.g.
+       out/obj/libfoo_intermediates/*.o for .o files. Directories named
+       after the file, as the intermediates directory of a module, are
+       replaced by a wildcard too, so that e.g. all
+       out/obj/*_intermediates/LINKED/*.so are one group.'''
+    (directory, base) = os.path.split(name)
+    (stem, ext) = os.path.splitext(base)
+    parts = directory.split('/')
+    for (i, part) in enumerate(parts):
+        if stem and (part == stem or part.startswith(stem + '_')):
+            parts[i] = '*' + part[len(stem):]
+    return os.path.join('/'.join(parts), '*' + ext)
+
+
+class Subgraph:
+    '''A reduced graph. Its nodes are node ids of the store, or
+       patterns (strings) standing for a group of nodes.'''
+    def __init__(self, store):
+        self.store = store
+        self.level = {}
+        self.count = collections.Counter()
+        # (source, destination) -> True if all edges are order-only
+        self.edges = {}
+        self.hidden = collections.Counter()
+
+    def name(self, node):
+        if isinstance(node, str):
+            return node
+        return self.store.name(node)
+
+    def attrs(self, node):
+        attrs = ''
+        label = None
+        if isinstance(node, str):
+            attrs = make2dot.append_key_value(attrs, 'shape', 'box')
+            label = '{}\\n({} nodes)'.format(node, self.count[node])
+        elif self.store.flags(node) & graphstore.IS_PHONY:
+            attrs = make2dot.append_key_value(attrs, 'style', 'dotted')
+        if self.hidden[node]:
+            label = '{}\\n(+{} not shown)'.format(label or self.name(node),
+                                                 self.hidden[node])
+        if label:
+            attrs = make2dot.append_key_value(attrs, 'label',
+                                              '"{}"'.format(label))
+        if attrs:
+            attrs += ']'
+        return attrs
+
+    def reduce(self):
+        '''Leaves out the edges implied by other paths'''
+        for edge in reduction.redundant_edges(self.edges):
+            del self.edges[edge]
+
+    def write_dot(self, out):
+        lines = ['digraph out {']
+        for ((s, d), order_only) in sorted(self.edges.iteritems()):
+            line = '{} -> {}'.format(make2dot.make_id(self.name(s)),
+                                     make2dot.make_id(self.name(d)))
+            if order_only:
+                line += ' [style=dotted]'
+            lines.append(line + ';')
+        for node in sorted(self.level):
+            lines.append('{} {};'.format(make2dot.make_id(self.name(node)),
+                                         self.attrs(node)))
+        lines.append('}')
+        out.write('\n'.join(lines) + '\n')
+
+
+def collapse_groups(store, level, root, size):
+    '''Returns a dictionary from node id to the node representing it:
+       the pattern of its group, if the group has at least size
+       members, and else the node itself'''
+    rep = dict((i, i) for i in level)
+    if not size:
+        return rep
+    groups = collections.defaultdict(list)
+    for i in level:
+        if i != root:
+            groups[group_key(store.name(i))].append(i)
+    for (key, members) in groups.iteritems():
+        if len(members) >= size:
+            for i in members:
+                rep[i] = key
+    return rep
+
+
+def extract(store, walked, limits):
+    '''Returns the Subgraph for the nodes of walked, a breadth-first
+       list of (node id, level) as yielded by showdep.walk(), reduced
+       according to limits'''
+    level = collections.OrderedDict()
+    for (i, l) in walked:
+        level[i] = l
+    root = next(iter(level))
+    rep = collapse_groups(store, level, root, limits.collapse)
+
+    sub = Subgraph(store)
+    for (i, l) in level.iteritems():
+        r = rep[i]
+        sub.count[r] += 1
+        if r not in sub.level or l < sub.level[r]:
+            sub.level[r] = l
+    edges = {}
+    neighbours = collections.defaultdict(set)
+    for i in level:
+        (order, order_only) = store.prerequisites(i)
+        for (prereqs, is_order_only) in ((order, False), (order_only, True)):
+            for p in prereqs:
+                if p not in level or rep[p] == rep[i]:
+                    continue
+                edge = (rep[i], rep[p])
+                edges[edge] = edges.get(edge, True) and is_order_only
+                neighbours[edge[0]].add(edge[1])
+                neighbours[edge[1]].add(edge[0])
+
+    if not (limits.max_nodes or limits.max_edges):
+        sub.edges = edges
+        return sub
+    ranked = sorted(sub.level, key=lambda n: (sub.level[n],
+                                              -len(neighbours[n]),
+                                              sub.name(n)))
+    kept = set()
+    edge_count = 0
+    for n in ranked:
+        new_edges = len(neighbours[n] & kept)
+        if kept and ((limits.max_nodes and len(kept) >= limits.max_nodes) or
+                     (limits.max_edges and
+                      edge_count + new_edges > limits.max_edges)):
+            break
+        kept.add(n)
+        edge_count += new_edges
+    sub.edges = dict((e, o) for (e, o) in edges.iteritems()
+                     if e[0] in kept and e[1] in kept)
+    sub.level = dict((n, l) for (n, l) in sub.level.iteritems()
+                     if n in kept)
+    for n in kept:
+        sub.hidden[n] = len(neighbours[n] - kept)
+    return sub
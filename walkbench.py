@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+'''Measures how long mrwalker.py takes to react to the keys on the
+   nodes with the most neighbours, and compares it with the old
+   SelectionWindow, which put every line into its Listbox.'''
+
+import argparse
+import heapq
+import sys
+import textwrap
+import time
+from Tkinter import *
+
+import graphcache
+import graphstore
+import mrwalker
+
+
+class LegacySelectionWindow:
+    '''The SelectionWindow of mrwalker.py before VirtualList. Kept as
+       a reference.'''
+    def __init__(self, masterWindow, cmdWindow):
+        self.win = Listbox(masterWindow,
+                           selectmode=SINGLE,
+                           font='Courier')
+        self.cmdWin = cmdWindow
+
+    def update(self, node, targets, children):
+        self.win.delete(0, END)
+        parents = children[node] if node in children else []
+        (order, order_only, cmds) = targets[node]
+        all_lines = list(parents)
+        all_lines.append('  ' + node)
+        all_lines.extend(['    P: ' + x for x in order])
+        all_lines.extend(['    O: ' + x for x in order_only])
+        for l in all_lines:
+            self.win.insert(END, l)
+        target_ix = len(parents)
+        self.win.activate(target_ix)
+        self.win.see(target_ix)
+        self.cmdWin.update(cmds)
+
+    def pageDown(self):
+        self.win.yview_scroll(1, 'pages')
+
+    def end(self):
+        self.win.see(END)
+
+
+def high_degree(store, count):
+    '''Returns the names of the count targets with the most parents
+       and prerequisites, the most connected first'''
+    def degree(i):
+        return (store.rev_off[i + 1] - store.rev_off[i] +
+                store.fwd_off[i + 1] - store.fwd_off[i])
+    targets = (i for i in xrange(store.n)
+               if store.flags(i) & graphstore.IS_TARGET)
+    return [(store.name(i), degree(i))
+            for i in heapq.nlargest(count, targets, key=degree)]
+
+
+def timed(root, func, *args):
+    '''Returns the time in ms which func and the redrawing take'''
+    start = time.time()
+    func(*args)
+    root.update_idletasks()
+    return (time.time() - start) * 1000
+
+
+def measure(root, window, node, pages, targets, children):
+    '''Returns the times of showing node, of going pages pages down,
+       and of going to the end'''
+    enter = timed(root, window.update, node, targets, children)
+    if isinstance(window, LegacySelectionWindow):
+        (page_down, end) = (window.pageDown, window.end)
+    else:
+        (page_down, end) = (lambda: window.list.move(window.list.rows),
+                            lambda: window.list.moveTo(
+                                len(window.list.lines) - 1))
+    page = sum(timed(root, page_down) for i in xrange(pages)) / pages
+    return (enter, page, timed(root, end))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+           Benchmarks the node list of mrwalker.py on a database
+           created by "make -qpR". For each of the nodes with the
+           most neighbours, prints the time in ms to show the node
+           (Enter), to go one page down (PgDn, the average of
+           --pages pages) and to go to the end of the list (End),
+           including the time Tk takes to redraw. The first numbers
+           are for mrwalker.py, the second ones for the old list which
+           held every line. Needs a display.'''))
+    parser.add_argument('-f', '--file', action='store',
+                        help='make database to read', required=True)
+    parser.add_argument('-n', '--nodes', type=int, default=5,
+                        help='number of nodes to measure (default 5)')
+    parser.add_argument('--pages', type=int, default=10,
+                        help='number of pages to go down (default 10)')
+    parser.add_argument('--no-legacy', action='store_true',
+                        help='do not measure the old list')
+    args = parser.parse_args()
+
+    try:
+        root = Tk()
+    except TclError as e:
+        sys.exit('Error: {}'.format(e))
+    store = graphcache.load_store(args.file)
+    (targets, children) = graphstore.views(store)
+    if isinstance(store, graphcache.GraphIndex):
+        store = store.to_store()
+    nodes = high_degree(store, args.nodes)
+
+    root.geometry('1200x900')
+    m = PanedWindow(root, orient=VERTICAL)
+    m.pack(fill=BOTH, expand=1)
+    bottom = mrwalker.CmdWindow(m)
+    windows = [mrwalker.SelectionWindow(m, bottom)]
+    if not args.no_legacy:
+        windows.append(LegacySelectionWindow(m, bottom))
+    for w in windows:
+        m.add(w.win)
+    m.add(bottom.win)
+    root.update()
+
+    print '{:>8} {:>17} {:>17} {:>17}  {}'.format(
+        'degree', 'Enter', 'PgDn', 'End', 'node')
+    for (node, degree) in nodes:
+        results = [measure(root, w, node, args.pages, targets, children)
+                   for w in windows]
+        cells = [' / '.join('{:.1f}'.format(r[k]) for r in results)
+                 for k in xrange(3)]
+        print '{:8} {:>17} {:>17} {:>17}  {}'.format(degree, *(cells + [node]))
+    root.destroy()
+
+if __name__ == "__main__":
+    main()